@@ -0,0 +1,9 @@
+"""
+API benchmarks against synthetic point datasets.
+
+    python -m benchmarks.run --rows 1000000 --concurrency 8 --output bench.json
+
+Generates a point dataset of the given size (unless it's already there),
+ingests it into the database from plenario.settings with PlenarioETL, and
+times the main API endpoints against it. See benchmarks/run.py for options.
+"""
@@ -0,0 +1,190 @@
+"""
+Time the main API endpoints against synthetic point datasets.
+
+    python -m benchmarks.run --rows 1000000,10000000 --concurrency 8 \\
+        --requests 200 --output bench.json
+
+Every endpoint gets the same number of requests, at most --concurrency of
+them in flight at once. The requests use random date windows and grid
+resolutions drawn from --seed, so that a run is reproducible but doesn't
+just measure the cache. The cache is flushed before each endpoint unless
+--keep-cache is given.
+
+Requests go through the app in this process by default, or to a running
+server with --url. The report is JSON, with p50/p95/p99 latency (ms) and
+throughput (requests per second) per endpoint and dataset size.
+"""
+
+import argparse
+import json
+import random
+import subprocess
+import sys
+import time
+from datetime import date, timedelta
+from multiprocessing.pool import ThreadPool
+from urllib import urlencode
+
+import requests
+
+from benchmarks.synthetic import ingest_points, ingest_neighborhoods, \
+    FIRST_YEAR, LAST_YEAR
+from plenario.warmer import percentile, WARMING_ENVIRON_KEY
+
+ENDPOINTS = ['timeseries', 'detail', 'detail-aggregate', 'grid', 'shapes',
+             'datasets']
+
+
+def _window(rng):
+    """Random date window of a month to two years."""
+
+    first, last = date(FIRST_YEAR, 1, 1), date(LAST_YEAR, 12, 31)
+    length = rng.randint(30, 730)
+    start = first + timedelta(days=rng.randint(0, (last - first).days - length))
+    return {'obs_date__ge': start.isoformat(),
+            'obs_date__le': (start + timedelta(days=length)).isoformat()}
+
+
+def make_urls(endpoint, dataset, shapeset, n, seed):
+    """:returns: list of n request URLs (path and query string) to send to
+                 an endpoint"""
+
+    rng = random.Random('{}:{}:{}'.format(endpoint, dataset, seed))
+    urls = []
+    for _ in range(n):
+        args = _window(rng)
+        if endpoint == 'shapes':
+            path = '/v1/api/shapes/{}/{}'.format(shapeset, dataset)
+        elif endpoint == 'datasets':
+            path = '/v1/api/datasets'
+            # Half listings of everything, half lookups of one dataset.
+            args = {'dataset_name': dataset} if rng.random() < 0.5 else {}
+        else:
+            path = '/v1/api/' + endpoint
+            args['dataset_name'] = dataset
+            if endpoint in ('timeseries', 'detail-aggregate'):
+                args['agg'] = rng.choice(['day', 'week', 'month'])
+            elif endpoint == 'grid':
+                args['resolution'] = rng.choice([250, 500, 1000])
+        urls.append(path + ('?' + urlencode(sorted(args.items())) if args else ''))
+    return urls
+
+
+class AppClient(object):
+    """Sends requests through the app in this process."""
+
+    def __init__(self):
+        from plenario import create_app
+        self.app = create_app()
+
+    def get(self, url):
+        # Test clients aren't safe to share between threads. Benchmark
+        # requests aren't traffic the cache warmer should learn from.
+        client = self.app.test_client()
+        return client.get(url, environ_base={WARMING_ENVIRON_KEY: True}).status_code
+
+    def flush_cache(self):
+        from plenario.api.common import cache
+        with self.app.app_context():
+            cache.clear()
+
+
+class HTTPClient(object):
+    """Sends requests to a running server."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+
+    def get(self, url):
+        return requests.get(self.base_url + url).status_code
+
+    def flush_cache(self):
+        requests.get(self.base_url + '/v1/api/flush-cache')
+
+
+def run_endpoint(client, urls, concurrency):
+    """:returns: dict of request count, errors, latency percentiles (ms) and
+                 throughput (requests per second)"""
+
+    def timed(url):
+        start = time.time()
+        try:
+            status = client.get(url)
+        except Exception:
+            status = None
+        return (time.time() - start) * 1000, status
+
+    pool = ThreadPool(concurrency)
+    start = time.time()
+    try:
+        results = pool.map(timed, urls)
+    finally:
+        pool.close()
+    elapsed = time.time() - start
+
+    times = sorted(ms for ms, status in results if status == 200)
+    report = {
+        'requests': len(results),
+        'errors': len(results) - len(times),
+        'throughput': round(len(times) / elapsed, 2) if elapsed else None,
+    }
+    for p in (50, 95, 99):
+        ms = percentile(times, p)
+        report['p{}_ms'.format(p)] = round(ms, 1) if ms is not None else None
+    return report
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD']).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--rows', default='1000000',
+                        help='comma separated dataset sizes')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per endpoint and dataset size')
+    parser.add_argument('--endpoints', default=','.join(ENDPOINTS))
+    parser.add_argument('--url', help='base URL of a running server')
+    parser.add_argument('--keep-cache', action='store_true')
+    parser.add_argument('--output', help='file for the JSON report, '
+                                         'standard output if not given')
+    args = parser.parse_args(argv)
+
+    client = HTTPClient(args.url) if args.url else AppClient()
+    shapeset = ingest_neighborhoods()
+
+    report = {
+        'revision': _git_revision(),
+        'seed': args.seed,
+        'concurrency': args.concurrency,
+        'requests': args.requests,
+        'results': {},
+    }
+    for rows in [int(r) for r in args.rows.split(',')]:
+        dataset = ingest_points(rows, args.seed)
+        results = report['results'][str(rows)] = {}
+        for endpoint in args.endpoints.split(','):
+            if not args.keep_cache:
+                client.flush_cache()
+            urls = make_urls(endpoint, dataset, shapeset, args.requests,
+                             args.seed)
+            results[endpoint] = run_endpoint(client, urls, args.concurrency)
+            print >> sys.stderr, '{:>10} rows {:>17}: {}'.format(
+                rows, endpoint, results[endpoint])
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print output
+
+
+if __name__ == '__main__':
+    main()
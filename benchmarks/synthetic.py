@@ -0,0 +1,167 @@
+"""
+Synthetic point datasets which look enough like the real ones to exercise
+the same query plans: most points fall around a handful of hot spots in
+Chicago, recent years hold more records than old ones, and a few
+categories make up most of the rows.
+"""
+
+import csv
+import os
+import random
+from datetime import datetime, timedelta
+
+from plenario.database import session
+from plenario.etl.point import PlenarioETL
+from plenario.etl.shape import ShapeETL
+from plenario.models import MetaTable, ShapeMetadata
+from plenario.settings import DATA_DIR
+
+# Chicago, roughly.
+MIN_LAT, MAX_LAT = 41.644, 42.023
+MIN_LON, MAX_LON = -87.940, -87.524
+
+FIRST_YEAR, LAST_YEAR = 2001, 2016
+
+HOT_SPOTS = 25
+# Share of the points which are spread uniformly instead of around a hot spot.
+BACKGROUND = 0.2
+CATEGORIES = 30
+
+COLUMNS = ['id', 'date', 'category', 'arrest', 'value', 'latitude', 'longitude']
+
+NEIGHBORHOODS_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                                  'tests', 'test_fixtures',
+                                  'chicago_neighborhoods.zip')
+
+
+def dataset_name(rows, seed):
+    return 'bench_points_{}_{}'.format(rows, seed)
+
+
+def _zipf_weights(n, s=1.1):
+    return [1.0 / (rank ** s) for rank in range(1, n + 1)]
+
+
+def _cumulative(weights):
+    total, cum = 0.0, []
+    for w in weights:
+        total += w
+        cum.append(total)
+    return [c / total for c in cum]
+
+
+def _pick(rng, cum):
+    # Binary search over the cumulative weights.
+    x, lo, hi = rng.random(), 0, len(cum) - 1
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if cum[mid] < x:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def generate_points(path, rows, seed=0):
+    """Write a CSV of rows synthetic points. The same seed always gives
+    the same file.
+
+    :param path: where to write the CSV
+    :param rows: number of records
+    :param seed: random seed"""
+
+    rng = random.Random(seed)
+
+    spots = [(rng.uniform(MIN_LAT, MAX_LAT), rng.uniform(MIN_LON, MAX_LON),
+              rng.uniform(0.002, 0.02)) for _ in range(HOT_SPOTS)]
+    spot_cum = _cumulative(_zipf_weights(HOT_SPOTS))
+    category_cum = _cumulative(_zipf_weights(CATEGORIES))
+
+    # Later years have more records, the way datasets grow as agencies
+    # start publishing more.
+    years = range(FIRST_YEAR, LAST_YEAR + 1)
+    year_cum = _cumulative([i + 1 for i in range(len(years))])
+    # More happens in the afternoon and evening than at dawn.
+    hour_cum = _cumulative([1, 1, 1, 1, 1, 1, 2, 3, 4, 4, 4, 5,
+                            5, 5, 5, 6, 6, 6, 6, 5, 4, 3, 2, 1])
+
+    with open(path, 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(COLUMNS)
+        for i in xrange(rows):
+            if rng.random() < BACKGROUND:
+                lat = rng.uniform(MIN_LAT, MAX_LAT)
+                lon = rng.uniform(MIN_LON, MAX_LON)
+            else:
+                lat, lon, spread = spots[_pick(rng, spot_cum)]
+                lat = rng.gauss(lat, spread)
+                lon = rng.gauss(lon, spread)
+
+            year = years[_pick(rng, year_cum)]
+            moment = datetime(year, 1, 1) + timedelta(
+                days=rng.randint(0, 364),
+                hours=_pick(rng, hour_cum),
+                seconds=rng.randint(0, 3599))
+
+            writer.writerow([
+                i,
+                moment.strftime('%Y-%m-%d %H:%M:%S'),
+                'category_{}'.format(_pick(rng, category_cum)),
+                rng.random() < 0.25,
+                round(rng.expovariate(0.01), 2),
+                round(lat, 9),
+                round(lon, 9),
+            ])
+
+
+def ingest_points(rows, seed=0):
+    """Generate and ingest a synthetic point dataset, unless one of that
+    size and seed is already in the database.
+
+    :returns: name of the dataset"""
+
+    name = dataset_name(rows, seed)
+    if MetaTable.get_by_dataset_name(name) is not None:
+        return name
+
+    path = os.path.join(DATA_DIR, name + '.csv')
+    generate_points(path, rows, seed)
+
+    md = MetaTable(url='benchmark://{}'.format(name),
+                   human_name=u'Benchmark points ({:,} rows)'.format(rows),
+                   dataset_name=unicode(name),
+                   business_key=u'id',
+                   observed_date=u'date',
+                   latitude=u'latitude',
+                   longitude=u'longitude',
+                   approved_status='true',
+                   column_names={'id': 'INTEGER', 'date': 'TIMESTAMP',
+                                 'category': 'VARCHAR', 'arrest': 'BOOLEAN',
+                                 'value': 'DOUBLE PRECISION',
+                                 'latitude': 'DOUBLE PRECISION',
+                                 'longitude': 'DOUBLE PRECISION'})
+    session.add(md)
+    session.commit()
+    try:
+        PlenarioETL(md, source_path=path).add()
+    finally:
+        os.remove(path)
+    return name
+
+
+def ingest_neighborhoods():
+    """Ingest the Chicago neighborhoods test fixture, to aggregate the
+    points over with /shapes/<polygon>/<point>.
+
+    :returns: name of the shape dataset"""
+
+    human_name = u'Benchmark Neighborhoods'
+    name = ShapeMetadata.make_table_name(human_name)
+    if ShapeMetadata.get_by_dataset_name(name) is not None:
+        return name
+
+    meta = ShapeMetadata.add(human_name=human_name, source_url=None,
+                             update_freq='yearly', approved_status=True)
+    session.commit()
+    ShapeETL(meta=meta, source_path=NEIGHBORHOODS_PATH).add()
+    return name
@@ -39,7 +39,8 @@ def init_meta():
     #Reset concept of a metadata table
     non_meta_tables = [table for table in Base.metadata.sorted_tables
                        if table.name not in
-                       {'meta_master', 'meta_shape', 'plenario_user'}]
+                       {'meta_master', 'meta_shape', 'plenario_user',
+                        'perf_slow_queries'}]
     for t in non_meta_tables:
         Base.metadata.remove(t)
     
@@ -2,6 +2,9 @@ import json
 from flask import make_response, Blueprint
 from point import timeseries, detail, meta, dataset_fields, grid, detail_aggregate
 from common import cache, make_cache_key
+from plenario.tasks import warm_cache
+from plenario.api.compression import compress_response
+from plenario.api.timing import start_timing, finish_timing
 from shape import get_all_shape_datasets,\
                     export_shape, aggregate_point_data
 from time import sleep
@@ -10,6 +13,11 @@ from sensor import weather_stations, weather
 API_VERSION = '/v1'
 
 api = Blueprint('api', __name__)
+api.before_request(start_timing)
+# after_request hooks run last to first: compression goes after everything
+# else has had a look at the body.
+api.after_request(compress_response)
+api.after_request(finish_timing)
 prefix = API_VERSION + '/api'
 
 api.add_url_rule(prefix + '/timeseries', 'timeseries', timeseries)
@@ -30,6 +38,7 @@ api.add_url_rule(prefix + '/shapes/<polygon_dataset_name>/<point_dataset_name>',
 @api.route(prefix + '/flush-cache')
 def flush_cache():
     cache.clear()
+    warm_cache.delay()
     resp = make_response(json.dumps({'status': 'ok', 'message': 'cache flushed!'}))
     resp.headers['Content-Type'] = 'application/json'
     return resp
@@ -1,20 +1,40 @@
+import base64
+import hashlib
 import json
+import re
+import threading
+import time
 from flask.ext.cache import Cache
-from plenario.settings import CACHE_CONFIG
+from redis import RedisError
+from werkzeug.contrib.cache import RedisCache
+from plenario.settings import CACHE_CONFIG, CACHE_TIMEOUT, CACHE_STALE_TIMEOUT
 from datetime import timedelta, date, datetime
-from functools import update_wrapper
-from flask import make_response, request, current_app
+from functools import update_wrapper, wraps
+from flask import make_response, request, current_app, copy_current_request_context
 import csv
 from shapely.geometry import asShape
 from cStringIO import StringIO
 from plenario.utils.helpers import get_size_in_degrees
+from plenario.database import session, redis_client, cache_generations, \
+    store_cache_entry, EVERY_DATASET
+from plenario.warmer import record_query, WARMING_ENVIRON_KEY
+from plenario.api.timing import timed, note_cache_key
+from plenario.api.compression import gzipped, for_client
+from plenario.api.conditional import validators, is_not_modified, \
+    not_modified, with_validators
 from plenario.models import MetaTable
 from sqlalchemy.sql.schema import Table
 
 cache = Cache(config=CACHE_CONFIG)
 
 RESPONSE_LIMIT = 1000
-CACHE_TIMEOUT = 60*60*6
+# Seconds a worker may hold the lock for building a cached response, and
+# how long other workers wait on it before building the response themselves.
+CACHE_LOCK_TIMEOUT = 120
+CACHE_LOCK_WAIT = 60
+# Number of rows fetched per round trip from a server-side cursor
+# when a response is streamed.
+STREAM_BATCH_SIZE = 1000
 
 
 def unknown_object_json_handler(obj):
@@ -50,6 +70,33 @@ def date_json_handler(obj):
         raise ValueError
 
 
+def encode_page_token(*values):
+    """Build an opaque continuation token out of the sort key of the last
+    row on a page. Handing it back lets the next page pick up right after that
+    row, instead of scanning past every row before it like OFFSET does.
+
+    :param values: sort key values of the last row (ex. point_date, hash)
+    :returns: url-safe token string"""
+
+    return base64.urlsafe_b64encode(json.dumps(values, default=date_json_handler))
+
+
+def decode_page_token(token):
+    """Reverse encode_page_token. Dates come back as ISO formatted strings.
+
+    :param token: string made by encode_page_token
+    :returns: list of sort key values
+    :raises: ValueError if the token is malformed"""
+
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(token)))
+    except (TypeError, ValueError, UnicodeEncodeError):
+        raise ValueError('Invalid page token: {}'.format(token))
+    if not isinstance(values, list):
+        raise ValueError('Invalid page token: {}'.format(token))
+    return values
+
+
 # http://flask.pocoo.org/snippets/56/
 def crossdomain(origin=None, methods=None, headers=None,
                 max_age=21600, attach_to_all=True,
@@ -94,9 +141,297 @@ def crossdomain(origin=None, methods=None, headers=None,
 
 
 def make_cache_key(*args, **kwargs):
+    """Key for endpoints that don't validate their arguments. Unlike hash(),
+    the digest is the same in every worker process."""
+
     path = request.path
-    args = str(hash(frozenset(request.args.items())))
-    return (path + args).encode('utf-8')
+    args = sorted(request.args.items(multi=True))
+    digest = hashlib.sha1(json.dumps(args)).hexdigest()
+    return (path + digest).encode('utf-8')
+
+
+def canonical_cache_key(args):
+    """Build a cache key out of validated arguments rather than the raw query
+    string, so that requests which mean the same thing share an entry no
+    matter how the dates were written, what order the datasets were listed
+    in or how the GeoJSON was formatted.
+
+    :param args: ValidatorResult of user provided arguments
+    :returns: key string"""
+
+    canonical = {k: _canonical_value(k, v) for k, v in args.data.items()}
+    # Warnings end up in the response, so they're part of what's cached.
+    canonical['__warnings__'] = sorted(repr(w) for w in args.warnings)
+    payload = json.dumps(canonical, sort_keys=True, separators=(',', ':'))
+    digest = hashlib.sha1(payload).hexdigest()
+    return '{}:{}'.format(request.endpoint, digest)
+
+
+def _canonical_value(key, value):
+    if isinstance(value, Table):
+        return value.name
+    elif isinstance(value, (datetime, date)):
+        return value.isoformat()
+    elif key == 'geom' and value:
+        # Reload the fragment so whitespace, key order and the way numbers
+        # were written don't matter.
+        return _float_coordinates(json.loads(value))
+    elif isinstance(value, (list, tuple)):
+        values = [_canonical_value(None, v) for v in value]
+        # The order of dataset_name__in has no meaning.
+        return sorted(values) if key == 'dataset_name__in' else values
+    elif isinstance(value, dict):
+        return {k: _canonical_value(k, v) for k, v in value.items()}
+    return value
+
+
+def _float_coordinates(obj):
+    if isinstance(obj, bool):
+        return obj
+    elif isinstance(obj, (int, long, float)):
+        return float(obj)
+    elif isinstance(obj, list):
+        return [_float_coordinates(o) for o in obj]
+    elif isinstance(obj, dict):
+        return {k: _float_coordinates(v) for k, v in obj.items()}
+    return obj
+
+
+def cache_tags(args):
+    """Names of the datasets a response to these arguments will read, so
+    that it can be dropped from the cache when one of them is updated.
+
+    :param args: ValidatorResult of user provided arguments
+    :returns: set of dataset names"""
+
+    data = args.data
+    tags = set()
+    for key, value in data.items():
+        if key in {'dataset', 'shapeset'} and value is not None:
+            tags.add(getattr(value, 'name', value))
+        elif key == 'dataset_name__in' and value:
+            tags.update(value)
+        elif 'filter' in key:
+            tags.add(re.split(r'__(?!_)', key)[0])
+
+    # Without a dataset the response is about all of them, including ones
+    # which don't exist yet.
+    if data.get('dataset') is None and not data.get('dataset_name__in'):
+        tags.add(EVERY_DATASET)
+    return tags
+
+
+def cached_response(timeout=CACHE_TIMEOUT, unless=None, stale_timeout=None):
+    """Cache the response of a handler which takes a ValidatorResult, under
+    its canonical_cache_key. Only successful responses are kept.
+
+    Misses are single-flight: the first worker to miss on a key takes a
+    redis lock and builds the response, while identical requests wait on the
+    lock and then read what it cached, instead of all running the same query.
+
+    With a stale_timeout, a response older than timeout is still served for
+    up to stale_timeout more seconds, while a background thread builds its
+    replacement. Only once that runs out does a request have to wait.
+
+    Responses are cached gzipped, and handed out that way to clients which
+    accept gzip, so a hit costs no compression.
+
+    Responses carry an ETag and Last-Modified worked out from the key and
+    the update times of the datasets (see plenario.api.conditional), and a
+    client which has the current version gets a 304 before the cache is
+    read.
+
+    :param timeout: seconds a response is served as is
+    :param unless: callable taking the ValidatorResult, if it returns true
+                   the response is neither looked up nor stored
+    :param stale_timeout: seconds a response is served past timeout while
+                          it is refreshed, by default it isn't"""
+
+    def decorator(f):
+        @wraps(f)
+        def decorated(args, *a, **kw):
+            # Handlers are free to modify args, so work these out up front.
+            key = canonical_cache_key(args)
+            tags = cache_tags(args)
+
+            etag, last_modified = validators(key, tags)
+            if is_not_modified(etag, last_modified):
+                return not_modified(etag, last_modified)
+
+            if unless is not None and unless(args):
+                with timed('handler'):
+                    resp = f(args, *a, **kw)
+            else:
+                resp = _cached(f, key, tags, args, a, kw)
+            return with_validators(resp, etag, last_modified)
+
+        def _cached(f, key, tags, args, a, kw):
+            _record_query(key)
+            note_cache_key(key, tags)
+
+            def build(args):
+                generations = _cache_generations(tags)
+                with timed('handler'):
+                    resp = f(args, *a, **kw)
+                if resp.status_code == 200:
+                    if generations is not None:
+                        _cache_set(key, gzipped(resp), tags, generations,
+                                   timeout, stale_timeout)
+                    for_client(resp)
+                return resp
+
+            with timed('cache'):
+                entry = _cache_get(key)
+            if entry is not None:
+                fresh_until, resp = entry
+                if time.time() > fresh_until:
+                    _refresh_in_background(key, build, _copy_args(args))
+                return for_client(resp)
+
+            with timed('cache'):
+                lock = _acquire_lock('lock', key)
+            try:
+                if lock is not None:
+                    # Whoever held the lock before us may have just cached it.
+                    with timed('cache'):
+                        entry = _cache_get(key)
+                    if entry is not None:
+                        return for_client(entry[1])
+                return build(args)
+            finally:
+                if lock is not None:
+                    _release_lock(lock)
+        return decorated
+    return decorator
+
+
+def conditional_response(f):
+    """Give the response of a handler which takes a ValidatorResult, but
+    isn't cached, an ETag and Last-Modified, and answer with a 304 when
+    the client has the current version. See cached_response."""
+
+    @wraps(f)
+    def decorated(args, *a, **kw):
+        etag, last_modified = validators(canonical_cache_key(args), cache_tags(args))
+        if is_not_modified(etag, last_modified):
+            return not_modified(etag, last_modified)
+        return with_validators(f(args, *a, **kw), etag, last_modified)
+    return decorated
+
+
+def _record_query(key):
+    if request.environ.get(WARMING_ENVIRON_KEY):
+        return
+    try:
+        record_query(key, request.full_path)
+    except RedisError:
+        current_app.logger.exception('Failed to record query for the warmer')
+
+
+def _cache_get(key):
+    """:returns: (time the response goes stale, response) or None"""
+
+    try:
+        return cache.get(key)
+    except Exception:
+        current_app.logger.exception('Failed to read from cache')
+        return None
+
+
+def _tagged_cache():
+    """Responses are stored and tagged in one redis transaction, see
+    store_cache_entry. With any other backend (ex. simple, for development)
+    they go through Flask-Cache untagged, and ETL runs can't drop them, so
+    they're only current until they expire.
+
+    :returns: whether the cache's backend is redis"""
+
+    return isinstance(cache.cache, RedisCache)
+
+
+def _cache_generations(tags):
+    """:returns: cache_generations of the tags, or None if there's no
+                 telling, in which case the response isn't cached"""
+
+    if not _tagged_cache():
+        return []
+    try:
+        return cache_generations(tags)
+    except RedisError:
+        current_app.logger.exception('Failed to read cache generations')
+        return None
+
+
+def _cache_set(key, resp, tags, generations, timeout, stale_timeout=None):
+    fresh_until = time.time() + timeout
+    if stale_timeout:
+        timeout += stale_timeout
+    try:
+        if _tagged_cache():
+            # Written the way the cache's backend would, so cache.get reads it.
+            data = cache.cache.dump_object((fresh_until, resp))
+            store_cache_entry(key, data, tags, timeout, generations)
+        else:
+            cache.set(key, (fresh_until, resp), timeout=timeout)
+    except Exception:
+        current_app.logger.exception('Failed to write to cache')
+
+
+def _copy_args(args):
+    # Handlers add and delete keys of args.data, but don't change its values.
+    return args._replace(data=dict(args.data), warnings=list(args.warnings))
+
+
+def _refresh_in_background(key, build, args):
+    """Rebuild a stale response in a thread of its own, unless some worker
+    is already at it. The thread gets a copy of the request context, so the
+    handler runs just like it would have for the request itself."""
+
+    lock = _acquire_lock('refresh', key, blocking=False)
+    if lock is None:
+        return
+
+    @copy_current_request_context
+    def refresh():
+        try:
+            build(args)
+        except Exception:
+            current_app.logger.exception('Failed to refresh cached response')
+        finally:
+            _release_lock(lock)
+            # The handler used this thread's scoped session, hand its
+            # connection back to the pool.
+            session.remove()
+
+    thread = threading.Thread(target=refresh)
+    thread.daemon = True
+    thread.start()
+
+
+def _acquire_lock(kind, key, blocking=True):
+    """:returns: the held lock, or None if it couldn't be had (in
+                 CACHE_LOCK_WAIT seconds when blocking), in which case the
+                 caller goes on without it"""
+
+    name = '{}:{}:{}'.format(CACHE_CONFIG['CACHE_KEY_PREFIX'], kind, key)
+    # The lock expires by itself in case its holder dies mid-build. It isn't
+    # thread local, so a background refresh can release it when it's done.
+    lock = redis_client.lock(name, timeout=CACHE_LOCK_TIMEOUT, sleep=0.05,
+                             blocking_timeout=CACHE_LOCK_WAIT,
+                             thread_local=False)
+    try:
+        return lock if lock.acquire(blocking=blocking) else None
+    except RedisError:
+        current_app.logger.exception('Failed to take cache lock')
+        return None
+
+
+def _release_lock(lock):
+    try:
+        lock.release()
+    except RedisError:
+        # It expired before the response was built, nothing left to release.
+        pass
 
 
 def make_csv(data):
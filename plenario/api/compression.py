@@ -0,0 +1,142 @@
+"""
+Compressed API responses.
+
+compress_response runs after every API request and encodes the body with
+brotli or gzip, whichever the client accepts and we have (brotli is
+optional). Cached responses are stored gzipped, see cached_response, and a
+client which accepts gzip is handed the stored body as is.
+"""
+
+import zlib
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Bodies smaller than this (bytes) aren't worth the trouble.
+MIN_SIZE = 500
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+# Makes zlib write a gzip header and trailer.
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+COMPRESSIBLE_TYPES = {
+    'application/json',
+    'text/csv',
+    'application/vnd.mapbox-vector-tile',
+    'application/vnd.google-earth.kml+xml',
+}
+
+
+def accepted_encodings():
+    """:returns: set of content codings the client accepts"""
+
+    accepted = set()
+    for part in request.headers.get('Accept-Encoding', '').split(','):
+        coding, _, params = part.strip().partition(';')
+        params = params.replace(' ', '')
+        if coding and params not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            accepted.add(coding.lower())
+    return accepted
+
+
+def negotiate_encoding():
+    """:returns: 'br', 'gzip' or None"""
+
+    accepted = accepted_encodings()
+    if brotli is not None and 'br' in accepted:
+        return 'br'
+    elif 'gzip' in accepted or '*' in accepted:
+        return 'gzip'
+    return None
+
+
+def gzip(data):
+    # Unlike the gzip module, this leaves the timestamp out of the header,
+    # so the same body always compresses to the same bytes.
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, GZIP_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def gunzip(data):
+    return zlib.decompress(data, GZIP_WBITS)
+
+
+def _gzip_stream(chunks):
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, GZIP_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _compressible(resp):
+    return resp.status_code == 200 \
+        and 'Content-Encoding' not in resp.headers \
+        and resp.mimetype in COMPRESSIBLE_TYPES
+
+
+def gzipped(resp):
+    """Gzip a buffered response in place, for the cache.
+
+    :returns: the response"""
+
+    if _compressible(resp) and not resp.is_streamed:
+        resp.set_data(gzip(resp.get_data()))
+        resp.headers['Content-Encoding'] = 'gzip'
+    return resp
+
+
+def decompressed(resp):
+    """Undo gzipped, in place.
+
+    :returns: the response"""
+
+    if resp.headers.get('Content-Encoding') == 'gzip' and not resp.is_streamed:
+        resp.set_data(gunzip(resp.get_data()))
+        del resp.headers['Content-Encoding']
+    return resp
+
+
+def for_client(resp):
+    """Hand a cached (gzipped) response to a client which may not take gzip.
+
+    :returns: the response"""
+
+    if 'gzip' not in accepted_encodings():
+        decompressed(resp)
+    resp.vary.add('Accept-Encoding')
+    return resp
+
+
+def compress_response(resp):
+    """after_request hook compressing the response if the client accepts it."""
+
+    if not _compressible(resp):
+        return resp
+    resp.vary.add('Accept-Encoding')
+
+    if resp.is_streamed:
+        # Streams are only ever gzipped.
+        if 'gzip' not in accepted_encodings():
+            return resp
+        encoding = 'gzip'
+        resp.response = _gzip_stream(resp.response)
+    else:
+        encoding = negotiate_encoding()
+        if encoding is None:
+            return resp
+        data = resp.get_data()
+        if len(data) < MIN_SIZE:
+            return resp
+        if encoding == 'br':
+            resp.set_data(brotli.compress(data, quality=BROTLI_QUALITY))
+        else:
+            resp.set_data(gzip(data))
+
+    resp.headers['Content-Encoding'] = encoding
+    return resp
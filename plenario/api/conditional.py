@@ -0,0 +1,83 @@
+"""
+Conditional GETs.
+
+A response only changes when the arguments do or the data behind it does,
+and the catalog knows when every dataset was last updated. So the ETag and
+Last-Modified of a response are worked out from its canonical cache key and
+those times alone, and a client which already has the current version gets
+a 304 before any query runs or any cached body is read.
+
+Metadata isn't timestamped, and admin edits to it leave the update times
+alone. They do invalidate the cached responses of the dataset, which bumps
+the cache generations of its tags, so the ETag goes by those as well.
+Responses covering every dataset (ex. the /datasets listing) can also lose
+a dataset, so their ETag changes with the catalog version too.
+"""
+
+import hashlib
+import json
+
+from flask import make_response, request
+from redis import RedisError
+
+from plenario.catalog import catalog
+from plenario.database import EVERY_DATASET, cache_generations
+
+
+def validators(key, dataset_names):
+    """:param key: canonical key of the response
+    :param dataset_names: names of the datasets it's built from
+    :returns: (ETag, Last-Modified), or (None, None) when there's no telling
+              when the data last changed"""
+
+    found = catalog.last_updates(dataset_names)
+    if not found:
+        return None, None
+    updates, version = found
+    if not updates:
+        return None, None
+    try:
+        generations = cache_generations(dataset_names)
+    except RedisError:
+        return None, None
+
+    state = sorted((name, updated.isoformat()) for name, updated in updates.items())
+    state.append(generations)
+    if EVERY_DATASET in dataset_names:
+        state.append(version)
+    etag = hashlib.sha1(json.dumps([key, state])).hexdigest()
+    # HTTP dates have no fractions of a second.
+    last_modified = max(updates.values()).replace(microsecond=0)
+    return etag, last_modified
+
+
+def is_not_modified(etag, last_modified):
+    """:returns: whether the client's copy of the response is current"""
+
+    if etag is None:
+        return False
+    # If-None-Match wins when both are sent, see RFC 7232 section 6.
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    since = request.if_modified_since
+    if since is not None:
+        return last_modified <= since.replace(tzinfo=None)
+    return False
+
+
+def not_modified(etag, last_modified):
+    """:returns: empty 304 response"""
+
+    return with_validators(make_response('', 304), etag, last_modified)
+
+
+def with_validators(resp, etag, last_modified):
+    """Add ETag and Last-Modified to a successful response.
+
+    :returns: the response"""
+
+    if etag is not None and resp.status_code in (200, 304):
+        # Weak, since the body may go out compressed or not.
+        resp.set_etag(etag, weak=True)
+        resp.last_modified = last_modified
+    return resp
@@ -0,0 +1,122 @@
+"""
+Fast JSON encoding of result rows.
+
+json.dumps(row, default=unknown_object_json_handler) works out what every
+value is, and hands every date to the handler, one row at a time. A
+RowEncoder looks at the SQLAlchemy type of each column once instead, picks
+a function turning that column's values straight into JSON text, and writes
+rows out with those. The output is the same as json.dumps gives.
+"""
+
+import json as stdlib_json
+from cStringIO import StringIO
+from json.encoder import encode_basestring_ascii
+
+from sqlalchemy import types
+
+from plenario.api.common import unknown_object_json_handler
+
+# simplejson's C speedups cover more than the standard library's, use it
+# for whatever isn't a row when it's installed.
+try:
+    import simplejson as json
+except ImportError:
+    json = stdlib_json
+
+
+def dumps(obj):
+    return json.dumps(obj, default=unknown_object_json_handler)
+
+
+def _encode_float(value):
+    value = float(value)
+    if value != value:
+        return 'NaN'
+    elif value == float('inf'):
+        return 'Infinity'
+    elif value == float('-inf'):
+        return '-Infinity'
+    return repr(value)
+
+
+def _encode_int(value):
+    return str(value)
+
+
+def _encode_bool(value):
+    return 'true' if value else 'false'
+
+
+def _encode_temporal(value):
+    return '"' + value.isoformat() + '"'
+
+
+def _encode_any(value):
+    return stdlib_json.dumps(value, default=unknown_object_json_handler)
+
+
+def _nullable(encode):
+    def encoder(value):
+        return 'null' if value is None else encode(value)
+    return encoder
+
+
+def encoder_for(type_):
+    """:param type_: SQLAlchemy type of a column
+    :returns: function turning a value of that column into JSON text"""
+
+    # Float is a kind of Numeric, and Boolean and Integer share nothing,
+    # so check the narrower types first.
+    if isinstance(type_, types.Boolean):
+        encode = _encode_bool
+    elif isinstance(type_, types.Integer):
+        encode = _encode_int
+    elif isinstance(type_, types.Numeric):
+        encode = _encode_float
+    elif isinstance(type_, (types.DateTime, types.Date, types.Time)):
+        encode = _encode_temporal
+    elif isinstance(type_, types.String):
+        encode = encode_basestring_ascii
+    else:
+        encode = _encode_any
+    return _nullable(encode)
+
+
+class RowEncoder(object):
+    """Encodes row tuples as JSON objects keyed by column name, or as arrays
+    of values in the order of names."""
+
+    def __init__(self, columns, exclude=()):
+        """:param columns: SQLAlchemy columns, in the order rows have them
+        :param exclude: names of columns to leave out"""
+
+        kept = [(i, c) for i, c in enumerate(columns) if c.name not in exclude]
+        self.names = [c.name for _, c in kept]
+        self.fields = [(i, encode_basestring_ascii(c.name) + ': ', encoder_for(c.type))
+                       for i, c in kept]
+
+    def encode(self, row):
+        return '{' + ', '.join(key + encode(row[i]) for i, key, encode in self.fields) + '}'
+
+    def encode_values(self, row):
+        return '[' + ', '.join(encode(row[i]) for i, _, encode in self.fields) + ']'
+
+    def write(self, rows, out, as_arrays=False):
+        """Write rows to a file-like object, separated by commas.
+
+        :param as_arrays: write arrays of values instead of objects
+        :returns: number of rows written"""
+
+        count = 0
+        encode = self.encode_values if as_arrays else self.encode
+        for row in rows:
+            if count:
+                out.write(', ')
+            out.write(encode(row))
+            count += 1
+        return count
+
+    def encode_many(self, rows, as_arrays=False):
+        out = StringIO()
+        self.write(rows, out, as_arrays)
+        return out.getvalue()
@@ -1,7 +1,5 @@
 import json
 import re
-import shapely.geometry
-import shapely.wkb
 import sqlalchemy
 
 from collections import OrderedDict
@@ -11,23 +9,34 @@ from flask import request, make_response
 from itertools import groupby
 from operator import itemgetter
 
-from plenario.api.common import cache, crossdomain, CACHE_TIMEOUT
-from plenario.api.common import make_cache_key, date_json_handler, unknown_object_json_handler
+from plenario.api.common import cached_response, crossdomain, STREAM_BATCH_SIZE
+from plenario.api.common import date_json_handler, unknown_object_json_handler
+from plenario.api.common import encode_page_token
 from plenario.api.condition_builder import parse_tree
 from plenario.api.response import internal_error, bad_request, json_response_base, make_csv
 from plenario.api.response import geojson_response_base, form_csv_detail_response, form_json_detail_response
 from plenario.api.response import form_geojson_detail_response, add_geojson_feature
+from plenario.api.response import form_columnar_detail_response
+from plenario.api.response import stream_json_detail_response, stream_csv_detail_response
+from plenario.api.response import stream_geojson_detail_response
+from plenario.api.response import form_grid_geojson_response, form_mvt_response
+from plenario.api.compression import decompressed
+from plenario.api.timing import timed
 from plenario.api.validator import DatasetRequiredValidator, NoGeoJSONDatasetRequiredValidator
 from plenario.api.validator import NoDefaultDatesValidator, validate, NoGeoJSONValidator, has_tree_filters
+from plenario.api.validator import GridValidator, DetailValidator
+from plenario.catalog import catalog
 from plenario.database import session
 from plenario.models import MetaTable
+from plenario.settings import CACHE_STALE_TIMEOUT
 
+# Half the width of the Web Mercator (EPSG:3857) world, in meters.
+WEB_MERCATOR_EXTENT = 20037508.342789244
 
 # ======
 # routes
 # ======
 
-@cache.cached(timeout=CACHE_TIMEOUT, key_prefix=make_cache_key)
 @crossdomain(origin="*")
 def timeseries():
     fields = ('location_geom__within', 'dataset_name', 'dataset_name__in',
@@ -40,7 +49,6 @@ def timeseries():
     return _timeseries(validated_args)
 
 
-@cache.cached(timeout=CACHE_TIMEOUT, key_prefix=make_cache_key)
 @crossdomain(origin="*")
 def detail_aggregate():
     fields = ('location_geom__within', 'dataset_name', 'agg', 'obs_date__ge',
@@ -52,13 +60,12 @@ def detail_aggregate():
     return _detail_aggregate(validated_args)
 
 
-@cache.cached(timeout=CACHE_TIMEOUT, key_prefix=make_cache_key)
 @crossdomain(origin="*")
 def detail():
     fields = ('location_geom__within', 'dataset_name', 'shape', 'obs_date__ge',
               'obs_date__le', 'data_type', 'offset', 'date__time_of_day_ge',
-              'date__time_of_day_le', 'limit')
-    validator = DatasetRequiredValidator(only=fields)
+              'date__time_of_day_le', 'limit', 'stream', 'page_token')
+    validator = DetailValidator(only=fields)
     validated_args = validate(validator, request.args.to_dict())
     if validated_args.errors:
         return bad_request(validated_args.errors)
@@ -66,19 +73,23 @@ def detail():
     return _detail(validated_args)
 
 
-@cache.cached(timeout=CACHE_TIMEOUT, key_prefix=make_cache_key)
 @crossdomain(origin="*")
 def grid():
     fields = ('dataset_name', 'resolution', 'buffer', 'obs_date__le', 'obs_date__ge',
-              'location_geom__within')
-    validated_args = validate(DatasetRequiredValidator(only=fields), request.args.to_dict())
+              'location_geom__within', 'data_type', 'tile')
+    validated_args = validate(GridValidator(only=fields), request.args.to_dict())
     if validated_args.errors:
         return bad_request(validated_args.errors)
+    if validated_args.data['data_type'] == 'mvt':
+        if not validated_args.data.get('tile'):
+            return bad_request("data_type=mvt requires a tile, given as tile=z/x/y.")
+    else:
+        # They all come back as GeoJSON, so let them share a cache entry.
+        validated_args.data['data_type'] = 'geojson'
 
     return _grid(validated_args)
 
 
-@cache.cached(timeout=CACHE_TIMEOUT, key_prefix=make_cache_key)
 @crossdomain(origin="*")
 def dataset_fields(dataset_name):
     request_args = request.args.to_dict()
@@ -89,7 +100,10 @@ def dataset_fields(dataset_name):
     if validated_args.errors:
         return bad_request(validated_args.errors)
 
-    response = _meta(validated_args)
+    # It may come out of the cache gzipped.
+    response = decompressed(_meta(validated_args))
+    if response.status_code == 304:
+        return response
 
     # API defines column values to be in the 'objects' list.
     resp_dict = json.loads(response.data)
@@ -98,7 +112,6 @@ def dataset_fields(dataset_name):
     return response
 
 
-@cache.cached(timeout=CACHE_TIMEOUT, key_prefix=make_cache_key)
 @crossdomain(origin="*")
 def meta():
     fields = ('obs_date__le', 'obs_date__ge', 'dataset_name', 'location_geom__within')
@@ -113,6 +126,7 @@ def meta():
 # _route logic
 # ============
 
+@cached_response(stale_timeout=CACHE_STALE_TIMEOUT)
 def _timeseries(args):
 
     meta_params = ['geom', 'dataset', 'dataset_name__in', 'obs_date__ge', 'obs_date__le', 'agg']
@@ -130,7 +144,7 @@ def _timeseries(args):
                 # Prevents an error that is caused by dataset names with trailing
                 # underscores.
                 tablename = re.split(r'__(?!_)', field)[0]
-                metarecord = MetaTable.get_by_dataset_name(tablename)
+                metarecord = catalog.point(tablename)
                 pt = metarecord.point_table
                 ctrees[pt.name] = parse_tree(pt, value)
         # Just cleanliness, since we don't use this argument. Doesn't have
@@ -166,7 +180,7 @@ def _timeseries(args):
 
     try:
         panel = MetaTable.timeseries_all(
-            table_names, agg, start_date, end_date, geom, ctrees
+            table_names, agg, start_date, end_date, geom, ctrees, args.warnings
         )
     except Exception as e:
         msg = 'Failed to construct timeseries.'
@@ -177,7 +191,8 @@ def _timeseries(args):
 
     datatype = args.data['data_type']
     if datatype == 'json':
-        resp = make_response(json.dumps(resp, default=unknown_object_json_handler), 200)
+        with timed('serialize'):
+            resp = make_response(json.dumps(resp, default=unknown_object_json_handler), 200)
         resp.headers['Content-Type'] = 'application/json'
     elif datatype == 'csv':
 
@@ -214,6 +229,7 @@ def _timeseries(args):
     return resp
 
 
+@cached_response()
 def _detail_aggregate(args):
     """Returns a record for every row in the specified dataset with brief
     temporal and spatial information about the row. This can give a user of the
@@ -242,14 +258,14 @@ def _detail_aggregate(args):
         # Prevents an error that is caused by dataset names with trailing
         # underscores.
         tablename = re.split(r'__(?!_)', tablename)[0]
-        table = MetaTable.get_by_dataset_name(tablename).point_table
+        table = catalog.point(tablename).point_table
         try:
             conditions = parse_tree(table, condition_tree)
         except ValueError:  # Catches empty condition tree.
             conditions = None
 
         try:
-            ts = MetaTable.get_by_dataset_name(table.name).timeseries_one(
+            ts = catalog.point(table.name).timeseries_one(
                 agg, start_date, end_date, geom, conditions
             )
         except Exception as e:
@@ -261,9 +277,10 @@ def _detail_aggregate(args):
 
     datatype = args.data['data_type']
     if datatype == 'json':
-        resp = json_response_base(args, time_counts, request.args)
+        resp = json_response_base(args, time_counts, args.data)
         resp['count'] = sum([c['count'] for c in time_counts])
-        resp = make_response(json.dumps(resp, default=unknown_object_json_handler), 200)
+        with timed('serialize'):
+            resp = make_response(json.dumps(resp, default=unknown_object_json_handler), 200)
         resp.headers['Content-Type'] = 'application/json'
 
     elif datatype == 'csv':
@@ -275,37 +292,125 @@ def _detail_aggregate(args):
     return resp
 
 
+@cached_response(unless=lambda args: args.data.get('stream'))
 def _detail(args):
 
-    meta_params = ('dataset', 'shape', 'data_type', 'limit', 'offset')
+    meta_params = ('dataset', 'shape', 'data_type', 'limit', 'offset', 'stream',
+                   'page_token')
     meta_vals = (args.data.get(k) for k in meta_params)
-    dataset, shapeset, data_type, limit, offset = meta_vals
+    dataset, shapeset, data_type, limit, offset, stream, page_token = meta_vals
 
     q = detail_query(args)
 
-    # Apply limit and offset.
+    # Both kinds of paging need a stable order. (point_date, hash) is unique,
+    # and new point tables carry an index on it.
+    q = q.order_by(dataset.c.point_date, dataset.c.hash)
+
+    # Prefer the continuation token, it costs the same no matter how deep
+    # the page is. Fall back to OFFSET otherwise.
+    if page_token:
+        try:
+            q = q.filter(keyset_condition(dataset, page_token))
+        except (ValueError, TypeError) as e:
+            return bad_request("Invalid page_token: {}".format(e))
+    elif offset:
+        q = q.offset(offset)
+
     q = q.limit(limit)
-    q = q.offset(offset) if offset else q
+
+    table_columns = list(dataset.columns)
+    if shapeset:
+        table_columns += list(shapeset.columns)
+    columns = [c.name for c in table_columns]
+
+    to_remove = ['point_date', 'hash']
+
+    # Shape columns come after the point columns, so these always point at
+    # the point dataset's sort key.
+    key_idx = (columns.index('point_date'), columns.index('hash'))
+
+    def next_page_token(last_row, count):
+        if count < limit:
+            return None
+        return encode_page_token(*[last_row[i] for i in key_idx])
+
+    if stream:
+        return _stream_detail(q, table_columns, to_remove, args, next_page_token)
 
     try:
-        columns = [c.name for c in dataset.columns]
-        if shapeset:
-            columns += [c.name for c in shapeset.columns]
-        result_rows = [OrderedDict(zip(columns, row)) for row in q.all()]
+        rows = q.all()
     except Exception as ex:
         session.rollback()
         return internal_error("Failed to fetch records.", ex)
 
-    to_remove = ['point_date', 'hash']
+    token = next_page_token(rows[-1], len(rows)) if rows else None
 
     if data_type == 'json':
-        return form_json_detail_response(to_remove, args, result_rows)
+        # Encoded straight from the row tuples.
+        return form_json_detail_response(to_remove, args, table_columns, rows, token)
+
+    elif data_type == 'json_columnar':
+        return form_columnar_detail_response(to_remove, args, table_columns, rows, token)
+
+    result_rows = [OrderedDict(zip(columns, row)) for row in rows]
+
+    if data_type == 'csv':
+        return form_csv_detail_response(to_remove, result_rows, token)
+
+    elif data_type == 'geojson':
+        return form_geojson_detail_response(to_remove, args, result_rows, token)
+
+
+def _stream_detail(q, table_columns, to_remove, args, next_page_token):
+    """Serve /detail rows as they come off of a server-side (named) cursor
+    instead of materializing the whole result first.
+
+    :param q: detail query with limit and offset already applied
+    :param table_columns: SQLAlchemy columns selected by the query
+    :param to_remove: names of columns to leave out of the response
+    :param args: ValidatorResult of user provided arguments
+    :param next_page_token: callable building a continuation token from the
+                            last row and the number of rows sent
+
+    :returns: streamed response object"""
+
+    rows = q.yield_per(STREAM_BATCH_SIZE)
+    columns = [c.name for c in table_columns]
+
+    data_type = args.data['data_type']
+    if data_type == 'json':
+        return stream_json_detail_response(to_remove, args, table_columns, rows, next_page_token)
+
+    elif data_type == 'json_columnar':
+        return stream_json_detail_response(to_remove, args, table_columns, rows, next_page_token,
+                                           columnar=True)
 
     elif data_type == 'csv':
-        return form_csv_detail_response(to_remove, result_rows)
+        return stream_csv_detail_response(to_remove, columns, rows)
 
     elif data_type == 'geojson':
-        return form_geojson_detail_response(to_remove, args, result_rows)
+        return stream_geojson_detail_response(to_remove, columns, rows)
+
+
+def keyset_condition(dataset, page_token):
+    """Condition selecting the rows that sort after the row a continuation
+    token was made from.
+
+    :param dataset: point table being paged through
+    :param page_token: decoded token, [point_date, hash]
+
+    :returns: SQLAlchemy condition"""
+
+    point_date, hash_ = page_token
+    point_date = parser.parse(point_date)
+
+    # The plain range on point_date lets the planner use the point_date index
+    # on tables which predate the (point_date, hash) index.
+    return sqlalchemy.and_(
+        dataset.c.point_date >= point_date,
+        sqlalchemy.tuple_(dataset.c.point_date, dataset.c.hash) >
+        sqlalchemy.tuple_(point_date, hash_)
+    )
 
 
 def detail_query(args, aggregate=False):
@@ -372,21 +477,32 @@ def detail_query(args, aggregate=False):
     return q
 
 
+@cached_response()
 def _grid(args):
 
     meta_params = ('dataset', 'geom', 'resolution', 'buffer', 'obs_date__ge',
-                   'obs_date__le')
+                   'obs_date__le', 'data_type', 'tile')
     meta_vals = (args.data.get(k) for k in meta_params)
-    point_table, geom, resolution, buffer_, obs_date__ge, obs_date__le = meta_vals
+    point_table, geom, resolution, buffer_, obs_date__ge, obs_date__le, data_type, tile = meta_vals
+
+    grids = []
 
-    result_rows = []
+    # A vector tile only needs the points that can end up on it.
+    tile_bounds = tile_envelope(*tile) if tile else None
+    extent = sqlalchemy.func.ST_Transform(tile_bounds, 4326) if tile else None
 
+    only_dates = False
     if not has_tree_filters(args.data):
         tname = point_table.name
-        args.data[tname + '__filter'] = request_args_to_condition_tree(
+        ctree = request_args_to_condition_tree(
             request_args=args.data,
             ignore=['buffer', 'resolution']
         )
+        args.data[tname + '__filter'] = ctree
+        # make_grid applies the date range by itself, and without any other
+        # conditions it can answer from the precomputed pyramid.
+        only_dates = all(isinstance(c['col'], basestring) and c['col'] == 'point_date'
+                         for c in ctree['val'])
 
     # We only build conditions from values with a key containing 'filter'.
     # Therefore we only build dataset conditions from condition trees.
@@ -395,40 +511,75 @@ def _grid(args):
 
         tablename = tablename.split('__')[0]
 
-        metatable = MetaTable.get_by_dataset_name(tablename)
+        metatable = catalog.point(tablename)
         table = metatable.point_table
-        conditions = parse_tree(table, condition_tree)
+        conditions = [] if only_dates else [parse_tree(table, condition_tree)]
 
         try:
-            registry_row = MetaTable.get_by_dataset_name(table.name)
             # make_grid expects conditions to be iterable.
-            grid_rows, size_x, size_y = registry_row.make_grid(
+            grid, size_x, size_y = metatable.make_grid(
                 resolution,
                 geom,
-                [conditions],
-                {'upper': obs_date__le, 'lower': obs_date__ge}
+                conditions,
+                {'upper': obs_date__le, 'lower': obs_date__ge},
+                extent
             )
-            result_rows += grid_rows
+            grids.append(grid)
         except Exception as e:
             return internal_error('Could not make grid aggregation.', e)
 
-    resp = geojson_response_base()
-    for value in result_rows:
-        if value[1]:
-            pt = shapely.wkb.loads(value[1].decode('hex'))
-            south, west = (pt.x - (size_x / 2)), (pt.y - (size_y / 2))
-            north, east = (pt.x + (size_x / 2)), (pt.y + (size_y / 2))
-            new_geom = shapely.geometry.box(south, west, north, east).__geo_interface__
-        else:
-            new_geom = None
-        new_property = {'count': value[0], }
-        add_geojson_feature(resp, new_geom, new_property)
+    try:
+        if data_type == 'mvt':
+            return form_mvt_response(grid_tile(grids, tile_bounds))
 
-    resp = make_response(json.dumps(resp, default=date_json_handler), 200)
-    resp.headers['Content-Type'] = 'application/json'
-    return resp
+        result_rows = []
+        for grid in grids:
+            q = sqlalchemy.select([grid.c.count, sqlalchemy.func.ST_AsGeoJSON(grid.c.cell)])
+            result_rows += session.execute(q).fetchall()
+    except Exception as e:
+        session.rollback()
+        return internal_error('Could not make grid aggregation.', e)
+
+    return form_grid_geojson_response(result_rows)
+
+
+def tile_envelope(z, x, y):
+    """Web Mercator bounds of a z/x/y map tile.
+
+    :returns: SQLAlchemy geometry expression (SRID 3857)"""
+
+    tile_size = 2 * WEB_MERCATOR_EXTENT / 2 ** z
+    west = -WEB_MERCATOR_EXTENT + x * tile_size
+    north = WEB_MERCATOR_EXTENT - y * tile_size
+    return sqlalchemy.func.ST_MakeEnvelope(west, north - tile_size, west + tile_size, north, 3857)
+
+
+def grid_tile(grids, tile_bounds):
+    """Encode grid cells as a single Mapbox Vector Tile.
+
+    :param grids: subqueries of (count, cell) from MetaTable.make_grid
+    :param tile_bounds: envelope of the tile, from tile_envelope
+
+    :returns: the tile, as bytes"""
+
+    cells = sqlalchemy.union_all(*[
+        sqlalchemy.select([grid.c.count, sqlalchemy.func.ST_Transform(grid.c.cell, 3857).label('cell')])
+        .where(grid.c.cell != None)
+        for grid in grids
+    ]).alias('cells')
+
+    features = sqlalchemy.select([
+        cells.c.count,
+        sqlalchemy.func.ST_AsMVTGeom(cells.c.cell, tile_bounds).label('geom')
+    ]).where(sqlalchemy.func.ST_Intersects(cells.c.cell, tile_bounds)).alias('features')
+
+    q = sqlalchemy.select([sqlalchemy.func.ST_AsMVT(sqlalchemy.literal_column('features'), 'grid')])\
+        .select_from(features)
+    tile = session.execute(q).scalar()
+    return bytes(tile) if tile is not None else b''
 
 
+@cached_response(stale_timeout=CACHE_STALE_TIMEOUT)
 def _meta(args):
     """Generate meta information about table(s) with records from MetaTable.
 
@@ -492,10 +643,11 @@ def _meta(args):
         # clear column_names off the json, users don't need to see it
         del record['column_names']
 
-    resp = json_response_base(args, metadata_records, request.args)
+    resp = json_response_base(args, metadata_records, args.data)
     resp['meta']['total'] = len(resp['objects'])
     status_code = 200
-    resp = make_response(json.dumps(resp, default=unknown_object_json_handler), status_code)
+    with timed('serialize'):
+        resp = make_response(json.dumps(resp, default=unknown_object_json_handler), status_code)
     resp.headers['Content-Type'] = 'application/json'
     return resp
 
@@ -513,7 +665,8 @@ def request_args_to_condition_tree(request_args, ignore=list()):
 
     :returns: condition tree"""
 
-    ignored = {'agg', 'data_type', 'dataset', 'geom', 'limit', 'offset', 'shape', 'shapeset'}
+    ignored = {'agg', 'data_type', 'dataset', 'geom', 'limit', 'offset', 'shape',
+               'shapeset', 'stream', 'page_token', 'tile'}
     for val in ignore:
         ignored.add(val)
 
@@ -1,8 +1,12 @@
 import json
 import shapely.wkb
+from collections import OrderedDict
 from datetime import datetime
-from flask import make_response, request
-from plenario.api.common import make_csv, unknown_object_json_handler
+from flask import make_response, request, Response, stream_with_context
+from itertools import islice
+from plenario.api.common import make_csv, unknown_object_json_handler, STREAM_BATCH_SIZE
+from plenario.api.encoder import RowEncoder, dumps
+from plenario.api.timing import timed
 
 
 def make_error(msg, status_code):
@@ -37,6 +41,11 @@ def remove_columns_from_dict(rows, col_names):
 
 
 def json_response_base(validator, objects, query=''):
+    """
+    :param query: echoed back as meta.query. Responses which get cached echo
+                  the validated arguments rather than request.args, since
+                  every request with the same canonical key shares them.
+    """
     meta = {
         'status': 'ok',
         'message': '',
@@ -69,21 +78,78 @@ def add_geojson_feature(geojson_response, feature_geom, feature_properties):
     geojson_response['features'].append(new_feature)
 
 
-def form_json_detail_response(to_remove, validator, rows):
-    to_remove.append('geom')
-    remove_columns_from_dict(rows, to_remove)
-    resp = json_response_base(validator, rows)
-    resp['meta']['total'] = len(resp['objects'])
-    resp['meta']['query'] = request.args
-    resp = make_response(
-        json.dumps(resp, default=unknown_object_json_handler),
-        200
+@timed('serialize')
+def form_grid_geojson_response(rows):
+    """
+    :param rows: (count, geometry) pairs, where geometry is GeoJSON text
+                 already rendered by ST_AsGeoJSON
+    """
+    # The geometries are spliced in as they are, there's no sense in parsing
+    # them only to dump them again.
+    features = ', '.join(
+        '{"type": "Feature", "geometry": %s, "properties": {"count": %d}}'
+        % (geometry or 'null', count)
+        for count, geometry in rows
     )
+    body = '{"type": "FeatureCollection", "features": [%s]}' % features
+    resp = make_response(body, 200)
     resp.headers['Content-Type'] = 'application/json'
     return resp
 
 
-def form_csv_detail_response(to_remove, rows):
+def form_mvt_response(tile):
+    resp = make_response(tile, 200)
+    resp.headers['Content-Type'] = 'application/vnd.mapbox-vector-tile'
+    return resp
+
+
+def add_page_token_header(resp, next_page_token):
+    # Formats without a meta block carry the continuation token in a header.
+    if next_page_token:
+        resp.headers['X-Next-Page-Token'] = next_page_token
+
+
+@timed('serialize')
+def form_json_detail_response(to_remove, validator, columns, rows, next_page_token=None):
+    """
+    :param columns: SQLAlchemy columns of the rows
+    :param rows: row tuples
+    """
+    meta = json_response_base(validator, [])['meta']
+    meta['total'] = len(rows)
+    meta['query'] = validator.data
+    if next_page_token:
+        meta['next_page_token'] = next_page_token
+
+    encoder = RowEncoder(columns, exclude=to_remove + ['geom'])
+    body = '{"meta": ' + dumps(meta) + ', "objects": [' + encoder.encode_many(rows) + ']}'
+    resp = make_response(body, 200)
+    resp.headers['Content-Type'] = 'application/json'
+    return resp
+
+
+@timed('serialize')
+def form_columnar_detail_response(to_remove, validator, columns, rows, next_page_token=None):
+    """Like form_json_detail_response, but names the columns once and sends
+    every row as an array of values in that order, so wide datasets don't
+    repeat their column names on every row."""
+
+    meta = json_response_base(validator, [])['meta']
+    meta['total'] = len(rows)
+    meta['query'] = validator.data
+    if next_page_token:
+        meta['next_page_token'] = next_page_token
+
+    encoder = RowEncoder(columns, exclude=to_remove + ['geom'])
+    body = '{"meta": ' + dumps(meta) + ', "columns": ' + dumps(encoder.names) + \
+           ', "data": [' + encoder.encode_many(rows, as_arrays=True) + ']}'
+    resp = make_response(body, 200)
+    resp.headers['Content-Type'] = 'application/json'
+    return resp
+
+
+@timed('serialize')
+def form_csv_detail_response(to_remove, rows, next_page_token=None):
     to_remove.append('geom')
     remove_columns_from_dict(rows, to_remove)
 
@@ -95,10 +161,12 @@ def form_csv_detail_response(to_remove, rows):
     filedate = datetime.now().strftime('%Y-%m-%d')
     resp.headers['Content-Type'] = 'text/csv'
     resp.headers['Content-Disposition'] = 'attachment; filename=%s_%s.csv' % (dname, filedate)
+    add_page_token_header(resp, next_page_token)
     return resp
 
 
-def form_geojson_detail_response(to_remove, validator, rows):
+@timed('serialize')
+def form_geojson_detail_response(to_remove, validator, rows, next_page_token=None):
     geojson_resp = geojson_response_base()
     # We want the geom this time.
     remove_columns_from_dict(rows, to_remove)
@@ -117,4 +185,114 @@ def form_geojson_detail_response(to_remove, validator, rows):
 
     resp = make_response(json.dumps(geojson_resp, default=unknown_object_json_handler), 200)
     resp.headers['Content-Type'] = 'application/json'
+    add_page_token_header(resp, next_page_token)
+    return resp
+
+
+# =================
+# Streamed variants
+# =================
+# These take the column names and an iterable of row tuples (usually a query
+# running on a server-side cursor) instead of a list of OrderedDicts. Rows are
+# serialized a batch at a time, so memory use doesn't grow with the limit.
+
+def iter_batches(rows, size=STREAM_BATCH_SIZE):
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+def kept_columns(columns, to_remove):
+    """Pair the index of each column we want to send back with its name."""
+
+    return [(i, name) for i, name in enumerate(columns) if name not in to_remove]
+
+
+def make_stream_response(chunks, content_type):
+    resp = Response(stream_with_context(chunks), 200)
+    resp.headers['Content-Type'] = content_type
     return resp
+
+
+def stream_json_detail_response(to_remove, validator, columns, rows, next_page_token=None,
+                                columnar=False):
+    """
+    :param columns: SQLAlchemy columns of the rows, unlike the other
+                    streamed variants which take their names
+    :param columnar: send the json_columnar layout, see
+                     form_columnar_detail_response
+    """
+    encoder = RowEncoder(columns, exclude=to_remove + ['geom'])
+
+    def generate():
+        # The total isn't known until the last row has been written, so the
+        # meta block goes after the objects.
+        if columnar:
+            yield '{"columns": ' + dumps(encoder.names) + ', "data": ['
+        else:
+            yield '{"objects": ['
+        total = 0
+        last_row = None
+        for batch in iter_batches(rows):
+            last_row = batch[-1]
+            yield (', ' if total else '') + encoder.encode_many(batch, as_arrays=columnar)
+            total += len(batch)
+
+        meta = json_response_base(validator, [])['meta']
+        meta['total'] = total
+        meta['query'] = validator.data
+        if next_page_token and last_row is not None:
+            token = next_page_token(last_row, total)
+            if token:
+                meta['next_page_token'] = token
+        yield '], "meta": ' + dumps(meta) + '}'
+
+    return make_stream_response(generate(), 'application/json')
+
+
+def stream_csv_detail_response(to_remove, columns, rows):
+    keep = kept_columns(columns, to_remove + ['geom'])
+
+    def generate():
+        yield make_csv([[name for _, name in keep]])
+        for batch in iter_batches(rows):
+            yield make_csv([[row[i] for i, _ in keep] for row in batch])
+
+    resp = make_stream_response(generate(), 'text/csv')
+    dname = request.args.get('dataset_name')
+    filedate = datetime.now().strftime('%Y-%m-%d')
+    resp.headers['Content-Disposition'] = 'attachment; filename=%s_%s.csv' % (dname, filedate)
+    return resp
+
+
+def stream_geojson_detail_response(to_remove, columns, rows):
+    # We want the geom this time, but as the feature geometry.
+    keep = kept_columns(columns, to_remove + ['geom'])
+    geom_idx = columns.index('geom')
+
+    def generate():
+        yield '{"type": "FeatureCollection", "features": ['
+        first = True
+        for batch in iter_batches(rows):
+            features = []
+            for row in batch:
+                try:
+                    geom = shapely.wkb.loads(row[geom_idx].desc, hex=True).__geo_interface__
+                except AttributeError:
+                    # Same as the buffered version, skip rows without a
+                    # usable geom value.
+                    continue
+                features.append(json.dumps({
+                    'type': 'Feature',
+                    'geometry': geom,
+                    'properties': OrderedDict((name, row[i]) for i, name in keep)
+                }, default=unknown_object_json_handler))
+            if features:
+                yield ('' if first else ', ') + ', '.join(features)
+                first = False
+        yield ']}'
+
+    return make_stream_response(generate(), 'application/json')
@@ -1,8 +1,12 @@
 from plenario.api.common import cache, CACHE_TIMEOUT, make_cache_key, crossdomain, date_json_handler, RESPONSE_LIMIT
+from plenario.api.common import encode_page_token, decode_page_token
+from plenario.api.encoder import RowEncoder, dumps
 from plenario.utils.helpers import get_size_in_degrees
-from plenario.database import session, app_engine as engine, Base
+from plenario.utils.model_helpers import reflect_table
+from plenario.database import session
 from flask import request, make_response
-from sqlalchemy import Table, func
+from sqlalchemy import func, tuple_
+from dateutil import parser
 import json
 import shapely.wkb, shapely.geometry
 
@@ -13,8 +17,7 @@ def weather_stations():
     raw_query_params = request.args.copy()
     #print "weather_stations(): raw_query_params=", raw_query_params
 
-    stations_table = Table('weather_stations', Base.metadata,
-        autoload=True, autoload_with=engine, extend_existing=True)
+    stations_table = reflect_table('weather_stations')
     valid_query, query_clauses, resp, status_code = make_query(stations_table,raw_query_params)
     if valid_query:
         resp['meta']['status'] = 'ok'
@@ -39,10 +42,8 @@ def weather_stations():
 def weather(table):
     raw_query_params = request.args.copy()
 
-    weather_table = Table('dat_weather_observations_%s' % table, Base.metadata,
-        autoload=True, autoload_with=engine, extend_existing=True)
-    stations_table = Table('weather_stations', Base.metadata,
-        autoload=True, autoload_with=engine, extend_existing=True)
+    weather_table = reflect_table('dat_weather_observations_%s' % table)
+    stations_table = reflect_table('weather_stations')
     valid_query, query_clauses, resp, status_code = make_query(weather_table,raw_query_params)
     if valid_query:
         resp['meta']['status'] = 'ok'
@@ -53,16 +54,34 @@ def weather(table):
             base_query = base_query.filter(clause)
 
         try:
-            base_query = base_query.order_by(getattr(weather_table.c, 'date').desc())
+            time_col = getattr(weather_table.c, 'date')
         except AttributeError:
-            base_query = base_query.order_by(getattr(weather_table.c, 'datetime').desc())
-        base_query = base_query.limit(RESPONSE_LIMIT) # returning the top 1000 records
-        if raw_query_params.get('offset'):
+            time_col = getattr(weather_table.c, 'datetime')
+        # id breaks ties between observations taken at the same time,
+        # so that a page_token picks up exactly where the last page ended.
+        base_query = base_query.order_by(time_col.desc(), weather_table.c.id.desc())
+        if raw_query_params.get('page_token'):
+            try:
+                last_time, last_id = decode_page_token(raw_query_params['page_token'])
+                last_time = parser.parse(last_time)
+            except (ValueError, TypeError):
+                resp['meta']['message'] = 'Invalid page_token'
+                resp['meta']['query'] = raw_query_params
+                resp = make_response(json.dumps(resp, default=date_json_handler), 400)
+                resp.headers['Content-Type'] = 'application/json'
+                return resp
+            base_query = base_query.filter(time_col <= last_time)
+            base_query = base_query.filter(tuple_(time_col, weather_table.c.id) < tuple_(last_time, last_id))
+        elif raw_query_params.get('offset'):
             offset = raw_query_params['offset']
             base_query = base_query.offset(int(offset))
+        base_query = base_query.limit(RESPONSE_LIMIT) # returning the top 1000 records
         values = [r for r in base_query.all()]
         weather_fields = weather_table.columns.keys()
         station_fields = stations_table.columns.keys()
+        if raw_query_params.get('data_type') == 'json_columnar':
+            return _weather_columnar(resp, values, weather_table, station_fields,
+                                     time_col, raw_query_params)
         weather_data = {}
         station_data = {}
         for value in values:
@@ -82,11 +101,45 @@ def weather(table):
             }
             resp['objects'].append(d)
         resp['meta']['total'] = sum([len(r['observations']) for r in resp['objects']])
+        if len(values) == RESPONSE_LIMIT:
+            last = values[-1]
+            resp['meta']['next_page_token'] = encode_page_token(getattr(last, time_col.name), last.id)
     resp['meta']['query'] = raw_query_params
     resp = make_response(json.dumps(resp, default=date_json_handler), status_code)
     resp.headers['Content-Type'] = 'application/json'
     return resp
 
+
+def _weather_columnar(resp, values, weather_table, station_fields, time_col, raw_query_params):
+    """data_type=json_columnar: observations as arrays of values under one
+    list of column names, and each station's info once, by wban_code.
+
+    :param values: (observation columns..., station columns...) rows"""
+
+    stations = {}
+    for value in values:
+        if value.wban_code not in stations:
+            sd = {f: getattr(value, f) for f in station_fields}
+            loc = str(value.location)
+            sd['location'] = shapely.wkb.loads(loc.decode('hex')).__geo_interface__
+            stations[value.wban_code] = sd
+
+    meta = resp['meta']
+    meta['total'] = len(values)
+    if len(values) == RESPONSE_LIMIT:
+        last = values[-1]
+        meta['next_page_token'] = encode_page_token(getattr(last, time_col.name), last.id)
+    meta['query'] = raw_query_params
+
+    # Observation columns come first, so the encoder can index rows with them.
+    encoder = RowEncoder(weather_table.columns)
+    body = '{"meta": ' + dumps(meta) + ', "columns": ' + dumps(encoder.names) + \
+           ', "data": [' + encoder.encode_many(values, as_arrays=True) + \
+           '], "stations": ' + dumps(stations) + '}'
+    resp = make_response(body, 200)
+    resp.headers['Content-Type'] = 'application/json'
+    return resp
+
 '''
 make_query is a holdover from the old API implementation that used Master Table
 '''
@@ -115,6 +168,10 @@ def make_query(table, raw_query_params):
         args_keys.remove('order_by')
     if 'weather' in args_keys:
         args_keys.remove('weather')
+    if 'page_token' in args_keys:
+        args_keys.remove('page_token')
+    if 'data_type' in args_keys:
+        args_keys.remove('data_type')
     for query_param in args_keys:
         try:
             field, operator = query_param.split('__')
@@ -8,12 +8,16 @@ from sqlalchemy import func
 from sqlalchemy.exc import NoSuchTableError
 
 from plenario.api.common import crossdomain, extract_first_geometry_fragment
-from plenario.api.common import make_fragment_str
+from plenario.api.common import make_fragment_str, make_cache_key, conditional_response
+from plenario.api.conditional import validators, is_not_modified, not_modified, \
+    with_validators
 from plenario.api.condition_builder import parse_tree
 from plenario.api.point import detail_query, form_csv_detail_response
 from plenario.api.point import form_geojson_detail_response, bad_request
 from plenario.api.response import make_error
 from plenario.api.validator import validate, has_tree_filters, Validator, ExportFormatsValidator
+from plenario.catalog import catalog
+from plenario.database import EVERY_DATASET
 from plenario.models import ShapeMetadata
 from plenario.utils.ogr2ogr import OgrExport
 
@@ -49,6 +53,10 @@ def get_all_shape_datasets():
     """
     Fetches metadata for every shape dataset in meta_shape
     """
+    etag, last_modified = validators(make_cache_key(), {EVERY_DATASET})
+    if is_not_modified(etag, last_modified):
+        return not_modified(etag, last_modified)
+
     try:
         response_skeleton = {
             'meta': {
@@ -80,7 +88,7 @@ def get_all_shape_datasets():
 
     resp = make_response(json.dumps(response_skeleton), status_code)
     resp.headers['Content-Type'] = 'application/json'
-    return resp
+    return with_validators(resp, etag, last_modified)
 
 
 @crossdomain(origin="*")
@@ -113,7 +121,7 @@ def export_shape(dataset_name):
     if dataset_name not in ShapeMetadata.tablenames():
         return make_error(dataset_name + ' not found.', 404)
     try:
-        ShapeMetadata.get_by_dataset_name(dataset_name).shape_table
+        catalog.shape(dataset_name).shape_table
     except NoSuchTableError:
         return make_error(dataset_name + ' has yet to be ingested.', 404)
 
@@ -132,6 +140,7 @@ def export_shape(dataset_name):
 # Shape Route Logic
 # =================
 
+@conditional_response
 def _aggregate_point_data(args):
     meta_params = ('dataset', 'shapeset', 'data_type', 'geom', 'offset', 'limit')
     meta_vals = (args.data.get(k) for k in meta_params)
@@ -156,6 +165,7 @@ def _aggregate_point_data(args):
         return form_geojson_detail_response(['hash', 'ogc_fid'], args, rows)
 
 
+@conditional_response
 def _export_shape(args):
     """Route logic for /shapes/<shapeset>/ endpoint. Returns records for a
     single specified shape dataset.
@@ -210,7 +220,7 @@ def _export_dataset_to_response(shapeset, data_type, query=None):
         extension = _shape_format_to_file_extension(export_format)
 
         # Make the downloaded filename look nice
-        shapemeta = ShapeMetadata.get_by_dataset_name(shapeset.name)
+        shapemeta = catalog.shape(shapeset.name)
         resp.headers['Content-Type'] = _shape_format_to_content_header(export_format)
         resp.headers['Content-Disposition'] = 'attachment; filename={}.{}'.format(shapemeta.human_name, extension)
         return resp
@@ -0,0 +1,274 @@
+"""
+Where did the time of an API request go?
+
+Each request gets a RequestTiming in flask.g, and code along the way adds
+to its phases with `with timed('phase'):`. The phases are
+
+    validate   parsing and checking the arguments (includes convert)
+    convert    turning argument strings into tables, dates and geometries
+    cache      looking up and waiting on cached responses
+    sql        statements executed for the request, on its own thread or
+               on workers handed a function through carry_timing
+    query      the handler, less serialize (includes sql)
+    serialize  turning results into JSON or CSV
+    total      the whole request
+
+so phases overlap. They go out in a Server-Timing header, are added to
+meta.timing of JSON responses when asked for with debug_timing=true, and
+are logged as one JSON object per request on the plenario.timing logger.
+
+Statements which take longer than SLOW_QUERY_THRESHOLD are saved to
+perf_slow_queries (see SlowQuery) once the request is done, a sample of
+them along with their EXPLAIN (ANALYZE, BUFFERS) plan.
+"""
+
+import json
+import logging
+import random
+import sys
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import g, request, has_app_context
+from sqlalchemy import event
+
+from plenario.api.compression import decompressed
+from plenario.database import app_engine, EVERY_DATASET
+from plenario.models import SlowQuery
+from plenario.settings import TIMING_LOG, SLOW_QUERY_THRESHOLD, \
+    SLOW_QUERY_EXPLAIN_RATE, SLOW_QUERY_EXPLAIN_TIMEOUT
+
+logger = logging.getLogger('plenario.timing')
+if TIMING_LOG and not logger.handlers:
+    _handler = logging.StreamHandler(sys.stderr)
+    _handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+# Timing of the request a worker thread is doing work for, see carry_timing.
+_local = threading.local()
+
+
+class RequestTiming(object):
+
+    def __init__(self):
+        self.start = time.time()
+        self.phases = OrderedDict()
+        self.statements = 0
+        # (statement, parameters, seconds) of statements over the threshold
+        self.slow = []
+        self.cache_key = None
+        self.dataset_names = None
+        # Statements can come in from worker threads.
+        self._lock = threading.Lock()
+
+    def add(self, phase, seconds):
+        with self._lock:
+            self.phases[phase] = self.phases.get(phase, 0) + seconds
+
+    def add_statement(self, statement, parameters, seconds):
+        with self._lock:
+            self.phases['sql'] = self.phases.get('sql', 0) + seconds
+            self.statements += 1
+            if seconds * 1000 >= SLOW_QUERY_THRESHOLD:
+                self.slow.append((statement, parameters, seconds))
+
+    def milliseconds(self):
+        """:returns: OrderedDict of phase name to milliseconds, with query
+                     worked out from the handler time and total added"""
+
+        phases = self.phases.copy()
+        handler = phases.pop('handler', None)
+        if handler is not None:
+            phases['query'] = max(handler - phases.get('serialize', 0), 0)
+        phases['total'] = time.time() - self.start
+        return OrderedDict((k, round(v * 1000, 1)) for k, v in phases.items())
+
+
+def current_timing():
+    """:returns: RequestTiming of the current request, or None outside of
+                 one (ex. on worker threads)"""
+
+    timing = getattr(_local, 'timing', None)
+    if timing is not None or not has_app_context():
+        return timing
+    return getattr(g, 'timing', None)
+
+
+def carry_timing(f):
+    """Wrap a function which is about to be handed to a worker thread, so
+    that the statements it runs count towards the current request."""
+
+    timing = current_timing()
+
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        _local.timing = timing
+        try:
+            return f(*args, **kwargs)
+        finally:
+            _local.timing = None
+    return decorated
+
+
+def note_cache_key(key, datasets):
+    """Remember which cache key and datasets the current request is about,
+    for slow query records."""
+
+    timing = current_timing()
+    if timing is not None:
+        timing.cache_key = key
+        timing.dataset_names = sorted(d for d in datasets if d != EVERY_DATASET) or None
+
+
+class timed(object):
+    """Add the time spent in a block, or a function when used as a
+    decorator, to a phase of the current request."""
+
+    def __init__(self, phase):
+        self.phase = phase
+
+    def __enter__(self):
+        self.timing = current_timing()
+        self.start = time.time()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.timing is not None:
+            self.timing.add(self.phase, time.time() - self.start)
+
+    def __call__(self, f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            with timed(self.phase):
+                return f(*args, **kwargs)
+        return decorated
+
+
+def start_timing():
+    g.timing = RequestTiming()
+
+
+def finish_timing(resp):
+    """Report the timing of a request on its response."""
+
+    timing = current_timing()
+    if timing is None:
+        return resp
+    phases = timing.milliseconds()
+
+    metrics = []
+    for phase, ms in phases.items():
+        metric = '{};dur={}'.format(phase, ms)
+        if phase == 'sql':
+            metric += ';desc="{} statements"'.format(timing.statements)
+        metrics.append(metric)
+    resp.headers['Server-Timing'] = ', '.join(metrics)
+
+    if request.args.get('debug_timing') == 'true':
+        _add_meta_timing(resp, phases)
+
+    logger.info(json.dumps({
+        'endpoint': request.endpoint,
+        'path': request.path,
+        'status': resp.status_code,
+        'statements': timing.statements,
+        'timing': phases,
+    }))
+
+    if timing.slow:
+        _record_slow_queries(timing, request.endpoint)
+    return resp
+
+
+def _add_meta_timing(resp, phases):
+    if resp.is_streamed or resp.mimetype != 'application/json':
+        return
+    # Cached responses come gzipped, compress_response redoes it afterwards.
+    decompressed(resp)
+    try:
+        body = json.loads(resp.get_data(), object_pairs_hook=OrderedDict)
+    except ValueError:
+        return
+    if isinstance(body, dict) and isinstance(body.get('meta'), dict):
+        body['meta']['timing'] = phases
+        resp.set_data(json.dumps(body))
+
+
+def _record_slow_queries(timing, endpoint):
+    """Save the slow statements of a request on a thread of its own, so
+    neither the inserts nor the EXPLAINs hold up the response."""
+
+    records = []
+    for statement, parameters, seconds in timing.slow:
+        records.append({
+            'endpoint': endpoint,
+            'dataset_names': timing.dataset_names,
+            'cache_key': timing.cache_key,
+            'statement': statement,
+            'parameters': parameters,
+            'duration': round(seconds * 1000, 1),
+            'explain': random.random() < SLOW_QUERY_EXPLAIN_RATE,
+        })
+
+    thread = threading.Thread(target=_save_slow_queries, args=(records,))
+    thread.daemon = True
+    thread.start()
+
+
+def _save_slow_queries(records):
+    rows = []
+    for record in records:
+        parameters = record['parameters']
+        plan = None
+        if record.pop('explain'):
+            plan = _explain(record['statement'], parameters)
+        rows.append(dict(record, plan=plan,
+                         parameters=json.dumps(parameters, default=repr)))
+    try:
+        app_engine.execute(SlowQuery.__table__.insert(), rows)
+    except Exception:
+        logger.exception('Failed to save slow queries')
+
+
+def _explain(statement, parameters):
+    """EXPLAIN (ANALYZE, BUFFERS) a select, which runs it once more.
+
+    :returns: JSON plan, or None if it's not a select or didn't finish
+              in SLOW_QUERY_EXPLAIN_TIMEOUT"""
+
+    # ANALYZE executes the statement, so leave anything that writes alone.
+    if not statement.lstrip().upper().startswith('SELECT'):
+        return None
+
+    # A raw connection doesn't go through the cursor events below.
+    conn = app_engine.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('SET LOCAL statement_timeout = %s',
+                           (SLOW_QUERY_EXPLAIN_TIMEOUT,))
+            cursor.execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + statement,
+                           parameters)
+            return cursor.fetchone()[0]
+    except Exception:
+        logger.exception('Failed to explain slow query')
+        return None
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+@event.listens_for(app_engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._plenario_start = time.time()
+
+
+@event.listens_for(app_engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, '_plenario_start', None)
+    timing = current_timing()
+    if start is not None and timing is not None:
+        timing.add_statement(statement, parameters, time.time() - start)
@@ -2,18 +2,25 @@ import json
 import re
 
 from collections import namedtuple
-from datetime import datetime, timedelta
+from datetime import date, datetime, time, timedelta
 from dateutil import parser
 from marshmallow import fields, Schema
 from marshmallow.validate import Range, Length, OneOf, ValidationError
 from sqlalchemy.exc import DatabaseError, ProgrammingError, NoSuchTableError
 
 from plenario.api.common import extract_first_geometry_fragment, make_fragment_str
+from plenario.api.common import decode_page_token
 from plenario.api.condition_builder import field_ops
+from plenario.api.timing import timed
+from plenario.catalog import catalog
 from plenario.database import session
 from plenario.models import MetaTable, ShapeMetadata
 from plenario.utils.model_helpers import table_exists
 
+# Deepest zoom a map tile can be asked for. Web Mercator tiles get smaller
+# than a centimeter past it.
+MAX_TILE_ZOOM = 30
+
 
 def validate_dataset(dataset_name):
     if not table_exists(dataset_name):
@@ -25,6 +32,30 @@ def validate_many_datasets(list_of_datasets):
         validate_dataset(dataset)
 
 
+def validate_page_token(token):
+    try:
+        decode_page_token(token)
+    except ValueError as err:
+        raise ValidationError(err.message)
+
+
+def validate_tile(tile):
+    try:
+        z, x, y = parse_tile(tile)
+    except ValueError:
+        raise ValidationError("Invalid tile: {}, expected z/x/y.".format(tile))
+    # Check z before working out 2 ** z, which could be huge.
+    if not 0 <= z <= MAX_TILE_ZOOM:
+        raise ValidationError("Tile zoom must be between 0 and {}.".format(MAX_TILE_ZOOM))
+    if not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        raise ValidationError("Tile {} is out of range for zoom {}.".format(tile, z))
+
+
+def parse_tile(tile):
+    z, x, y = (int(n) for n in tile.strip('/').split('/'))
+    return z, x, y
+
+
 class Validator(Schema):
     """Base validator object using Marshmallow. Don't be intimidated! As scary
     as the following block of code looks it's quite simple, and saves us from
@@ -51,11 +82,15 @@ class Validator(Schema):
     date__time_of_day_le = fields.Integer(default=23, validate=Range(0, 23))
     data_type = fields.Str(default='json', validate=OneOf(valid_formats))
     location_geom__within = fields.Str(default=None, dump_to='geom')
-    obs_date__ge = fields.Date(default=datetime.now() - timedelta(days=90))
-    obs_date__le = fields.Date(default=datetime.now())
+    # Worked out per request, and a day at a time so that requests relying on
+    # them share a cache key until midnight.
+    obs_date__ge = fields.Date(default=lambda: datetime.combine(date.today() - timedelta(days=90), time()))
+    obs_date__le = fields.Date(default=lambda: datetime.combine(date.today(), time.max))
     limit = fields.Integer(default=1000)
     offset = fields.Integer(default=0, validate=Range(0))
+    page_token = fields.Str(default=None, validate=validate_page_token)
     resolution = fields.Integer(default=500, validate=Range(0))
+    stream = fields.Boolean(default=False)
 
 
 class DatasetRequiredValidator(Validator):
@@ -65,6 +100,14 @@ class DatasetRequiredValidator(Validator):
     dataset_name = fields.Str(default=None, validate=validate_dataset, dump_to='dataset', required=True)
 
 
+class DetailValidator(DatasetRequiredValidator):
+    """/detail can also send rows as arrays of values under a single list of
+    column names, which is much smaller for wide datasets."""
+
+    valid_formats = {'csv', 'geojson', 'json', 'json_columnar'}
+    data_type = fields.Str(default='json', validate=OneOf(valid_formats))
+
+
 class NoGeoJSONValidator(Validator):
     """Some endpoints, like /timeseries, should not allow GeoJSON as a valid
     response format."""
@@ -82,6 +125,16 @@ class NoGeoJSONDatasetRequiredValidator(DatasetRequiredValidator):
     data_type = fields.Str(default='json', validate=OneOf(valid_formats))
 
 
+class GridValidator(DatasetRequiredValidator):
+    """/grid can also hand back a single Mapbox Vector Tile of the grid, which
+    needs the tile to render. Any other format it used to take still gets
+    GeoJSON."""
+
+    valid_formats = {'csv', 'geojson', 'json', 'mvt'}
+    data_type = fields.Str(default='geojson', validate=OneOf(valid_formats))
+    tile = fields.Str(default=None, validate=validate_tile)
+
+
 class NoDefaultDatesValidator(Validator):
     """Some endpoints, specifically /datasets, will not return results with
     the original default dates (because the time window is so small)."""
@@ -113,10 +166,10 @@ ValidatorResult = namedtuple('ValidatorResult', 'data errors warnings')
 converters = {
     'agg': str,
     'buffer': int,
-    'dataset': lambda x: MetaTable.get_by_dataset_name(x).point_table,
-    'shapeset': lambda x: ShapeMetadata.get_by_dataset_name(x).shape_table,
+    'dataset': lambda x: catalog.point(x).point_table,
+    'shapeset': lambda x: catalog.shape(x).shape_table,
     'data_type': str,
-    'shape': lambda x: ShapeMetadata.get_by_dataset_name(x).shape_table,
+    'shape': lambda x: catalog.shape(x).shape_table,
     'dataset_name__in': lambda x: x.split(','),
     'date__time_of_day_ge': int,
     'date__time_of_day_le': int,
@@ -125,7 +178,9 @@ converters = {
     'date': lambda x: parser.parse(x).date(),
     'point_date': lambda x: parser.parse(x),
     'offset': int,
+    'page_token': lambda x: decode_page_token(x) if x else None,
     'resolution': int,
+    'tile': lambda x: parse_tile(x) if x else None,
     'geom': lambda x: make_fragment_str(extract_first_geometry_fragment(x)),
 }
 
@@ -151,6 +206,7 @@ def convert(request_args):
             session.rollback()
 
 
+@timed('validate')
 def validate(validator, request_args):
     """Validate a dictionary of arguments. Substitute all missing fields with
     defaults if not explicitly told to do otherwise.
@@ -182,7 +238,8 @@ def validate(validator, request_args):
 
     # Certain values will be dumped as strings. This conversion
     # makes them into their corresponding type. (ex. Table)
-    convert(result.data)
+    with timed('convert'):
+        convert(result.data)
 
     # Holds messages concerning unnecessary parameters. These can be either
     # junk parameters, or redundant column parameters if a tree filter was
@@ -193,7 +250,7 @@ def validate(validator, request_args):
     # arguments or validate them individually. We don't do both.
 
     # Determine unchecked parameters provided in the request.
-    unchecked = set(args.keys()) - set(validator.fields.keys())
+    unchecked = set(args.keys()) - set(validator.fields.keys()) - {'debug_timing'}
 
     # If tree filters were provided, ignore ALL unchecked parameters that are
     # not tree filters or response format information.
@@ -209,10 +266,10 @@ def validate(validator, request_args):
 
                 # Report a filter which specifies a non-existent tree.
                 try:
-                    table = MetaTable.get_by_dataset_name(t_name).point_table
+                    table = catalog.point(t_name).point_table
                 except (AttributeError, NoSuchTableError):
                     try:
-                        table = ShapeMetadata.get_by_dataset_name(t_name).shape_table
+                        table = catalog.shape(t_name).shape_table
                     except (AttributeError, NoSuchTableError):
                         result.errors[t_name] = "Table name {} could not be found.".format(t_name)
                         return result
@@ -230,7 +287,8 @@ def validate(validator, request_args):
             # These keys just have to do with the formatting of the JSON response.
             # We keep these values around even if they have no effect on a condition
             # tree.
-            elif key in {'geom', 'offset', 'limit', 'agg', 'obs_date__le', 'obs_date__ge'}:
+            elif key in {'geom', 'offset', 'limit', 'agg', 'obs_date__le', 'obs_date__ge',
+                         'stream', 'page_token', 'tile', 'debug_timing'}:
                 pass
 
             # These keys are also ones that should be passed over when searching for
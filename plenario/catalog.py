@@ -0,0 +1,120 @@
+"""catalog: A per-worker copy of the dataset registry (meta_master and
+meta_shape), so that handling an API request doesn't mean querying for the
+same metadata rows over and over.
+
+Commits that change registry rows bump a version counter in redis (see the
+session hooks at the bottom of plenario.models). The copy is reloaded when
+that counter moves, checked at most once per request, or when it gets
+older than CATALOG_MAX_AGE."""
+
+import threading
+import time
+from datetime import datetime
+
+from flask import g, has_request_context
+from redis import RedisError
+from sqlalchemy.orm import sessionmaker
+
+from plenario.database import app_engine, get_version, EVERY_DATASET
+from plenario.models import MetaTable, ShapeMetadata, CATALOG_VERSION
+from plenario.settings import CATALOG_MAX_AGE
+
+
+_unset = object()
+
+
+class Catalog(object):
+
+    def __init__(self, max_age=CATALOG_MAX_AGE):
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._points = {}
+        self._shapes = {}
+        self._version = None
+        self._loaded_at = 0
+
+        # Rows are loaded on a session of their own and handed out detached,
+        # so they can outlive the request that loaded them.
+        self._make_session = sessionmaker(bind=app_engine, expire_on_commit=False)
+
+    def point(self, dataset_name):
+        """:returns: MetaTable record of a point dataset, or None"""
+
+        if not self._refresh():
+            return MetaTable.get_by_dataset_name(dataset_name)
+        return self._points.get(dataset_name)
+
+    def shape(self, dataset_name):
+        """:returns: ShapeMetadata record of a shape dataset, or None"""
+
+        if not self._refresh():
+            return ShapeMetadata.get_by_dataset_name(dataset_name)
+        return self._shapes.get(dataset_name)
+
+    def last_updates(self, dataset_names):
+        """When the data of some datasets last changed. EVERY_DATASET stands
+        for all of them.
+
+        :param dataset_names: names of point and shape datasets
+        :returns: (dict of dataset name to datetime, registry version), or
+                  None when the in memory copy can't be trusted"""
+
+        if not self._refresh():
+            return None
+
+        points, shapes = self._points, self._shapes
+        if EVERY_DATASET in dataset_names:
+            records = points.values() + shapes.values()
+        else:
+            records = [points.get(n) or shapes.get(n) for n in dataset_names]
+
+        updates = {}
+        for record in records:
+            if record is None:
+                continue
+            updated = record.last_update or record.date_added
+            if updated is None:
+                continue
+            if not isinstance(updated, datetime):
+                # date_added of shapes is a date.
+                updated = datetime.combine(updated, datetime.min.time())
+            updates[record.dataset_name] = updated
+        return updates, self._version
+
+    def _refresh(self):
+        """Reload the registry if it's out of date.
+
+        :returns: whether the in memory copy can be used"""
+
+        if has_request_context() and getattr(g, 'catalog_version', _unset) == self._version:
+            return True
+
+        try:
+            version = get_version(CATALOG_VERSION)
+        except RedisError:
+            # Without the counter there's no telling if the copy is stale.
+            return False
+
+        with self._lock:
+            expired = time.time() - self._loaded_at > self.max_age
+            if version != self._version or expired:
+                self._load()
+                self._version = version
+            if has_request_context():
+                g.catalog_version = version
+        return True
+
+    def _load(self):
+        session = self._make_session()
+        try:
+            points = session.query(MetaTable).all()
+            shapes = session.query(ShapeMetadata).all()
+        finally:
+            session.close()
+
+        self._points = {p.dataset_name: p for p in points}
+        self._shapes = {s.dataset_name: s for s in shapes}
+        self._loaded_at = time.time()
+
+
+catalog = Catalog()
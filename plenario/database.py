@@ -1,15 +1,158 @@
+from redis import StrictRedis, WatchError
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, scoped_session
 from sqlalchemy.pool import NullPool
 from sqlalchemy.ext.declarative import declarative_base
 
-from plenario.settings import DATABASE_CONN
+from plenario.settings import DATABASE_CONN, REDIS_HOST, CACHE_CONFIG, \
+    DB_POOL_SIZE, DB_MAX_OVERFLOW
 
 
-app_engine = create_engine(DATABASE_CONN, convert_unicode=True)
+app_engine = create_engine(DATABASE_CONN, convert_unicode=True,
+                           pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW)
 
 session = scoped_session(sessionmaker(bind=app_engine,
                                       autocommit=False,
                                       autoflush=False, expire_on_commit=False))
 Base = declarative_base(bind=app_engine)
 Base.query = session.query_property()
+
+redis_client = StrictRedis(host=REDIS_HOST)
+
+
+def _version_key(name):
+    return '{}:version:{}'.format(CACHE_CONFIG['CACHE_KEY_PREFIX'], name)
+
+
+def get_version(name):
+    """Current value of a version counter shared by every web and celery
+    process. Counters start at 0."""
+    return int(redis_client.get(_version_key(name)) or 0)
+
+
+def bump_version(name):
+    return redis_client.incr(_version_key(name))
+
+
+# Cache tags
+# ==========
+# Cached API responses are tagged with the names of the datasets they were
+# built from, so an ETL run can throw away just the responses it made stale.
+# Responses which cover every dataset (like the full /datasets listing) are
+# tagged with EVERY_DATASET, and are dropped whenever any dataset changes.
+#
+# Each tag also has a generation, bumped on every invalidation. A response
+# is only stored if the generations of its tags are still the ones read
+# before it was built, so one that was being built from old data while the
+# ETL invalidated it doesn't make it into the cache afterwards.
+
+EVERY_DATASET = '*'
+
+# Members a tag set may reach before the entries which have expired since
+# are pruned from it.
+TAG_PRUNE_SIZE = 10000
+
+
+def _tag_key(tag):
+    return '{}:tag:{}'.format(CACHE_CONFIG['CACHE_KEY_PREFIX'], tag)
+
+
+def _generation_key(tag):
+    return '{}:generation:{}'.format(CACHE_CONFIG['CACHE_KEY_PREFIX'], tag)
+
+
+def cache_generations(tags):
+    """Read before building a response to be stored with store_cache_entry.
+
+    :param tags: names of the datasets it's built from
+    :returns: current generations of the tags"""
+
+    if not tags:
+        return []
+    return redis_client.mget([_generation_key(tag) for tag in sorted(tags)])
+
+
+def store_cache_entry(key, data, tags, timeout, generations):
+    """Store a response and tag it in one transaction, unless one of its
+    tags was invalidated since it was built.
+
+    :param key: key to cache the response under
+    :param data: the response, serialized the way the cache's redis
+                 backend does
+    :param tags: names of the datasets it was built from
+    :param timeout: seconds the response is cached for
+    :param generations: cache_generations(tags) from before it was built
+    :returns: whether it was stored"""
+
+    # Keys are stored the way the cache's redis backend writes them.
+    stored_key = CACHE_CONFIG['CACHE_KEY_PREFIX'] + key
+    tags = sorted(tags)
+    generation_keys = [_generation_key(tag) for tag in tags]
+    with redis_client.pipeline() as pipe:
+        try:
+            if tags:
+                pipe.watch(*generation_keys)
+                if pipe.mget(generation_keys) != generations:
+                    return False
+            pipe.multi()
+            pipe.setex(stored_key, timeout, data)
+            for tag in tags:
+                pipe.sadd(_tag_key(tag), stored_key)
+            for tag in tags:
+                pipe.scard(_tag_key(tag))
+            sizes = pipe.execute()[-len(tags):] if tags else []
+        except WatchError:
+            return False
+
+    for tag, size in zip(tags, sizes):
+        if size > TAG_PRUNE_SIZE:
+            prune_cache_tag(tag)
+    return True
+
+
+def prune_cache_tag(tag):
+    """Remove the entries which have expired from a tag set."""
+
+    tag_key = _tag_key(tag)
+    batch = []
+    for stored_key in redis_client.sscan_iter(tag_key, count=1000):
+        batch.append(stored_key)
+        if len(batch) == 1000:
+            _remove_expired(tag_key, batch)
+            batch = []
+    if batch:
+        _remove_expired(tag_key, batch)
+
+
+def _remove_expired(tag_key, stored_keys):
+    pipe = redis_client.pipeline(transaction=False)
+    for stored_key in stored_keys:
+        pipe.exists(stored_key)
+    expired = [k for k, exists in zip(stored_keys, pipe.execute()) if not exists]
+    if expired:
+        redis_client.srem(tag_key, *expired)
+
+
+def invalidate_cache_tags(tags):
+    """Drop every cached response tagged with one of tags.
+
+    :param tags: names of datasets that have changed"""
+
+    tags = set(tags) | {EVERY_DATASET}
+    # Bump the generations first, so that nothing built before now is
+    # stored once the stale entries are read below.
+    pipe = redis_client.pipeline()
+    for tag in tags:
+        pipe.incr(_generation_key(tag))
+    pipe.execute()
+
+    tag_keys = [_tag_key(tag) for tag in tags]
+    stale = list(redis_client.sunion(tag_keys))
+    # Remove only these from the tag sets, entries stored since are current.
+    for i in range(0, len(stale), 1000):
+        chunk = stale[i:i + 1000]
+        pipe = redis_client.pipeline()
+        pipe.delete(*chunk)
+        for tag_key in tag_keys:
+            pipe.srem(tag_key, *chunk)
+        pipe.execute()
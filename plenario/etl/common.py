@@ -1,6 +1,11 @@
+import hashlib
+import io
 import tempfile
 import requests
-from plenario.database import app_engine as engine
+from collections import namedtuple
+from contextlib import contextmanager
+from redis import RedisError
+from plenario.database import app_engine as engine, invalidate_cache_tags
 
 
 class PlenarioETLError(Exception):
@@ -9,6 +14,27 @@ class PlenarioETLError(Exception):
         self.message = message
 
 
+# What the source of a dataset looked like when it was last ingested:
+# the ETag and Last-Modified headers it came with, and the sha256 of its
+# content. Any of them can be None.
+SourceFingerprint = namedtuple('SourceFingerprint', 'etag last_modified digest')
+
+
+class SourceUnchanged(Exception):
+    """
+    The source of a dataset hasn't changed since it was last ingested,
+    so there's nothing to update.
+    """
+
+    def __init__(self, url, fingerprint=None):
+        """
+        :param fingerprint: SourceFingerprint of the download, if it was
+                            downloaded and found to be the same
+        """
+        Exception.__init__(self, url)
+        self.fingerprint = fingerprint
+
+
 class ETLFile(object):
     """
     Encapsulates whether a file has been downloaded temporarily
@@ -18,7 +44,12 @@ class ETLFile(object):
 
     Implements context manager interface with __enter__ and __exit__.
     """
-    def __init__(self, source_path=None, source_url=None):
+    def __init__(self, source_path=None, source_url=None, since=None):
+        """
+        :param since: SourceFingerprint of the last download of source_url.
+                      If given, __enter__ raises SourceUnchanged rather than
+                      hand over the same file again.
+        """
         if source_path and source_url:
             raise RuntimeError('ETLFile takes exactly one of source_path and source_url. Both were given.')
 
@@ -28,6 +59,9 @@ class ETLFile(object):
         self.source_path = source_path
         self.source_url = source_url
         self.is_local = bool(source_path)
+        self.since = since
+        # SourceFingerprint of the download, once there's been one
+        self.fingerprint = None
         self._handle = None
 
     def __enter__(self):
@@ -65,26 +99,146 @@ class ETLFile(object):
         Download file to local data directory.
         :param url: url from where file should be downloaded
         :type url: str
-        :raises: IOError
+        :raises: IOError, SourceUnchanged
         """
 
         # The file might be big, so stream it in chunks.
         # I'd like to enforce a timeout, but some big datasets
         # take more than a minute to start streaming.
         # Maybe add timeout as a parameter.
-        file_stream_request = requests.get(url, stream=True)
-        # Raise an exception if we didn't get a 200
-        file_stream_request.raise_for_status()
+        file_stream_request = fetch_source(url, self.since)
 
         # Make this temporary file our file handle
         self.handle = tempfile.TemporaryFile()
 
         # Download and write to disk in 1MB chunks.
+        digest = hashlib.sha256()
         for chunk in file_stream_request.iter_content(chunk_size=1024*1024):
             if chunk:
+                digest.update(chunk)
                 self._handle.write(chunk)
                 self._handle.flush()
 
+        self.fingerprint = _fingerprint(file_stream_request, digest)
+        if is_unchanged(self.since, self.fingerprint):
+            # __exit__ won't be called, so clean up here.
+            self._handle.close()
+            raise SourceUnchanged(url, self.fingerprint)
+
+
+def fetch_source(url, since=None):
+    """
+    Start downloading the source file of a dataset, unless the server
+    says it hasn't changed.
+    :param url: url of the file
+    :param since: SourceFingerprint of the last download, if any
+    :return: streaming requests response
+    :raises: requests.HTTPError, SourceUnchanged
+    """
+    headers = {}
+    if since is not None:
+        if since.etag:
+            headers['If-None-Match'] = since.etag
+        if since.last_modified:
+            headers['If-Modified-Since'] = since.last_modified
+
+    response = requests.get(url, stream=True, headers=headers)
+    if response.status_code == 304:
+        response.close()
+        raise SourceUnchanged(url)
+    try:
+        # Raise an exception if we didn't get a 200
+        response.raise_for_status()
+    except requests.HTTPError:
+        response.close()
+        raise
+    return response
+
+
+def is_unchanged(since, fingerprint):
+    """
+    :return: whether a download has the same content as the last one
+    """
+    return since is not None and fingerprint is not None \
+        and since.digest is not None and since.digest == fingerprint.digest
+
+
+def _fingerprint(response, digest):
+    return SourceFingerprint(response.headers.get('ETag'),
+                             response.headers.get('Last-Modified'),
+                             digest.hexdigest())
+
+
+def source_fingerprint(meta):
+    """
+    :param meta: MetaTable or ShapeMetadata record
+    :return: SourceFingerprint of its last ingest, or None
+    """
+    fingerprint = SourceFingerprint(meta.source_etag,
+                                    meta.source_last_modified,
+                                    meta.source_digest)
+    return fingerprint if any(fingerprint) else None
+
+
+def record_fingerprint(meta, fingerprint):
+    """
+    Remember what the source looked like, for the next update.
+    Leaves meta as is if there's no fingerprint (ex. local files).
+    """
+    if fingerprint is not None:
+        meta.source_etag, meta.source_last_modified, meta.source_digest = fingerprint
+
+
+class _DigestedStream(io.RawIOBase):
+    """
+    Reads the decoded content of a streaming response, taking its sha256
+    along the way.
+    """
+
+    def __init__(self, response):
+        self.response = response
+        self.digest = hashlib.sha256()
+        # Decoding can hand back more than was asked for.
+        self._pending = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self._pending or self.response.raw.read(len(b))
+        n = min(len(b), len(data))
+        b[:n] = data[:n]
+        self._pending = data[n:]
+        self.digest.update(data[:n])
+        return n
+
+    def fingerprint(self):
+        return _fingerprint(self.response, self.digest)
+
+
+@contextmanager
+def streamed_url(url, buffer_size=1024*1024, since=None):
+    """
+    Read a remote file as it downloads, without writing it to disk.
+    It can only be read once, front to back.
+    :param url: url of the file
+    :param buffer_size: bytes read from the network at a time
+    :param since: SourceFingerprint of the last download, if any
+    :return: (file-like object, function returning the SourceFingerprint
+             of the file once it's been read to the end)
+    :raises: requests.HTTPError, SourceUnchanged
+    """
+    response = fetch_source(url, since)
+    try:
+        # Undo any gzip transfer encoding, and let the buffer see EOF
+        # rather than a closed file.
+        response.raw.decode_content = True
+        response.raw.auto_close = False
+        stream = _DigestedStream(response)
+        yield io.BufferedReader(stream, buffer_size), stream.fingerprint
+    finally:
+        response.close()
+
 
 def add_unique_hash(table_name):
     """
@@ -121,4 +275,16 @@ def delete_absent_hashes(staging_name, existing_name):
     try:
         engine.execute(del_)
     except Exception as e:
-        raise PlenarioETLError(repr(e) + '\n Failed to execute' + del_)
\ No newline at end of file
+        raise PlenarioETLError(repr(e) + '\n Failed to execute' + del_)
+
+def invalidate_cached_responses(dataset_name):
+    """
+    Drop the cached API responses built from a dataset, once new data for it
+    has been committed. A cache hiccup shouldn't fail the ETL, the responses
+    expire on their own eventually.
+    """
+    try:
+        invalidate_cache_tags([dataset_name])
+    except RedisError as e:
+        print 'Failed to invalidate cached responses for {}: {!r}'.\
+            format(dataset_name, e)
@@ -0,0 +1,422 @@
+"""
+Row hashes worked out while a CSV is copied into its staging table.
+
+Every point table has a hash column, md5(CAST(row AS text)) of the source
+columns, which Update compares to find new and deleted records. It used to
+be added after the COPY by add_unique_hash, which rewrites the whole table
+with SELECT DISTINCT. HashedCSV hashes rows on their way into the COPY
+instead, and leaves duplicates out as it goes.
+
+To come up with the same hash, every value is turned into the text
+Postgres would store for it and print in a row. That's only done for
+types and formats whose handling by Postgres is known exactly. For
+anything else HashedCSV raises UnhashableValue, or csv_canonicals declines
+up front, and the staging table falls back to add_unique_hash.
+"""
+
+import hashlib
+import re
+import struct
+from decimal import Decimal
+from itertools import chain
+
+from csvkit.unicsv import UnicodeCSVReader
+from sqlalchemy import types
+from sqlalchemy.dialects import postgresql
+
+from plenario.utils.typeinference import ISO_DATETIME, US_DATETIME, \
+    TIME_OF_DAY, parse_common_datetime
+
+# Postgres' boolin, which ignores case and surrounding whitespace.
+TRUE_INPUTS = frozenset(['t', 'tr', 'tru', 'true', 'y', 'ye', 'yes', 'on', '1'])
+FALSE_INPUTS = frozenset(['f', 'fa', 'fal', 'fals', 'false', 'n', 'no', 'of', 'off', '0'])
+
+# What int4in and float8in take, less what float() or int() would read
+# differently (ex. digits of other scripts, hex floats, infinity).
+INTEGER_INPUT = re.compile(r'\s*[+-]?\d+\s*\Z')
+FLOAT_INPUT = re.compile(r'\s*[+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?\s*\Z')
+
+# A quoted empty value, which COPY loads as an empty string rather than
+# NULL. The csv module reads it the same as an unquoted one, so it's looked
+# for in the raw text. (It also turns up inside some quoted values, which
+# only costs a fallback.)
+QUOTED_EMPTY = re.compile(r'[,\r\n]""[,\r\n]')
+
+# Characters which make record_out quote a value.
+QUOTED_CHARACTERS = frozenset(u'"\\(), \t\n\r\v\f')
+
+# Bytes handed to COPY at a time.
+CHUNK_SIZE = 1024 * 1024
+
+# An unused slot of a _DigestSet.
+EMPTY_DIGEST = '\0' * 16
+
+
+class UnhashableValue(Exception):
+    """A value Postgres may store differently than we'd guess."""
+
+
+# Canonical forms
+# ===============
+# Each of these takes a value as read from the CSV and returns the text
+# Postgres prints for it once stored in a column of some type, which is
+# also what gets written to the COPY. Empty values are NULL.
+
+def _text(value):
+    return value
+
+
+def _integer(value):
+    if not INTEGER_INPUT.match(value):
+        raise UnhashableValue(value)
+    return unicode(int(value))
+
+
+def _boolean(value):
+    value = value.strip().lower()
+    if value in TRUE_INPUTS:
+        return u't'
+    elif value in FALSE_INPUTS:
+        return u'f'
+    raise UnhashableValue(value)
+
+
+def _float_digits(value):
+    """
+    :return: (sign, digits, decimal exponent of the first digit) of the
+             shortest decimal which reads back as the same double
+    """
+    number = _float(value)
+    # repr gives the shortest round tripping digits, like Postgres' Ryu.
+    sign, digits, exponent = Decimal(repr(number)).normalize().as_tuple()
+    if not any(digits):
+        return sign, u'0', 0
+    digits = u''.join(unicode(d) for d in digits)
+    return sign, digits, exponent + len(digits) - 1
+
+
+def _shortest_float(value):
+    """float8out with extra_float_digits > 0, on Postgres 12 and later."""
+
+    sign, digits, exponent = _float_digits(value)
+    if -4 <= exponent < 15:
+        if exponent < 0:
+            text = u'0.' + u'0' * (-exponent - 1) + digits
+        elif len(digits) > exponent + 1:
+            text = digits[:exponent + 1] + u'.' + digits[exponent + 1:]
+        else:
+            text = digits + u'0' * (exponent + 1 - len(digits))
+    else:
+        text = digits[0]
+        if len(digits) > 1:
+            text += u'.' + digits[1:]
+        text += u'e{}{:02d}'.format(u'-' if exponent < 0 else u'+', abs(exponent))
+    return (u'-' if sign else u'') + text
+
+
+def _printf_float(precision):
+    """float8out printing %.*g, before Postgres 12 or with
+    extra_float_digits <= 0."""
+
+    def canonical(value):
+        return unicode('%.*g' % (precision, _float(value)))
+    return canonical
+
+
+def _float(value):
+    if not FLOAT_INPUT.match(value):
+        raise UnhashableValue(value)
+    number = float(value)
+    if number in (float('inf'), float('-inf')):
+        # Overflowed, which float8in won't have.
+        raise UnhashableValue(value)
+    return number
+
+
+def _parse_temporal(value, date_part, time_part):
+    """
+    :param date_part: whether the value should have a date
+    :param time_part: whether it may have a time of day
+    :return: datetime, parsed the way Postgres would with DateStyle MDY
+    """
+    match = ISO_DATETIME.match(value) or US_DATETIME.match(value)
+    if match:
+        has_time = match.group(4) is not None
+        if not date_part or (has_time and not time_part):
+            raise UnhashableValue(value)
+    elif date_part or not TIME_OF_DAY.match(value):
+        raise UnhashableValue(value)
+
+    # Unlike parse_datetime, don't fall back on dateutil for odd values,
+    # it and Postgres don't always agree on those.
+    d = parse_common_datetime(value)
+    if d is None:
+        raise UnhashableValue(value)
+    return d
+
+
+def _time_text(t):
+    text = u'{:02d}:{:02d}:{:02d}'.format(t.hour, t.minute, t.second)
+    if t.microsecond:
+        text += (u'.%06d' % t.microsecond).rstrip(u'0')
+    return text
+
+
+def _date_text(d):
+    return u'{:04d}-{:02d}-{:02d}'.format(d.year, d.month, d.day)
+
+
+def _timestamp(value):
+    d = _parse_temporal(value, date_part=True, time_part=True)
+    return _date_text(d) + u' ' + _time_text(d)
+
+
+def _date(value):
+    return _date_text(_parse_temporal(value, date_part=True, time_part=False))
+
+
+def _time(value):
+    return _time_text(_parse_temporal(value, date_part=False, time_part=True))
+
+
+def _canonical_for(type_, float_canonical):
+    """
+    :param type_: SQLAlchemy type of a column
+    :return: canonical form function for its values, or None if it isn't
+             a type we can hash
+    """
+    if isinstance(type_, types.Boolean):
+        return _boolean
+    elif isinstance(type_, types.Integer):
+        return _integer
+    elif isinstance(type_, types.Float):
+        # Float(precision=24) and REAL are single precision.
+        if isinstance(type_, postgresql.REAL) or \
+                (type_.precision is not None and type_.precision <= 24):
+            return None
+        return float_canonical
+    elif isinstance(type_, types.Numeric):
+        return None
+    elif isinstance(type_, types.DateTime):
+        return None if type_.timezone else _timestamp
+    elif isinstance(type_, types.Date):
+        return _date
+    elif isinstance(type_, types.Time):
+        return None if type_.timezone else _time
+    elif isinstance(type_, types.String):
+        # CHAR(n) pads values with spaces.
+        return None if isinstance(type_, types.CHAR) else _text
+    return None
+
+
+def _server_float_canonical(conn):
+    """
+    :param conn: DBAPI connection
+    :return: canonical form function for double precision values, or None
+             if the server isn't set up to print dates the way we expect
+    """
+    with conn.cursor() as cursor:
+        cursor.execute('SHOW server_version_num')
+        version = int(cursor.fetchone()[0])
+        cursor.execute('SHOW extra_float_digits')
+        extra_float_digits = int(cursor.fetchone()[0])
+        cursor.execute('SHOW DateStyle')
+        date_style = cursor.fetchone()[0]
+        cursor.execute('SHOW server_encoding')
+        encoding = cursor.fetchone()[0]
+
+    # 01/02/2015 is January 2nd with MDY, and dates come out as 2015-01-02.
+    if date_style.replace(' ', '').upper() != 'ISO,MDY' or encoding != 'UTF8':
+        return None
+    if version >= 120000 and extra_float_digits > 0:
+        return _shortest_float
+    return _printf_float(15 + extra_float_digits)
+
+
+def csv_canonicals(columns, conn):
+    """
+    Works out, before any of the file is read, whether HashedCSV can take it.
+    :param columns: SQLAlchemy columns the CSV is copied into, in order
+    :param conn: DBAPI connection the COPY will run on
+    :return: canonical form functions to build a HashedCSV with, or None
+             if rows of these columns can't be hashed outside of the database
+    """
+    float_canonical = _server_float_canonical(conn)
+    if float_canonical is None:
+        return None
+
+    canonicals = [_canonical_for(c.type, float_canonical) for c in columns]
+    if None in canonicals:
+        return None
+    return canonicals
+
+
+def _record_value(text):
+    """Print a value the way record_out does inside a row."""
+
+    if text is None:
+        return u''
+    if text and not any(ch in QUOTED_CHARACTERS for ch in text):
+        return text
+    return u'"' + text.replace(u'\\', u'\\\\').replace(u'"', u'""') + u'"'
+
+
+def _csv_value(text):
+    if text is None:
+        return u''
+    if text and not any(ch in u'",\r\n' for ch in text) and text.strip() == text:
+        return text
+    return u'"' + text.replace(u'"', u'""') + u'"'
+
+
+class HashedCSV(object):
+    """
+    File-like object for cursor.copy_expert. Reads a source CSV and hands
+    out its rows in canonical form with their hash added as the last
+    column, each distinct row once, without a header.
+
+    Empty values load as NULL whatever the column type, like unquoted ones
+    always did. Quoted ones ("") didn't, and raise UnhashableValue.
+    """
+
+    def __init__(self, f, canonicals):
+        """
+        :param f: file handle to the source CSV, header included
+        :param canonicals: canonical form function per column
+        """
+        self.canonicals = canonicals
+        self.rows = 0
+        self.duplicates = 0
+        # The UnhashableValue it ran into, if any. Whether the COPY passes
+        # on exceptions from read as they are depends on psycopg2.
+        self.unhashable = None
+        self._seen = _DigestSet()
+        self._buffer = ''
+        self._lines = self._generate(UnicodeCSVReader(_QuotedEmptyCheck(f)))
+
+    def _generate(self, reader):
+        # Skip the header.
+        reader.next()
+        width = len(self.canonicals)
+        for row in reader:
+            if len(row) != width:
+                # COPY would have failed on it, let it fail the same way.
+                raise UnhashableValue(row)
+
+            values = []
+            for value, canonical in zip(row, self.canonicals):
+                values.append(canonical(value) if value != u'' else None)
+
+            text = u'(' + u','.join(_record_value(v) for v in values) + u')'
+            digest = hashlib.md5(text.encode('utf-8'))
+            if not self._seen.add(digest.digest()):
+                self.duplicates += 1
+                continue
+            self.rows += 1
+
+            line = u','.join(chain((_csv_value(v) for v in values),
+                                   [digest.hexdigest()]))
+            yield line.encode('utf-8') + '\n'
+
+    def read(self, size=-1):
+        chunks, length = [self._buffer], len(self._buffer)
+        try:
+            for line in self._lines:
+                chunks.append(line)
+                length += len(line)
+                if 0 <= size <= length:
+                    break
+        except UnhashableValue as e:
+            self.unhashable = e
+            raise
+        data = ''.join(chunks)
+        if size < 0:
+            size = len(data)
+        self._buffer = data[size:]
+        return data[:size]
+
+
+class _DigestSet(object):
+    """
+    Set of 16 byte digests, to drop duplicate rows with. A set of strings
+    takes around 100 bytes a row, which adds up to gigabytes for the biggest
+    datasets. This packs the digests into an open addressed table instead,
+    at 21 to 43 bytes a row.
+    """
+
+    def __init__(self, slots=1 << 16):
+        """
+        :param slots: starting size of the table, a power of 2
+        """
+        self._slots = slots
+        self._table = bytearray(16 * slots)
+        self._len = 0
+        # An empty slot is all zeroes, so that digest is kept aside.
+        self._has_empty = False
+
+    def __len__(self):
+        return self._len + self._has_empty
+
+    def add(self, key):
+        """
+        :param key: 16 byte digest
+        :return: whether it wasn't in the set already
+        """
+        if key == EMPTY_DIGEST:
+            added, self._has_empty = not self._has_empty, True
+            return added
+        # Keep the table at most 3/4 full.
+        if 4 * (self._len + 1) > 3 * self._slots:
+            self._grow()
+        if _insert_digest(self._table, self._slots - 1, key):
+            self._len += 1
+            return True
+        return False
+
+    def _grow(self):
+        slots = self._slots * 2
+        table = bytearray(16 * slots)
+        old = self._table
+        for start in xrange(0, len(old), 16):
+            key = old[start:start + 16]
+            if key != EMPTY_DIGEST:
+                _insert_digest(table, slots - 1, key)
+        self._table, self._slots = table, slots
+
+
+def _insert_digest(table, mask, key, _index=struct.Struct('<Q').unpack_from):
+    """
+    Linear probing from the slot the digest's first 8 bytes pick, which are
+    as good as random.
+    :return: whether it wasn't in the table already
+    """
+    start = (_index(key)[0] & mask) << 4
+    while True:
+        slot = table[start:start + 16]
+        if slot == EMPTY_DIGEST:
+            table[start:start + 16] = key
+            return True
+        if slot == key:
+            return False
+        start = (start + 16) & (mask << 4 | 15)
+
+
+class _QuotedEmptyCheck(object):
+    """
+    Passes reads through from a file, raising UnhashableValue once it
+    comes across a quoted empty value.
+    """
+
+    def __init__(self, f):
+        self._f = f
+        # The end of what was read before, as a value can straddle reads.
+        # The start and end of the file count as line breaks.
+        self._tail = '\n'
+
+    def read(self, size=-1):
+        data = self._f.read(size)
+        text = self._tail + (data or '\n')
+        if QUOTED_EMPTY.search(text):
+            raise UnhashableValue('""')
+        self._tail = text[-3:]
+        return data
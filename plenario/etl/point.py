@@ -1,14 +1,22 @@
 import json
+import requests
+from datetime import datetime, timedelta
 
-from csvkit.unicsv import UnicodeCSVReader
 from geoalchemy2 import Geometry
-from sqlalchemy import TIMESTAMP, Table, Column, MetaData, String
-from sqlalchemy import select, func
+from sqlalchemy import TIMESTAMP, Table, Column, MetaData, String, Index, Text
+from sqlalchemy import select, func, literal
 from sqlalchemy.exc import NoSuchTableError
 
 from plenario.database import app_engine as engine, session
+from plenario.models import grid_square
+from plenario.settings import GRID_PYRAMID_RESOLUTIONS, INFERENCE_SAMPLE_ROWS
 from plenario.etl.common import ETLFile, add_unique_hash, PlenarioETLError, delete_absent_hashes
-from plenario.utils.helpers import iter_column, slugify
+from plenario.etl.common import invalidate_cached_responses, streamed_url
+from plenario.etl.common import SourceUnchanged, is_unchanged, \
+    source_fingerprint, record_fingerprint
+from plenario.etl.hashing import HashedCSV, csv_canonicals, CHUNK_SIZE
+from plenario.utils.helpers import infer_csv_columns, slugify
+from plenario.utils.model_helpers import schema_changed
 
 
 class PlenarioETL(object):
@@ -31,20 +39,44 @@ class PlenarioETL(object):
         """
         with self.staging_table as s_table:
             new_table = Creation(s_table.table, self.dataset).table
+        record_fingerprint(self.metadata, self.staging_table.fingerprint)
         update_meta(self.metadata, new_table)
+        invalidate_cached_responses(self.dataset.name)
         return new_table
 
     def update(self):
         """
         Insert new records into existing point table.
+        :return: False if the source hadn't changed since the last
+                 update, so there was nothing to do
         """
         existing_table = self.metadata.point_table
-        with self.staging_table as s_table:
-            staging = s_table.table
-            delete_absent_hashes(staging.name, existing_table.name)
-            with Update(staging, self.dataset, existing_table) as new_records:
-                new_records.insert()
-        update_meta(self.metadata, existing_table)
+        _ensure_paging_index(existing_table)
+        since = source_fingerprint(self.metadata)
+        self.staging_table.since = since
+        try:
+            with self.staging_table as s_table:
+                if is_unchanged(since, s_table.fingerprint):
+                    raise SourceUnchanged(self.metadata.source_url,
+                                          s_table.fingerprint)
+                staging = s_table.table
+                changed_days = _days_of_absent_hashes(staging, existing_table)
+                delete_absent_hashes(staging.name, existing_table.name)
+                with Update(staging, self.dataset, existing_table) as new_records:
+                    new_records.insert()
+                    changed_days |= new_records.days()
+        except SourceUnchanged:
+            # It's still been checked, but the table, cached responses and
+            # ETags built from it stay as they are.
+            record_fingerprint(self.metadata, self.staging_table.fingerprint)
+            self.metadata.last_checked = datetime.now()
+            session.add(self.metadata)
+            session.commit()
+            return False
+        record_fingerprint(self.metadata, self.staging_table.fingerprint)
+        update_meta(self.metadata, existing_table, changed_days)
+        invalidate_cached_responses(self.dataset.name)
+        return True
 
 
 class Staging(object):
@@ -71,6 +103,11 @@ class Staging(object):
         except NoSuchTableError:
             self.cols = None
 
+        # SourceFingerprint of the last download, to skip an unchanged file
+        self.since = None
+        # and of this one, once it's been read
+        self.fingerprint = None
+
         # Retrieve the source file
         try:
             if source_path:  # Local ingest
@@ -83,21 +120,41 @@ class Staging(object):
     def __enter__(self):
         """
         Create the staging table. Will be named s_[dataset_name]
-        """
-        with self.file_helper as helper:
-            if not self.cols:
-                # We couldn't get the column metadata from an existing table
-                self.cols = self._from_inference(helper.handle)
-
-            # Grab the handle to build a table from the CSV
-            try:
-                self.table = self._make_table(helper.handle)
-                add_unique_hash(self.table.name)
+        :raises: SourceUnchanged if self.since is given and the server
+                 says the file is the same, or its content is
+        """
+        self.file_helper.since = self.since
+        if self.cols and not self.file_helper.is_local:
+            # When updating, the columns are known before the file is read,
+            # so the download can go straight into the table.
+            if self._stream_hashed_table(self.file_helper.source_url):
                 self.table = Table(self.name, MetaData(),
                                    autoload_with=engine, extend_existing=True)
                 return self
-            except Exception as e:
-                raise PlenarioETLError(e)
+
+        try:
+            with self.file_helper as helper:
+                self.fingerprint = helper.fingerprint
+                if not self.cols:
+                    # We couldn't get the column metadata from an existing table
+                    self.cols = self._from_inference(helper.handle)
+
+                # Grab the handle to build a table from the CSV
+                try:
+                    canonicals = self._canonicals()
+                    if canonicals is None or \
+                            not self._make_hashed_table(helper.handle, canonicals):
+                        self._make_table(helper.handle)
+                        add_unique_hash(self.name)
+                    self.table = Table(self.name, MetaData(),
+                                       autoload_with=engine, extend_existing=True)
+                    return self
+                except Exception as e:
+                    raise PlenarioETLError(e)
+        except SourceUnchanged as e:
+            # The download was the same as the last one.
+            self.fingerprint = e.fingerprint
+            raise
 
     def _drop(self):
         engine.execute("DROP TABLE IF EXISTS {};"
@@ -144,6 +201,81 @@ class Staging(object):
         finally:
             conn.close()
 
+    def _canonicals(self):
+        """
+        :return: canonical forms to hash rows of the CSV with,
+                 or None if they have to be hashed by add_unique_hash
+        """
+        conn = engine.raw_connection()
+        try:
+            return csv_canonicals(self.cols, conn)
+        finally:
+            conn.close()
+
+    def _make_hashed_table(self, f, canonicals):
+        """
+        Create a table and fill it with CSV data and the hash of each row,
+        leaving out duplicate rows, without add_unique_hash rewriting it.
+        See plenario.etl.hashing.
+        :param f: Open file handle pointing to start of CSV
+        :param canonicals: from _canonicals
+        :return: whether it could, if not there's no table
+        """
+        cols = [_copy_col(c) for c in self.cols] + [Column('hash', Text)]
+        table = Table(self.name, MetaData(), *cols, extend_existing=True)
+
+        names = [c.name for c in cols]
+        copy_st = "COPY {t_name} ({cols}) FROM STDIN " \
+                  "WITH (FORMAT CSV, DELIMITER ',')".\
+            format(t_name=self.name, cols=', '.join(names))
+
+        conn = engine.raw_connection()
+        source = None
+        try:
+            source = HashedCSV(f, canonicals)
+            self._drop()
+            table.create(bind=engine)
+            with conn.cursor() as cursor:
+                cursor.copy_expert(copy_st, source, size=CHUNK_SIZE)
+                cursor.execute('ALTER TABLE "{}" ADD PRIMARY KEY (hash);'.
+                               format(self.name))
+            conn.commit()
+            return True
+        except Exception as e:
+            conn.rollback()
+            if source is not None and source.unhashable is not None:
+                print 'Hashing {} in the database: {!r}'.\
+                    format(self.name, source.unhashable)
+                self._drop()
+                return False
+            raise PlenarioETLError(e)
+        finally:
+            conn.close()
+
+    def _stream_hashed_table(self, url):
+        """
+        Create a table and fill it with hashed rows of a remote CSV while
+        it downloads, with neither a temporary file nor the whole file in
+        memory. What memory it takes still grows with the number of rows,
+        by the digest HashedCSV keeps of each one to drop duplicates.
+        :param url: url of the source CSV
+        :return: whether it could, if not there's no table and the file
+                 has to be downloaded after all
+        """
+        # Don't start the download unless the rows can be hashed.
+        canonicals = self._canonicals()
+        if canonicals is None:
+            return False
+        try:
+            with streamed_url(url, CHUNK_SIZE, self.since) as (f, fingerprint):
+                if not self._make_hashed_table(f, canonicals):
+                    return False
+                # The COPY read the file to the end.
+                self.fingerprint = fingerprint()
+                return True
+        except requests.RequestException as e:
+            raise PlenarioETLError(e)
+
     def _add_unique_hash(table_name):
         """
         Adds an md5 hash column of the preexisting columns
@@ -190,15 +322,10 @@ class Staging(object):
         """
         Generate columns by scanning source CSV and inferring column types.
         """
-        reader = UnicodeCSVReader(f)
+        column_info = infer_csv_columns(f, sample_rows=INFERENCE_SAMPLE_ROWS)
         # Always create columns with slugified names
-        header = map(slugify, reader.next())
-
-        cols = []
-        for col_idx, col_name in enumerate(header):
-            col_type, nullable = iter_column(col_idx, f)
-            cols.append(_make_col(col_name, col_type, nullable))
-        return cols
+        return [_make_col(slugify(c.name), c.type_, c.has_nulls)
+                for c in column_info]
 
 
 def _null_malformed_geoms(existing):
@@ -209,6 +336,28 @@ def _null_malformed_geoms(existing):
     engine.execute(upd)
 
 
+def _paging_index(table):
+    # Backs the keyset pagination of /detail, which orders on
+    # (point_date, hash) and resumes after the last row it served.
+    return Index('ix_{}_point_date_hash'.format(table.name),
+                 table.c.point_date, table.c.hash)
+
+
+def _ensure_paging_index(table):
+    """
+    Point tables created before /detail had continuation tokens
+    don't have the paging index. Add it the next time they're updated.
+    """
+    # Ask the database, the reflected table can predate the index.
+    name = 'ix_{}_point_date_hash'.format(table.name)
+    exists = engine.execute(
+        'SELECT 1 FROM pg_indexes WHERE tablename = %s AND indexname = %s',
+        (table.name, name)).first()
+    if exists is None:
+        _paging_index(table).create(engine)
+        schema_changed()
+
+
 def _make_col(name, type, nullable):
     return Column(name, type, nullable=nullable)
 
@@ -256,6 +405,7 @@ class Creation(object):
                    nullable=True, index=True)]
         new_table = Table(self.dataset.name, MetaData(),
                           *(original_cols + derived_cols))
+        _paging_index(new_table)
 
         try:
             new_table.create(engine)
@@ -265,6 +415,7 @@ class Creation(object):
             new_table.drop(bind=engine, checkfirst=True)
             raise
         else:
+            schema_changed()
             return new_table
 
     def _add_trigger(self):
@@ -367,6 +518,14 @@ class Update(object):
             raise PlenarioETLError(repr(e) +
                         '\n Failed to null out geoms with (0,0) geocoding')
 
+    def days(self):
+        """
+        :return: set of the days (as datetimes) of the new records
+        """
+        day = func.date_trunc('day', self.table.c.point_date)
+        sel = select([day]).distinct().where(self.table.c.point_date != None)
+        return {row[0] for row in engine.execute(sel)}
+
     def _drop(self):
         engine.execute("DROP TABLE IF EXISTS {};".format(self.name))
 
@@ -397,17 +556,121 @@ class Update(object):
         return geom_col
 
 
-def update_meta(metatable, table):
+def _days_of_absent_hashes(staging, existing):
+    """
+    :return: set of the days (as datetimes) of the records
+             delete_absent_hashes is about to delete
+    """
+    day = func.date_trunc('day', existing.c.point_date)
+    sel = select([day]).distinct()\
+        .select_from(existing.outerjoin(staging, existing.c.hash == staging.c.hash))\
+        .where(staging.c.hash == None)\
+        .where(existing.c.point_date != None)
+    return {row[0] for row in engine.execute(sel)}
+
+
+def _refresh_rollup(metatable, table):
+    """
+    Rebuild the daily count rollup that backs unfiltered timeseries queries.
+    Runs in the same transaction as the rest of update_meta, so readers
+    never see a half built rollup.
+
+    :param metatable: MetaTable instance of the dataset.
+    :param table: Point table to count records from.
+
+    :returns: None
+    """
+    rollup = metatable.rollup_table
+    rollup.create(bind=session.connection(), checkfirst=True)
+    metatable.rollup_built = True
+    session.execute(rollup.delete())
+
+    day = func.date_trunc('day', table.c.point_date)
+    daily_counts = select([day, func.count(table.c.hash)])\
+        .where(table.c.point_date != None)\
+        .group_by(day)
+    session.execute(rollup.insert().from_select(['day', 'count'], daily_counts))
+
+
+def _grid_cell_sizes(metatable):
+    """
+    :return: grid square sizes at each of the GRID_PYRAMID_RESOLUTIONS,
+             which depend on where the dataset is, or None without a bbox
+    """
+    if metatable.bbox is None:
+        return None
+    return [metatable.grid_cell_size(r) for r in GRID_PYRAMID_RESOLUTIONS]
+
+
+def _refresh_pyramid(metatable, table, days=None):
+    """
+    Recount the per-day grid square counts that back date-only /grid
+    queries, at each of the GRID_PYRAMID_RESOLUTIONS. Relies on the bbox
+    from update_meta, since square size depends on where the dataset is.
+
+    :param metatable: MetaTable instance of the dataset.
+    :param table: Point table to count records from.
+    :param days: datetimes of the only days whose records changed,
+                 or None to rebuild the whole pyramid
+
+    :returns: None
+    """
+    pyramid = metatable.pyramid_table
+    if not metatable.has_pyramid():
+        pyramid.create(bind=session.connection(), checkfirst=True)
+        metatable.pyramid_built = True
+        days = None
+    elif days is not None:
+        # A resolution that was added since has no counts to go on.
+        resolutions = session.query(pyramid.c.resolution).distinct().all()
+        if {r for r, in resolutions} != set(GRID_PYRAMID_RESOLUTIONS):
+            days = None
+
+    if days is None:
+        session.execute(pyramid.delete())
+    elif not days:
+        return
+    else:
+        days = sorted(days)
+        session.execute(pyramid.delete().where(pyramid.c.day.in_(days)))
+
+    if metatable.bbox is None:
+        # No located points, so nothing to put on a grid.
+        return
+
+    day = func.date_trunc('day', table.c.point_date)
+    for resolution in GRID_PYRAMID_RESOLUTIONS:
+        size_x, size_y = metatable.grid_cell_size(resolution)
+        square = grid_square(table.c.geom, size_x, size_y)
+        counts = select([literal(resolution), day, square, func.count(table.c.hash)])\
+            .where(table.c.point_date != None)\
+            .group_by(day, square)
+        if days is not None:
+            # The range is only there to use the point_date index.
+            counts = counts.where(table.c.point_date >= days[0])\
+                .where(table.c.point_date < days[-1] + timedelta(days=1))\
+                .where(day.in_(days))
+        session.execute(pyramid.insert().from_select(
+            ['resolution', 'day', 'cell', 'count'], counts))
+
+
+def update_meta(metatable, table, changed_days=None):
     """
     After ingest/update, update the metatable registry to reflect table information.
 
     :param metatable: MetaTable instance to update.
     :param table: Table instance to update from.
+    :param changed_days: datetimes of the only days an update changed,
+                         or None if any may have
 
     :returns: None
     """
 
     try:
+        # Grid squares change size if the bbox moves, which takes a new
+        # pyramid rather than a recount of the changed days.
+        old_sizes = _grid_cell_sizes(metatable)
+
         metatable.update_date_added()
 
         metatable.obs_from, metatable.obs_to = session.query(
@@ -427,6 +690,11 @@ def update_meta(metatable, table):
             if c.name not in {u'geom', u'point_date', u'hash'}
         }
 
+        _refresh_rollup(metatable, table)
+        if _grid_cell_sizes(metatable) != old_sizes:
+            changed_days = None
+        _refresh_pyramid(metatable, table, changed_days)
+
         session.add(metatable)
         session.commit()
 
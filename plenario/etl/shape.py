@@ -1,10 +1,13 @@
 # -*- coding: utf-8 -*-
 
 import zipfile
+from datetime import datetime
 
 from plenario.database import session, app_engine as engine
 from plenario.etl.common import ETLFile, PlenarioETLError, add_unique_hash,\
-    delete_absent_hashes
+    delete_absent_hashes, invalidate_cached_responses, SourceUnchanged,\
+    source_fingerprint, record_fingerprint
+from plenario.utils.model_helpers import schema_changed
 from plenario.utils.shapefile import import_shapefile, ShapefileError
 from sqlalchemy import Table, MetaData
 
@@ -35,24 +38,43 @@ class ShapeETL:
         new = HashedShape(self.table_name, self.source_url, self.source_path)
         try:
             new.ingest()
+            schema_changed()
             self.meta.update_after_ingest()
+            record_fingerprint(self.meta, new.fingerprint)
             session.commit()
         except:
             # In case ingestion failed partway through,
             # be sure to leave no trace.
             new.drop()
             raise
+        invalidate_cached_responses(self.table_name)
 
     def update(self):
+        """
+        :return: False if the source hadn't changed since the last
+                 update, so there was nothing to do
+        """
         assert self.meta.is_ingested
         existing = reflect(self.table_name)
         staging_name = 's_' + self.table_name
 
-        with HashedShape(staging_name, self.source_url,
-                         self.source_path) as staging:
-            self._hash_update(staging, existing)
+        new = HashedShape(staging_name, self.source_url, self.source_path,
+                          since=source_fingerprint(self.meta))
+        try:
+            with new as staging:
+                self._hash_update(staging, existing)
+        except SourceUnchanged:
+            # Headers can change while the content doesn't.
+            record_fingerprint(self.meta, new.fingerprint)
+            self.meta.last_checked = datetime.now()
+            session.commit()
+            return False
 
         self.meta.update_after_ingest()
+        record_fingerprint(self.meta, new.fingerprint)
+        session.commit()
+        invalidate_cached_responses(self.table_name)
+        return True
 
     @staticmethod
     def _hash_update(staging, existing):
@@ -80,29 +102,44 @@ class HashedShape(object):
     and append an md5 hash column.
     """
 
-    def __init__(self, name, url, path=None):
+    def __init__(self, name, url, path=None, since=None):
+        """
+        :param since: SourceFingerprint of the last download of url,
+                      see ETLFile
+        """
         self.name = name
         self.url = url
         self.path = path
+        self.since = since
+        # SourceFingerprint of the download, once ingested
+        self.fingerprint = None
 
     def ingest(self):
         """
         Create the table. The caller is responsible for cleanup.
         :return: SQLAlchemy Table
+        :raises: SourceUnchanged, before creating anything
         """
 
-        with ETLFile(source_url=self.url, source_path=self.path) as file_helper:
-
-            # Attempt insertion
-            try:
-                with zipfile.ZipFile(file_helper.handle) as shapefile_zip:
-                    import_shapefile(shapefile_zip=shapefile_zip,
-                                     table_name=self.name)
-            except zipfile.BadZipfile:
-                raise PlenarioETLError("Source file was not a valid .zip")
-            except ShapefileError as e:
-                raise PlenarioETLError("Failed to import shapefile.\n{}".
-                                       format(repr(e)))
+        try:
+            with ETLFile(source_url=self.url, source_path=self.path,
+                         since=self.since) as file_helper:
+                self.fingerprint = file_helper.fingerprint
+
+                # Attempt insertion
+                try:
+                    with zipfile.ZipFile(file_helper.handle) as shapefile_zip:
+                        import_shapefile(shapefile_zip=shapefile_zip,
+                                         table_name=self.name)
+                except zipfile.BadZipfile:
+                    raise PlenarioETLError("Source file was not a valid .zip")
+                except ShapefileError as e:
+                    raise PlenarioETLError("Failed to import shapefile.\n{}".
+                                           format(repr(e)))
+        except SourceUnchanged as e:
+            # The download was the same as the last one.
+            self.fingerprint = e.fingerprint
+            raise
 
         add_unique_hash(self.name)
         return reflect(self.name)
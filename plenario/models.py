@@ -1,26 +1,39 @@
+import atexit
 import json
+import os
 import sqlalchemy as sa
+import threading
 
 from collections import namedtuple
-from datetime import datetime
+from datetime import datetime, time, timedelta
 from flask_bcrypt import Bcrypt
 from geoalchemy2 import Geometry
 from hashlib import md5
-from itertools import groupby
+from itertools import groupby, chain
+from multiprocessing.pool import ThreadPool
 from operator import itemgetter
+from redis import RedisError
 from sqlalchemy import Column, String, Boolean, Date, DateTime, Text, func
 from sqlalchemy import Table, select, Integer
-from sqlalchemy.exc import NoSuchTableError
+from sqlalchemy.exc import NoSuchTableError, OperationalError
 from sqlalchemy.dialects.postgresql import ARRAY, JSONB
 from sqlalchemy.orm import synonym
 from sqlalchemy.types import NullType
 from uuid import uuid4
 
-from plenario.database import session, Base
+from plenario.database import session, Base, app_engine, bump_version
+from plenario.settings import TIMESERIES_WORKERS, TIMESERIES_STATEMENT_TIMEOUT
+from plenario.settings import GRID_PYRAMID_RESOLUTIONS
 from plenario.utils.helpers import get_size_in_degrees, slugify
+from plenario.utils.model_helpers import reflect_table
 
 bcrypt = Bcrypt()
 
+# Tables kept alongside each point table. slugify never starts a dataset
+# name with an underscore, so these can't be taken by one.
+ROLLUP_PREFIX = '_r_'
+PYRAMID_PREFIX = '_g_'
+
 
 class MetaTable(Base):
     __tablename__ = 'meta_master'
@@ -38,8 +51,15 @@ class MetaTable(Base):
     bbox = Column(Geometry('POLYGON', srid=4326))
     # TODO: Add restriction list ['daily' etc.]
     update_freq = Column(String(100), nullable=False)
+    # When the data last changed, and when the source was last looked at
     last_update = Column(DateTime)
+    last_checked = Column(DateTime)
     date_added = Column(DateTime)
+    # ETag, Last-Modified and sha256 of the source file when last ingested,
+    # so unchanged files can be skipped on update
+    source_etag = Column(String)
+    source_last_modified = Column(String)
+    source_digest = Column(String(64))
     # The names of our "special" fields
     observed_date = Column(String, nullable=False)
     latitude = Column(String)
@@ -52,6 +72,9 @@ class MetaTable(Base):
     contributor_email = Column(String)
     result_ids = Column(ARRAY(String))
     column_names = Column(JSONB)  # storage format {'<COLUMN_NAME>': '<COLUMN_TYPE>'}
+    # Whether the point ETL has built the rollup and grid pyramid tables
+    rollup_built = Column(Boolean)
+    pyramid_built = Column(Boolean)
 
     def __init__(self, url, human_name, observed_date,
                  approved_status=False, update_freq='yearly',
@@ -146,12 +169,49 @@ class MetaTable(Base):
 
     @property
     def point_table(self):
+        return reflect_table(self.dataset_name)
+
+    @property
+    def rollup_table(self):
+        """
+        Daily record counts of the point table, rebuilt by the point ETL
+        every time the dataset is added or updated.
+        """
         try:
-            return self._point_table
+            return self._rollup_table
         except AttributeError:
-            self._point_table = Table(self.dataset_name, Base.metadata,
-                                      autoload=True, extend_existing=True)
-            return self._point_table
+            self._rollup_table = Table(ROLLUP_PREFIX + self.dataset_name, sa.MetaData(),
+                                       Column('day', DateTime, primary_key=True),
+                                       Column('count', sa.BigInteger, nullable=False))
+            return self._rollup_table
+
+    def has_rollup(self):
+        # Datasets that haven't been through the ETL since rollups were
+        # introduced won't have one yet.
+        return bool(self.rollup_built)
+
+    @property
+    def pyramid_table(self):
+        """
+        Per-day counts of points in each grid square at each of the
+        GRID_PYRAMID_RESOLUTIONS, kept up to date by the point ETL
+        alongside the rollup. cell is the square's corner, see grid_square.
+        """
+        try:
+            return self._pyramid_table
+        except AttributeError:
+            self._pyramid_table = Table(PYRAMID_PREFIX + self.dataset_name, sa.MetaData(),
+                                        Column('resolution', Integer, nullable=False),
+                                        Column('day', DateTime, nullable=False),
+                                        Column('cell', Geometry('POINT', srid=4326,
+                                                                spatial_index=False)),
+                                        Column('count', sa.BigInteger, nullable=False),
+                                        sa.Index('ix_g_{}_resolution_day'.format(self.dataset_name),
+                                                 'resolution', 'day'))
+            return self._pyramid_table
+
+    def has_pyramid(self):
+        return bool(self.pyramid_built)
 
     @classmethod
     def attach_metadata(cls, rows):
@@ -204,23 +264,37 @@ class MetaTable(Base):
     # {'dataset_name': 'Foo',
     # 'items': [{'datetime': dt, 'count': int}, ...] } ]
     @classmethod
-    def timeseries_all(cls, table_names, agg_unit, start, end, geom=None, ctrees=None):
-        # For each table in table_names, generate a query to be unioned
+    def timeseries_all(cls, table_names, agg_unit, start, end, geom=None,
+                       ctrees=None, warnings=None):
+        # The catalog and timing are built on top of this module.
+        from plenario.api.timing import carry_timing
+        from plenario.catalog import catalog
+
+        # For each table in table_names, generate a query to be run alongside
+        # the others
         selects = []
-        for name in table_names:
+        for name in sorted(table_names):
 
             # If we have condition trees specified, apply them.
             # .get will return None for those datasets who don't have filters
             ctree = ctrees.get(name) if ctrees else None
-            table = cls.get_by_dataset_name(name)
+            table = catalog.point(name)
             ts_select = table.timeseries(agg_unit, start, end, geom, ctree)
-            selects.append(ts_select)
-
-        # Union the time series selects to get a panel
-        panel_query = sa.union(*selects)\
-                        .order_by('dataset_name')\
-                        .order_by('time_bucket')
-        panel_vals = session.execute(panel_query)
+            selects.append((name, ts_select.order_by('time_bucket')))
+
+        # Run each dataset's select on its own connection instead of as one
+        # big union, which Postgres would work through one branch at a time.
+        results = _timeseries_pool().map(carry_timing(_fetch_with_timeout),
+                                         [s for _, s in selects])
+
+        panel_vals = []
+        for (name, _), rows in zip(selects, results):
+            if rows is None:
+                if warnings is not None:
+                    warnings.append('Timeseries for {} took too long and was '
+                                    'left out'.format(name))
+                continue
+            panel_vals += rows
 
         panel = []
         for dataset_name, ts in groupby(panel_vals, lambda row: row.dataset_name):
@@ -289,9 +363,10 @@ class MetaTable(Base):
         now = datetime.now()
         if self.date_added is None:
             self.date_added = now
-        self.last_update = now
+        self.last_update = self.last_checked = now
 
-    def make_grid(self, resolution, geom=None, conditions=None, obs_dates={}):
+    def make_grid(self, resolution, geom=None, conditions=None, obs_dates={},
+                  extent=None):
         """
         :param resolution: length of side of grid square in meters
         :type resolution: int
@@ -300,36 +375,115 @@ class MetaTable(Base):
         :param conditions: conditions on columns to filter on
         :type conditions: list of SQLAlchemy binary operations
                           (e.g. col > value)
-        :return: grid: result proxy with all result rows
+        :param extent: only count points intersecting this geometry (SRID 4326)
+        :type extent: SQLAlchemy geometry expression
+        :return: grid: subquery of (count, cell), where cell is the envelope
+                       of the grid square as a geometry
                  size_x, size_y: the horizontal and vertical size
                                     of the grid squares in degrees
         """
         if conditions is None:
             conditions = []
 
+        size_x, size_y = self.grid_cell_size(resolution)
+
+        # Counts limited only by date can come from the pyramid.
+        if not conditions and not geom and obs_dates and \
+                resolution in GRID_PYRAMID_RESOLUTIONS and self.has_pyramid():
+            squares = self._pyramid_squares(resolution, size_x, size_y,
+                                            obs_dates, extent)
+        else:
+            squares = None
+
+        if squares is None:
+            squares = self._live_squares(size_x, size_y, geom, conditions,
+                                         obs_dates, extent)
+
+        # Grow each corner into its square, in the database rather than
+        # row by row in Python.
+        squares = squares.alias('squares')
+        cell = grid_cell(squares.c.squares, size_x, size_y)
+        grid = select([squares.c.count, cell.label('cell')]).alias('grid')
+
+        return grid, size_x, size_y
+
+    def grid_cell_size(self, resolution):
+        """
+        :param resolution: length of side of grid square in meters
+        :return: size_x, size_y: the horizontal and vertical size
+                                 of the grid squares in degrees
+        """
         # We need to convert resolution (given in meters) to degrees
         # - which is the unit of measure for EPSG 4326 -
         # - in order to generate our grid.
         center = self.get_bbox_center()
         # center[1] is longitude
-        size_x, size_y = get_size_in_degrees(resolution, center[1])
+        return get_size_in_degrees(resolution, center[1])
 
+    def _live_squares(self, size_x, size_y, geom=None, conditions=(),
+                      obs_dates={}, extent=None):
         # Generate a count for each resolution by resolution square
         t = self.point_table
-        q = session.query(func.count(t.c.hash),
-                          func.ST_SnapToGrid(t.c.geom, size_x, size_y)
-                          .label('squares'))\
-            .filter(*conditions)\
-            .group_by('squares')
+        squares = grid_square(t.c.geom, size_x, size_y)
+        q = select([func.count(t.c.hash).label('count'),
+                    squares.label('squares')])\
+            .group_by(squares)
+
+        for condition in conditions:
+            q = q.where(condition)
 
         if obs_dates:
-            q = q.filter(t.c.point_date >= obs_dates['lower'])
-            q = q.filter(t.c.point_date <= obs_dates['upper'])
+            q = q.where(t.c.point_date >= obs_dates['lower'])
+            q = q.where(t.c.point_date <= obs_dates['upper'])
 
         if geom:
-            q = q.filter(t.c.geom.ST_Within(func.ST_GeomFromGeoJSON(geom)))
+            q = q.where(t.c.geom.ST_Within(func.ST_GeomFromGeoJSON(geom)))
+
+        if extent is not None:
+            # Count every point of the squares overlapping the extent, the
+            # same as the pyramid does. The first condition is only there
+            # to use the index.
+            q = q.where(t.c.geom.ST_Intersects(
+                func.ST_Expand(extent, max(size_x, size_y))))
+            q = q.where(func.ST_Intersects(grid_cell(squares, size_x, size_y), extent))
+
+        return q
 
-        return session.execute(q), size_x, size_y
+    def _pyramid_squares(self, resolution, size_x, size_y, obs_dates, extent=None):
+        """
+        Square counts summed from the pyramid's whole days, plus live counts
+        for the days at either end that are only partly covered.
+
+        :return: select of (count, squares), or None if the date range has
+                 no whole days in it
+        """
+        first_day, last_day = _day_span(obs_dates['lower'], obs_dates['upper'])
+        if first_day >= last_day:
+            return None
+
+        p = self.pyramid_table
+        # Untyped, so geoalchemy doesn't wrap it in ST_AsEWKB when it's
+        # selected from the union.
+        square = sa.type_coerce(p.c.cell, NullType)
+        whole_days = select([p.c.count, square.label('squares')])\
+            .where(sa.and_(p.c.resolution == resolution,
+                           p.c.day >= first_day,
+                           p.c.day < last_day))
+        if extent is not None:
+            # Keep every square that overlaps the extent.
+            whole_days = whole_days.where(
+                func.ST_Intersects(grid_cell(p.c.cell, size_x, size_y), extent))
+
+        t = self.point_table
+        partial_days = self._live_squares(size_x, size_y, conditions=[sa.or_(
+            sa.and_(t.c.point_date >= obs_dates['lower'], t.c.point_date < first_day),
+            sa.and_(t.c.point_date >= last_day, t.c.point_date <= obs_dates['upper'])
+        )], extent=extent)
+
+        squares = sa.union_all(whole_days, partial_days).alias('pyramid')
+        return select([sa.cast(func.sum(squares.c.count), sa.BigInteger).label('count'),
+                       squares.c.squares])\
+            .group_by(squares.c.squares)
 
 
     # Return select statement to execute or union
@@ -351,6 +505,30 @@ class MetaTable(Base):
                            day_generator.label('time_bucket')])\
             .alias('defaults')
 
+        # Without any filters the counts can come from the daily rollup.
+        if geom is None and column_filters is None and self.has_rollup():
+            actuals = self._rollup_counts(agg_unit, start, end)
+        else:
+            actuals = self._live_counts(agg_unit, start, end, geom, column_filters)
+
+        # Need to alias to make it usable in a subexpression
+        actuals = actuals.alias('actuals')
+
+        # Outer join the default and observed values
+        # to create the timeseries select statement.
+        # If no observed value in a bucket, use the default.
+        name = sa.literal_column("'{}'".format(self.dataset_name))\
+            .label('dataset_name')
+        bucket = defaults.c.time_bucket.label('time_bucket')
+        count = func.coalesce(actuals.c.count, defaults.c.count).label('count')
+        ts = select([name, bucket, count]).\
+            select_from(defaults.outerjoin(actuals, actuals.c.time_bucket == defaults.c.time_bucket))
+
+        return ts
+
+    def _live_counts(self, agg_unit, start, end, geom=None, column_filters=None):
+        t = self.point_table
+
         where_filters = [t.c.point_date >= start, t.c.point_date <= end]
         if column_filters is not None:
             # Column filters has to be iterable here, because the '+' operator
@@ -372,20 +550,38 @@ class MetaTable(Base):
             contains = func.ST_Within(t.c.geom, func.ST_GeomFromGeoJSON(geom))
             actuals = actuals.where(contains)
 
-        # Need to alias to make it usable in a subexpression
-        actuals = actuals.alias('actuals')
+        return actuals
 
-        # Outer join the default and observed values
-        # to create the timeseries select statement.
-        # If no observed value in a bucket, use the default.
-        name = sa.literal_column("'{}'".format(self.dataset_name))\
-            .label('dataset_name')
-        bucket = defaults.c.time_bucket.label('time_bucket')
-        count = func.coalesce(actuals.c.count, defaults.c.count).label('count')
-        ts = select([name, bucket, count]).\
-            select_from(defaults.outerjoin(actuals, actuals.c.time_bucket == defaults.c.time_bucket))
+    def _rollup_counts(self, agg_unit, start, end):
+        """
+        Bucket counts built from the daily rollup. Days only partly covered
+        by [start, end] are counted from the point table, which is cheap
+        because the point_date index narrows them down to a single day each.
+        """
+        first_day, last_day = _day_span(start, end)
+        if first_day >= last_day:
+            # No whole days in the range, nothing to gain from the rollup.
+            return self._live_counts(agg_unit, start, end)
 
-        return ts
+        t = self.point_table
+        r = self.rollup_table
+
+        whole_days = select([r.c.count, r.c.day]).\
+            where(sa.and_(r.c.day >= first_day, r.c.day < last_day))
+
+        point_day = func.date_trunc('day', t.c.point_date)
+        partial_days = select([func.count(t.c.hash).label('count'),
+                               point_day.label('day')])\
+            .where(sa.or_(
+                sa.and_(t.c.point_date >= start, t.c.point_date < first_day),
+                sa.and_(t.c.point_date >= last_day, t.c.point_date <= end)))\
+            .group_by(point_day)
+
+        days = sa.union_all(whole_days, partial_days).alias('days')
+        bucket = func.date_trunc(agg_unit, days.c.day)
+        return select([sa.cast(func.sum(days.c.count), sa.BigInteger).label('count'),
+                       bucket.label('time_bucket')])\
+            .group_by(bucket)
 
     def timeseries_one(self, agg_unit, start, end, geom=None, column_filters=None):
         ts_select = self.timeseries(agg_unit, start, end, geom, column_filters)
@@ -397,6 +593,94 @@ class MetaTable(Base):
         return header + rows
 
 
+# (pid, ThreadPool) running timeseries queries for every request of this
+# process, so concurrent requests share TIMESERIES_WORKERS connections
+# rather than taking that many each.
+_timeseries_workers = None
+_timeseries_workers_lock = threading.Lock()
+
+
+def _timeseries_pool():
+    global _timeseries_workers
+    with _timeseries_workers_lock:
+        # Threads don't survive a fork, so each process starts its own.
+        if _timeseries_workers is None or _timeseries_workers[0] != os.getpid():
+            pool = ThreadPool(TIMESERIES_WORKERS)
+            atexit.register(_close_pool, pool)
+            _timeseries_workers = (os.getpid(), pool)
+        return _timeseries_workers[1]
+
+
+def _close_pool(pool):
+    pool.close()
+    pool.join()
+
+
+def grid_square(geom, size_x, size_y):
+    """
+    :param geom: point geometry (SRID 4326)
+    :param size_x, size_y: size of the grid squares in degrees
+    :returns: lower left corner of the grid square the point falls in.
+              Squares are lined up on (0, 0), so a point always lands in the
+              same square however it's selected.
+    """
+    x = func.floor(func.ST_X(geom) / size_x) * size_x
+    y = func.floor(func.ST_Y(geom) / size_y) * size_y
+    return func.ST_SetSRID(func.ST_MakePoint(x, y), 4326)
+
+
+def grid_cell(square, size_x, size_y):
+    """
+    :param square: corner of a grid square, from grid_square
+    :returns: the square, as an envelope
+    """
+    x, y = func.ST_X(square), func.ST_Y(square)
+    return func.ST_MakeEnvelope(x, y, x + size_x, y + size_y, 4326)
+
+
+def _fetch_with_timeout(query):
+    """
+    :param query: selectable to run on its own pooled connection
+
+    :returns: list of result rows, or None if the query hit
+              TIMESERIES_STATEMENT_TIMEOUT
+    """
+    with app_engine.connect() as conn:
+        try:
+            with conn.begin():
+                conn.execute('SET LOCAL statement_timeout = {:d}'.
+                             format(TIMESERIES_STATEMENT_TIMEOUT))
+                return conn.execute(query).fetchall()
+        except OperationalError as e:
+            # query_canceled, raised when the statement timeout kicks in
+            if getattr(e.orig, 'pgcode', None) == '57014':
+                return None
+            raise
+
+
+def _day_span(start, end):
+    """
+    :param start: date or datetime, inclusive
+    :param end: date or datetime, inclusive
+
+    :returns: datetimes bounding the whole days within [start, end], as a
+              half-open interval [first, last)
+    """
+    if not isinstance(start, datetime):
+        start = datetime.combine(start, time())
+    if not isinstance(end, datetime):
+        end = datetime.combine(end, time())
+
+    first = datetime.combine(start.date(), time())
+    if first < start:
+        first += timedelta(days=1)
+
+    # end is inclusive, so the day it falls on is only whole if it's the very
+    # last instant of that day, which never happens with TIMESTAMPs.
+    last = datetime.combine(end.date(), time())
+    return first, last
+
+
 class ShapeMetadata(Base):
     __tablename__ = 'meta_shape'
     dataset_name = Column(String, primary_key=True)
@@ -404,6 +688,14 @@ class ShapeMetadata(Base):
     source_url = Column(String)
     view_url = Column(String)
     date_added = Column(Date, nullable=False)
+    # When the shapes were last ingested
+    last_update = Column(DateTime)
+    # and when the source was last looked at
+    last_checked = Column(DateTime)
+    # ETag, Last-Modified and sha256 of the source file when last ingested
+    source_etag = Column(String)
+    source_last_modified = Column(String)
+    source_digest = Column(String(64))
 
     # Organization that published this dataset
     attribution = Column(String)
@@ -481,10 +773,7 @@ class ShapeMetadata(Base):
             name = dataset['dataset_name']
             try:
                 # Reflect up the shape table
-                table = Table(name,
-                              Base.metadata,
-                              autoload=True,
-                              extend_existing=True)
+                table = reflect_table(name)
             except NoSuchTableError:
                 # If that table doesn't exist (?!?!)
                 # don't try to form the fields.
@@ -573,14 +862,14 @@ class ShapeMetadata(Base):
 
     @property
     def shape_table(self):
-        try:
-            return self._shape_table
-        except AttributeError:
-            self._shape_table = Table(self.dataset_name, Base.metadata,
-                                      autoload=True, extend_existing=True)
-            return self._shape_table
+        return reflect_table(self.dataset_name)
 
     def remove_table(self):
+        """
+        Drop the shape table and delete this record, in the session's
+        transaction. Call schema_changed once it's committed, or other
+        workers may reflect the table again before it's gone.
+        """
         if self.is_ingested:
             drop = "DROP TABLE {};".format(self.dataset_name)
             session.execute(drop)
@@ -590,6 +879,7 @@ class ShapeMetadata(Base):
         self.is_ingested = True
         self.bbox = self._make_bbox()
         self.num_shapes = self._get_num_shapes()
+        self.last_update = self.last_checked = datetime.now()
 
     def _make_bbox(self):
         bbox_query = 'SELECT ST_Envelope(ST_Union(geom)) FROM {};'.\
@@ -652,4 +942,92 @@ class User(Base):
         return False
 
     def get_id(self):
-        return self.id
\ No newline at end of file
+        return self.id
+
+
+class SlowQuery(Base):
+    """A statement run for an API request which took longer than
+    SLOW_QUERY_THRESHOLD. Recorded by plenario.api.timing."""
+
+    __tablename__ = 'perf_slow_queries'
+    id = Column(Integer, primary_key=True)
+    recorded = Column(DateTime, default=datetime.now, nullable=False, index=True)
+    endpoint = Column(String(100))
+    # Datasets the request read, or NULL if none in particular.
+    dataset_names = Column(ARRAY(String))
+    cache_key = Column(String)
+    statement = Column(Text, nullable=False)
+    # JSON of the bind parameters.
+    parameters = Column(Text)
+    # Milliseconds.
+    duration = Column(sa.Float, nullable=False)
+    # EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) output, for a sample of them.
+    plan = Column(JSONB)
+
+    __table_args__ = (
+        # Backs dataset_names.contains([name]).
+        sa.Index('ix_perf_slow_queries_dataset_names', 'dataset_names',
+                 postgresql_using='gin'),
+    )
+
+    @classmethod
+    def for_dataset(cls, dataset_name):
+        """:returns: query of the slow statements of requests which read
+                     the dataset, along with any others"""
+
+        # Cast, or Postgres takes the list for a text[], which has no @> to
+        # compare with a varchar[].
+        names = sa.cast([dataset_name], ARRAY(String))
+        return session.query(cls).filter(cls.dataset_names.contains(names))
+
+    @classmethod
+    def worst_by_dataset(cls):
+        """:returns: rows of (dataset_name, count, worst and average duration)
+                     for every dataset, slowest first. A statement counts
+                     towards each dataset its request read."""
+
+        # One row per dataset of each statement, and a NULL one for those
+        # without any.
+        no_dataset = sa.cast(sa.literal_column("'{NULL}'"), ARRAY(String))
+        names = func.unnest(func.coalesce(cls.dataset_names, no_dataset))
+        per_dataset = select([names.label('dataset_name'), cls.id, cls.duration])\
+            .alias('per_dataset')
+
+        return session.query(per_dataset.c.dataset_name,
+                             func.count(per_dataset.c.id).label('count'),
+                             func.max(per_dataset.c.duration).label('worst'),
+                             func.avg(per_dataset.c.duration).label('average'))\
+            .group_by(per_dataset.c.dataset_name)\
+            .order_by(func.max(per_dataset.c.duration).desc())\
+            .all()
+
+
+# Registry changes
+# ================
+# The API keeps a per-worker copy of meta_master and meta_shape
+# (plenario.catalog). Any commit that touches those rows bumps the shared
+# version counter, which tells every worker to reload its copy.
+
+CATALOG_VERSION = 'catalog'
+
+
+@sa.event.listens_for(session, 'before_flush')
+def _note_registry_changes(session_, flush_context, instances):
+    touched = chain(session_.new, session_.dirty, session_.deleted)
+    if any(isinstance(obj, (MetaTable, ShapeMetadata)) for obj in touched):
+        session_.info['registry_changed'] = True
+
+
+@sa.event.listens_for(session, 'after_commit')
+def _bump_catalog_version(session_):
+    if session_.info.pop('registry_changed', False):
+        try:
+            bump_version(CATALOG_VERSION)
+        except RedisError as e:
+            # Workers will still pick up the change once their copy expires.
+            print 'Failed to bump catalog version: {!r}'.format(e)
+
+
+@sa.event.listens_for(session, 'after_rollback')
+def _forget_registry_changes(session_):
+    session_.info.pop('registry_changed', None)
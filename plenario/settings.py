@@ -17,6 +17,40 @@ DATABASE_CONN = 'postgresql://{}:{}@{}:{}/{}'.\
 
 REDIS_HOST = get('REDIS_HOST', 'localhost')
 
+# Connections each process keeps open to the database, and how many more it
+# may open when those are all checked out.
+DB_POOL_SIZE = int(get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(get('DB_MAX_OVERFLOW', 10))
+
+# Number of datasets whose timeseries are queried at once, and how long (ms)
+# any one of them may run before it's dropped from the panel. The workers
+# are shared by every request of a process, and each holds a connection, so
+# keep this below DB_POOL_SIZE + DB_MAX_OVERFLOW.
+TIMESERIES_WORKERS = int(get('TIMESERIES_WORKERS', 4))
+TIMESERIES_STATEMENT_TIMEOUT = int(get('TIMESERIES_STATEMENT_TIMEOUT', 10000))
+
+# /grid resolutions (meters) whose per-day cell counts are precomputed
+# by the point ETL.
+GRID_PYRAMID_RESOLUTIONS = [int(r) for r in
+                            get('GRID_PYRAMID_RESOLUTIONS', '250,500,1000').split(',')]
+
+# When set, the point ETL infers the column types of a new dataset from a
+# sample of this many rows instead of every row in the file.
+INFERENCE_SAMPLE_ROWS = int(get('INFERENCE_SAMPLE_ROWS', 0)) or None
+
+# Seconds a worker trusts its copy of the dataset registry without
+# hearing about a change.
+CATALOG_MAX_AGE = int(get('CATALOG_MAX_AGE', 300))
+
+# The cache warmer replays the WARMER_QUERIES most frequent API queries of
+# the last WARMER_WINDOW days, WARMER_CONCURRENCY at a time.
+WARMER_QUERIES = int(get('WARMER_QUERIES', 50))
+WARMER_CONCURRENCY = int(get('WARMER_CONCURRENCY', 4))
+WARMER_WINDOW = int(get('WARMER_WINDOW', 7))
+# ETL runs ask for a warm WARMER_DELAY seconds after they finish, and a
+# burst of them (ex. the daily updates) gets one warm once it's over.
+WARMER_DELAY = int(get('WARMER_DELAY', 300))
+
 # See: https://pythonhosted.org/Flask-Cache/#configuring-flask-cache
 # for config options
 CACHE_CONFIG = {
@@ -25,6 +59,27 @@ CACHE_CONFIG = {
     'CACHE_KEY_PREFIX': get('CACHE_KEY_PREFIX', 'plenario_app')
 }
 
+# Seconds to keep API responses. Point and shape responses are dropped by
+# the ETL when a dataset they read is updated, so this can be raised safely
+# for them; weather responses rely on it alone.
+CACHE_TIMEOUT = int(get('CACHE_TIMEOUT', 60*60*6))
+
+# Seconds that responses of frequently hit endpoints (the landing page
+# timeseries and /datasets) are still served after CACHE_TIMEOUT, while they
+# are refreshed in the background.
+CACHE_STALE_TIMEOUT = int(get('CACHE_STALE_TIMEOUT', 60*60*24))
+
+# Log the timing of every API request to standard error, as JSON. Off by
+# default, it's a line per request.
+TIMING_LOG = get('TIMING_LOG', 'false').lower() == 'true'
+
+# API statements slower than SLOW_QUERY_THRESHOLD (ms) are saved to
+# perf_slow_queries. SLOW_QUERY_EXPLAIN_RATE of them are run again under
+# EXPLAIN (ANALYZE, BUFFERS), for at most SLOW_QUERY_EXPLAIN_TIMEOUT (ms).
+SLOW_QUERY_THRESHOLD = int(get('SLOW_QUERY_THRESHOLD', 1000))
+SLOW_QUERY_EXPLAIN_RATE = float(get('SLOW_QUERY_EXPLAIN_RATE', 0.1))
+SLOW_QUERY_EXPLAIN_TIMEOUT = int(get('SLOW_QUERY_EXPLAIN_TIMEOUT', 60000))
+
 # Load a default admin
 DEFAULT_USER = {
     'name': get('DEFAULT_USER_NAME'),
@@ -6,11 +6,14 @@ from sqlalchemy.exc import NoSuchTableError, InternalError
 
 from plenario.celery_app import celery_app
 from plenario.database import session as session, app_engine as engine
+from plenario.etl.common import invalidate_cached_responses
 from plenario.etl.shape import ShapeETL
 from plenario.models import MetaTable, ShapeMetadata
-from plenario.settings import CELERY_SENTRY_URL
+from plenario.settings import CELERY_SENTRY_URL, WARMER_DELAY
 from plenario.etl.point import PlenarioETL
+from plenario.utils.model_helpers import schema_changed
 from plenario.utils.weather import WeatherETL
+from plenario.warmer import warm, postpone_warming, seconds_until_warming
 
 if CELERY_SENTRY_URL:
     handler = SentryHandler(CELERY_SENTRY_URL)
@@ -23,6 +26,9 @@ def delete_dataset(self, source_url_hash):
     try:
         dat_table = md.point_table
         dat_table.drop(engine, checkfirst=True)
+        md.rollup_table.drop(engine, checkfirst=True)
+        md.pyramid_table.drop(engine, checkfirst=True)
+        schema_changed()
     except NoSuchTableError:
         # Move on so we can get rid of the metadata
         pass
@@ -31,6 +37,8 @@ def delete_dataset(self, source_url_hash):
         session.commit()
     except InternalError, e:
         raise delete_dataset.retry(exc=e)
+    invalidate_cached_responses(md.dataset_name)
+    schedule_warm_cache()
     return 'Deleted {0} ({1})'.format(md.human_name, md.source_url_hash)
 
 
@@ -50,6 +58,7 @@ def add_dataset(self, source_url_hash, data_types=None):
 
     etl = PlenarioETL(md)
     etl.add()
+    schedule_warm_cache()
     return 'Finished adding {0} ({1})'.format(md.human_name, md.source_url_hash)
 
 
@@ -63,6 +72,7 @@ def add_shape(self, table_name):
 
     # Ingest the shapefile
     ShapeETL(meta=meta).add()
+    schedule_warm_cache()
     return 'Finished adding shape dataset {} from {}.'.format(meta.dataset_name,
                                                               meta.source_url)
 
@@ -75,8 +85,9 @@ def update_shape(self, table_name):
     meta.celery_task_id = self.request.id
     session.commit()
 
-    # Update the shapefile
-    ShapeETL(meta=meta).update()
+    # Update the shapefile, nothing to warm if it hadn't changed
+    if ShapeETL(meta=meta).update():
+        schedule_warm_cache()
     return 'Finished updating shape dataset {} from {}.'.\
         format(meta.dataset_name, meta.source_url)
 
@@ -86,6 +97,9 @@ def delete_shape(self, table_name):
     shape_meta = session.query(ShapeMetadata).get(table_name)
     shape_meta.remove_table()
     session.commit()
+    schema_changed()
+    invalidate_cached_responses(table_name)
+    schedule_warm_cache()
     return 'Removed {}'.format(table_name)
 
 
@@ -121,10 +135,36 @@ def update_dataset(self, source_url_hash):
             .where(MetaTable.source_url_hash == source_url_hash)\
             .values(result_ids=ids))
     etl = PlenarioETL(md)
-    etl.update()
+    if etl.update():
+        schedule_warm_cache()
     return 'Finished updating {0} ({1})'.format(md.human_name, md.source_url_hash)
 
 
+@celery_app.task
+def warm_cache(debounced=False):
+    """Replay the most frequent API queries, to rebuild the cached responses
+    an ETL run or a cache flush just threw away.
+
+    :param debounced: scheduled by schedule_warm_cache, so wait until no
+                      ETL run has asked for a warm for WARMER_DELAY seconds"""
+    if debounced:
+        wait = seconds_until_warming()
+        if wait > 0:
+            warm_cache.apply_async(kwargs={'debounced': True}, countdown=wait)
+            return 'Postponed for {:.0f}s'.format(wait)
+    report = warm()
+    print 'Warmed {queries} queries, p50 {p50}s, p95 {p95}s, p99 {p99}s, ' \
+          '{failed_count} failed'.format(failed_count=len(report['failed']), **report)
+    return report
+
+
+def schedule_warm_cache():
+    """Warm the cache once the ETL runs finishing around now are all done,
+    rather than after each one."""
+    if postpone_warming():
+        warm_cache.apply_async(kwargs={'debounced': True}, countdown=WARMER_DELAY)
+
+
 @celery_app.task
 def update_metar():
     print "update_metar()"
@@ -1,8 +1,10 @@
+import random
 import re
+from itertools import izip
 from unicodedata import normalize
 import string
 from csvkit.unicsv import UnicodeCSVReader
-from plenario.utils.typeinference import normalize_column_type
+from plenario.utils.typeinference import ColumnTypeInference
 import boto3
 from plenario.settings import MAIL_USERNAME, ADMIN_EMAILS, \
     AWS_ACCESS_KEY, AWS_SECRET_KEY, AWS_REGION_NAME
@@ -26,48 +28,67 @@ def get_size_in_degrees(meters, latitude):
 ColumnInfo = namedtuple('ColumnInfo', 'name type_ has_nulls')
 
 
-def infer_csv_columns(inp):
+def infer_csv_columns(inp, sample_rows=None):
     """
+    Infer the type of every column in one pass over the CSV.
 
     :param inp: File handle to a CSV dataset
                 that we can throw into a UnicodeCSVReader
+    :param sample_rows: if given, infer from a uniform sample of at most
+                        this many rows rather than all of them. Quicker on
+                        huge files, but a value the sample missed can turn
+                        out not to fit the inferred type.
     :return: List of `ColumnInfo`s
     """
-    reader = UnicodeCSVReader(inp)
-    header = reader.next()
-    inp.seek(0)
-    iter_output = [iter_column(col_idx, inp)
-                   for col_idx in range(len(header))]
-
-    return [ColumnInfo(name, type_, has_nulls)
-            for name, (type_, has_nulls) in zip(header, iter_output)]
-
-
-def iter_column(idx, f):
+    def read_rows():
+        inp.seek(0)
+        reader = UnicodeCSVReader(inp)
+        header = reader.next()
+        return header, (row for row in reader if row)
+
+    header, rows = read_rows()
+    if sample_rows:
+        rows = reservoir_sample(rows, sample_rows)
+    columns = [ColumnTypeInference() for _ in header]
+
+    for row in rows:
+        # Short rows are bad data, their missing cells are left out.
+        for column, value in izip(columns, row):
+            column.add(value)
+
+    # Rarely, a column looks numeric for a long while and then doesn't.
+    rescan = [(i, column) for i, column in enumerate(columns) if column.needs_rescan]
+    if rescan:
+        if not sample_rows:
+            _, rows = read_rows()
+        for row in rows:
+            for i, column in rescan:
+                if i < len(row):
+                    column.rescan(row[i])
+
+    return [ColumnInfo(name, *column.result())
+            for name, column in zip(header, columns)]
+
+
+def reservoir_sample(iterable, k, seed=0):
     """
-
-    :param idx: index of column
-    :param f: gzip file object of CSV dataset
-    :return: col_type, null_values
-             where col_type is inferred type from typeinference.py
-             and null_values is whether null values were found and normalized.
+    :param iterable: items to sample from, read once
+    :param k: size of the sample
+    :param seed: random seed, the same one always picks the same items
+    :return: list of at most k items, each one as likely as the next to be
+             in it, in the order they came in
     """
-    f.seek(0)
-    reader = UnicodeCSVReader(f)
-
-    # Discard the header
-    reader.next()
-
-    col = []
-    for row in reader:
-        if row:
-            try:
-                col.append(row[idx])
-            except IndexError:
-                # Bad data. Maybe we can fill with nulls?
-                pass
-    col_type, null_values = normalize_column_type(col)
-    return col_type, null_values
+    rng = random.Random(seed)
+    sample = []
+    for i, item in enumerate(iterable):
+        if i < k:
+            sample.append((i, item))
+        else:
+            j = rng.randint(0, i)
+            if j < k:
+                sample[j] = (i, item)
+    sample.sort(key=lambda pair: pair[0])
+    return [item for _, item in sample]
 
 
 def slugify(text, delim=u'_'):
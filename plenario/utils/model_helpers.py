@@ -1,9 +1,14 @@
 """model_helpers: Just a collection of functions which perform common
 interactions with the models."""
 
+import threading
+
+from flask import g, has_request_context
+from redis import RedisError
+from sqlalchemy import Table
 from sqlalchemy.exc import ProgrammingError
 
-from plenario.database import app_engine
+from plenario.database import app_engine, Base, get_version, bump_version
 
 
 def table_exists(table_name):
@@ -18,3 +23,72 @@ def table_exists(table_name):
         return True
     except ProgrammingError:
         return False
+
+
+# Reflected tables
+# ================
+# Reflecting a table costs a handful of catalog queries, so reflected Table
+# objects are kept for the life of the process. They're tagged with the
+# schema version they were reflected under, which the ETL bumps through
+# schema_changed whenever it creates or drops a table.
+
+SCHEMA_VERSION = 'schema'
+
+_unset = object()
+_reflected = {}
+_reflected_lock = threading.Lock()
+
+
+def reflect_table(table_name):
+    """Reflect a table, reusing an earlier reflection while the schema
+    version hasn't changed.
+
+    :param table_name: (string) table name
+    :returns: (Table) reflected table
+    :raises: NoSuchTableError if the table doesn't exist"""
+
+    version = _schema_version()
+    cached = _reflected.get(table_name)
+    if version is not None and cached is not None and cached[0] == version:
+        return cached[1]
+
+    with _reflected_lock:
+        # Drop the stale definition rather than extend it, otherwise columns
+        # which have since been dropped would stick around.
+        if table_name in Base.metadata.tables:
+            Base.metadata.remove(Base.metadata.tables[table_name])
+        table = Table(table_name, Base.metadata,
+                      autoload=True, autoload_with=app_engine)
+        if version is not None:
+            _reflected[table_name] = (version, table)
+    return table
+
+
+def schema_changed():
+    """Tell every process to reflect its tables again. Call after creating,
+    altering or dropping a table that the API reads from."""
+
+    _reflected.clear()
+    try:
+        bump_version(SCHEMA_VERSION)
+    except RedisError as e:
+        print 'Failed to bump schema version: {!r}'.format(e)
+
+
+def _schema_version():
+    """:returns: the shared schema version, checked at most once per request,
+                 or None if it can't be read"""
+
+    if has_request_context():
+        version = getattr(g, 'schema_version', _unset)
+        if version is not _unset:
+            return version
+
+    try:
+        version = get_version(SCHEMA_VERSION)
+    except RedisError:
+        version = None
+
+    if has_request_context():
+        g.schema_version = version
+    return version
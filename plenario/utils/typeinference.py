@@ -1,4 +1,5 @@
 import datetime
+import re
 
 from dateutil.parser import parse
 from sqlalchemy import Boolean, Integer, BigInteger, Float, Date, \
@@ -15,6 +16,21 @@ DEFAULT_DATETIME = datetime.datetime(2999, 12, 31, 0, 0, 0)
 NULL_DATE = datetime.date(2999, 12, 31)
 NULL_TIME = datetime.time(0, 0, 0)
 
+# The formats nearly every dataset uses, which are parsed without dateutil.
+# 2015-01-31, 2015-01-31 13:45, 2015-01-31T13:45:30.123
+ISO_DATETIME = re.compile(r'(\d{4})-(\d\d)-(\d\d)'
+                          r'(?:[T ](\d\d):(\d\d)(?::(\d\d)(?:\.(\d{1,6}))?)?)?\Z')
+# Socrata exports: 01/31/2015, 01/31/2015 01:45:30 PM
+US_DATETIME = re.compile(r'(\d\d?)/(\d\d?)/(\d{4})'
+                         r'(?: (\d\d?):(\d\d)(?::(\d\d))?(?: ?([AaPp][Mm]))?)?\Z')
+# 13:45, 1:45:30 pm
+TIME_OF_DAY = re.compile(r'(\d\d?):(\d\d)(?::(\d\d))?(?: ?([AaPp][Mm]))?\Z')
+
+
+# Values a column holds back from the datetime check while it still looks
+# like booleans or numbers, see ColumnTypeInference.
+PENDING_LIMIT = 10000
+
 
 def normalize_column_type(l):
     """
@@ -27,126 +43,241 @@ def normalize_column_type(l):
              and null_values is a boolean
              representing whether nulls of any kind were detected.
     """
-    
-    null_values = False
+    inference = ColumnTypeInference()
+    for x in l:
+        inference.add(x)
+    if inference.needs_rescan:
+        for x in l:
+            inference.rescan(x)
+    return inference.result()
+
+
+def parse_datetime(x):
+    """
+    Parse a date, time or datetime the way
+    dateutil.parser.parse(x, default=DEFAULT_DATETIME) does, only quicker
+    for ISO 8601 and Socrata formatted values.
+
+    :param x: string
+    :return: datetime
+    :raises: ValueError, TypeError or OverflowError if it isn't one
+    """
+    d = parse_common_datetime(x)
+    if d is None:
+        d = parse(x, default=DEFAULT_DATETIME)
+    return d
+
+
+def parse_common_datetime(x):
+    """
+    :return: datetime, or None to leave x to dateutil
+    """
+    match = ISO_DATETIME.match(x)
+    if match:
+        year, month, day, hour, minute, second, fraction = match.groups()
+        microsecond = int(fraction.ljust(6, '0')) if fraction else 0
+        return _make_datetime(int(year), int(month), int(day),
+                              hour, minute, second, microsecond)
+
+    match = US_DATETIME.match(x)
+    if match:
+        month, day, year, hour, minute, second, ampm = match.groups()
+        if ampm is not None:
+            hour = _clock_hour(hour, ampm)
+            if hour is None:
+                return None
+        return _make_datetime(int(year), int(month), int(day),
+                              hour, minute, second)
+
+    match = TIME_OF_DAY.match(x)
+    if match:
+        hour, minute, second, ampm = match.groups()
+        if ampm is not None:
+            hour = _clock_hour(hour, ampm)
+            if hour is None:
+                return None
+        return _make_datetime(DEFAULT_DATETIME.year, DEFAULT_DATETIME.month,
+                              DEFAULT_DATETIME.day, hour, minute, second)
+    return None
 
-    # Convert "NA", "N/A", etc. to null types.
-    for i, x in enumerate(l):
-        if x is not None and x.lower() in NULL_VALUES:
-            l[i] = None
-            null_values = True
 
-    # Are they boolean?
+def _clock_hour(hour, ampm):
+    """
+    :return: hour of the day, or None when it's an odd one best left to
+             dateutil (ex. 0 PM)
+    """
+    hour = int(hour)
+    if not 1 <= hour <= 12:
+        return None
+    if ampm.lower() == 'am':
+        return 0 if hour == 12 else hour
+    return hour if hour == 12 else hour + 12
+
+
+def _make_datetime(year, month, day, hour=None, minute=None, second=None,
+                   microsecond=0):
+    """
+    :return: datetime, or None when a field is out of range, so that
+             dateutil gets to say what's wrong with it
+    """
     try:
-        for i, x in enumerate(l):
-            if x == '' or x is None:
-                raise ValueError('Not boolean')
-            elif x.lower() in TRUE_VALUES:
-                continue
-            elif x.lower() in FALSE_VALUES:
-                continue
-            else:
-                raise ValueError('Not boolean')
-
-        return Boolean, null_values
+        return datetime.datetime(year, month, day, int(hour or 0),
+                                 int(minute or 0), int(second or 0),
+                                 microsecond)
     except ValueError:
-        pass
+        return None
 
-    # Are they integers?
-    try:
-        normal_types_set = set()
-        add = normal_types_set.add
-        for i, x in enumerate(l):
-            if x == '' or x is None:
-                continue
-            
-            int_x = int(x.replace(',', ''))
 
+class ColumnTypeInference(object):
+    """
+    Guesses the type of a column the same way normalize_column_type does,
+    but is fed one value at a time, so that every column of a CSV can be
+    inferred in a single pass over it.
+
+    Each candidate type (boolean, integer, float, datetime) stays in the
+    running until a value doesn't fit it, and the column ends up with the
+    first one that's left, or String.
+
+    A column which looks numeric for more than PENDING_LIMIT distinct
+    values and then turns out not to be needs a second look at its values
+    for the datetime check: see needs_rescan.
+    """
+
+    def __init__(self):
+        self.null_values = False
+        self.boolean = True
+        self.integer = True
+        self.big_integer = False
+        self.float = True
+        self.temporal = True
+        self.temporal_types = set()
+        self.ampm = False
+
+        # Parsing datetimes is by far the slowest check, and its outcome
+        # only matters once the column can't be boolean or numeric. Until
+        # then, distinct values are held back here rather than parsed.
+        self.pending = set()
+        self.overflowed = False
+
+    def add(self, x):
+        """
+        :param x: value of the column in one row (a string or None)
+        """
+        if x is None or x.lower() in NULL_VALUES:
+            self.null_values = True
+            # Nulls fit every type but boolean.
+            self.boolean = False
+            return
+
+        if self.boolean:
+            lower = x.lower()
+            if lower not in TRUE_VALUES and lower not in FALSE_VALUES:
+                self.boolean = False
+
+        if self.integer:
+            self._add_integer(x)
+
+        if self.float:
+            try:
+                float(x.replace(',', ''))
+            except ValueError:
+                self.float = False
+
+        if not self.temporal or self.overflowed:
+            return
+        if self.boolean or self.float:
+            self.pending.add(x)
+            if len(self.pending) > PENDING_LIMIT:
+                # Too many to hold on to, rescan will go over them if need be.
+                self.overflowed = True
+                self.pending = set()
+            return
+        self._flush_pending()
+        self._add_temporal(x)
+
+    @property
+    def needs_rescan(self):
+        """
+        Whether every value has to be handed to rescan before result.
+        """
+        return self.overflowed and self.temporal \
+            and not (self.boolean or self.integer or self.float)
+
+    def rescan(self, x):
+        """
+        :param x: value of the column in one row, in a second pass
+        """
+        self.overflowed = False
+        if self.temporal and x is not None and x.lower() not in NULL_VALUES:
+            self._add_temporal(x)
+
+    def _add_integer(self, x):
+        try:
+            int_x = int(x.replace(',', ''))
+            # Integers padded with 0s are treated as strings.
             if x[0] == '0' and int(x) != 0:
-                raise TypeError('Integer is padded with 0s, so treat it as a string instead.')
-            if x.isspace():
-                raise TypeError('Integer is nothing but spaces so falling back to string')
-
-            if 9000000000000000000 > int_x > 1000000000:
-                add(BigInteger)
-            elif 1000000000 > int_x:
-                add(Integer)
-            else:
                 raise ValueError
+        except ValueError:
+            self.integer = False
+            return
 
-        if BigInteger in normal_types_set:
-            return BigInteger, null_values
-        else:
-            return Integer, null_values
+        if 9000000000000000000 > int_x > 1000000000:
+            self.big_integer = True
+        elif not 1000000000 > int_x:
+            self.integer = False
 
-    except TypeError:
-        pass
-    except ValueError:
-        pass
+    def _add_temporal(self, x):
+        try:
+            d = parse_datetime(x)
+        except (ValueError, TypeError, OverflowError):
+            # TypeError: https://bugs.launchpad.net/dateutil/+bug/1247643
+            self.temporal = False
+            self.pending = set()
+            return
 
-    # Are they floats?
-    try:
+        # Is it only a time?
+        if d.date() == NULL_DATE:
+            self.temporal_types.add(TIME)
+        # Is it only a date?
+        elif d.time() == NULL_TIME:
+            self.temporal_types.add(Date)
+        # It must be a date and time
+        else:
+            self.temporal_types.add(TIMESTAMP)
 
-        for i, x in enumerate(l):
-            if x == '' or x is None:
-                continue
+        lower = x.lower()
+        if 'am' in lower or 'pm' in lower:
+            self.ampm = True
 
-            float_x  = float(x.replace(',', ''))
+    def _flush_pending(self):
+        pending, self.pending = self.pending, set()
+        for x in pending:
+            if not self.temporal:
+                break
+            self._add_temporal(x)
 
-        return Float, null_values
-    except ValueError:
-        pass
+    def result(self):
+        """
+        :return: (col_type, null_values), like normalize_column_type
+        """
+        if self.boolean:
+            return Boolean, self.null_values
+        if self.integer:
+            return (BigInteger if self.big_integer else Integer), self.null_values
+        if self.float:
+            return Float, self.null_values
 
-    # Are they datetimes?
-    try:
-        normal_types_set = set()
-        add = normal_types_set.add
-        ampm = False
-        for i, x in enumerate(l):
-            if x == '' or x is None:
-                add(NoneType)
-                continue
- 
-            d = parse(x, default=DEFAULT_DATETIME)
- 
-            # Is it only a time?
-            if d.date() == NULL_DATE:
-                add(TIME)
-
-            # Is it only a date?
-            elif d.time() == NULL_TIME:
-                add(Date)
- 
-            # It must be a date and time
-            else:
-                add(TIMESTAMP)
-            
-            if 'am' in x.lower():
-                ampm = True
-            
-            if 'pm' in x.lower():
-                ampm = True
-
-            
-        normal_types_set.discard(NoneType)
- 
-        # If a mix of dates and datetimes, up-convert dates to datetimes
-        if normal_types_set == set([TIMESTAMP, Date]):
-            normal_types_set = set([TIMESTAMP])
-        # Datetimes and times don't mix -- fallback to using strings
-        elif normal_types_set == set([TIMESTAMP, TIME]):
-            normal_types_set = set([String])
-        # Dates and times don't mix -- fallback to using strings
-        elif normal_types_set == set([Date, TIME]):
-            normal_types_set = set([String])
-        elif normal_types_set == set([TIME]) and ampm:
-            normal_types_set = set([String])
- 
-        return normal_types_set.pop(), null_values
-    except ValueError:
-        pass
-    except TypeError: #https://bugs.launchpad.net/dateutil/+bug/1247643
-        pass
+        self._flush_pending()
+        if self.needs_rescan:
+            raise RuntimeError('Column has to be rescanned first.')
+        if self.temporal and self.temporal_types:
+            types = self.temporal_types
+            # If a mix of dates and datetimes, up-convert dates to datetimes
+            if types == {TIMESTAMP, Date}:
+                return TIMESTAMP, self.null_values
+            # Times only mix with other times, and not with am/pm
+            elif len(types) == 1 and not (types == {TIME} and self.ampm):
+                return next(iter(types)), self.null_values
 
-    # Don't know what they are, so they must just be strings 
-    return String, null_values
+        # Don't know what they are, so they must just be strings
+        return String, self.null_values
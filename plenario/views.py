@@ -1,7 +1,8 @@
 from flask import make_response, request, redirect, url_for, render_template, \
     Blueprint, flash, session as flask_session
-from plenario.models import MetaTable, User, ShapeMetadata
+from plenario.models import MetaTable, User, ShapeMetadata, SlowQuery
 from plenario.database import session, Base, app_engine as engine
+from plenario.etl.common import invalidate_cached_responses
 from plenario.utils.helpers import send_mail, slugify, infer_csv_columns
 from plenario.tasks import update_dataset as update_dataset_task, \
     delete_dataset as delete_dataset_task, add_dataset as add_dataset_task, \
@@ -596,6 +597,23 @@ def view_datasets():
                            shape_datasets=shape_datasets)
 
 
+@views.route('/admin/slow-queries')
+@login_required
+def slow_queries():
+    dataset_name = request.args.get('dataset_name')
+
+    if dataset_name:
+        q = SlowQuery.for_dataset(dataset_name)
+    else:
+        q = session.query(SlowQuery)
+    queries = q.order_by(SlowQuery.duration.desc()).limit(100).all()
+
+    return render_template('admin/slow-queries.html',
+                           datasets=SlowQuery.worst_by_dataset(),
+                           queries=queries,
+                           dataset_name=dataset_name)
+
+
 @views.route('/admin/dataset-status/')
 @login_required
 def dataset_status():
@@ -678,10 +696,12 @@ def edit_shape(dataset_name):
             'attribution': form.attribution.data,
             'update_freq': form.update_freq.data,
         }
-        session.query(ShapeMetadata)\
-            .filter(ShapeMetadata.dataset_name == meta.dataset_name)\
-            .update(upd)
+        # Set through the ORM rather than with a bulk update, so the
+        # commit tells every worker's catalog about the change.
+        for attr, value in upd.items():
+            setattr(meta, attr, value)
         session.commit()
+        invalidate_cached_responses(meta.dataset_name)
 
         if not meta.approved_status:
             approve_shape(dataset_name)
@@ -774,10 +794,12 @@ def edit_dataset(source_url_hash):
             'location': form.location.data,
             'observed_date': form.observed_date.data,
         }
-        session.query(MetaTable)\
-            .filter(MetaTable.source_url_hash == meta.source_url_hash)\
-            .update(upd)
+        # Set through the ORM rather than with a bulk update, so the
+        # commit tells every worker's catalog about the change.
+        for attr, value in upd.items():
+            setattr(meta, attr, value)
         session.commit()
+        invalidate_cached_responses(meta.dataset_name)
 
         if not meta.approved_status:
             approve_dataset(source_url_hash)
@@ -0,0 +1,189 @@
+"""
+Keeps the API cache warm with the queries people actually make.
+
+cached_response records the canonical key of every request it handles, along
+with a URL which reproduces it, in a redis sorted set per day. After an ETL
+run or a cache flush, warm() replays the most frequent of them through the
+app, so that whoever asks next doesn't have to wait on the query.
+
+    python -m plenario.warmer [number of queries]
+"""
+
+import json
+import math
+import sys
+import time
+from datetime import date, timedelta
+from multiprocessing.pool import ThreadPool
+from operator import itemgetter
+
+from redis import WatchError
+
+from plenario.database import redis_client
+from plenario.settings import CACHE_CONFIG, WARMER_QUERIES, WARMER_CONCURRENCY, \
+    WARMER_WINDOW, WARMER_DELAY
+
+# Set in the WSGI environ of replayed requests, which aren't counted as traffic.
+WARMING_ENVIRON_KEY = 'plenario.warming'
+
+
+def _base_key():
+    # Flushing the cache deletes every key starting with the cache prefix,
+    # and the traffic stats should outlive that.
+    return 'warmer:{}'.format(CACHE_CONFIG['CACHE_KEY_PREFIX'])
+
+
+def _day_keys(day):
+    base = '{}:{}'.format(_base_key(), day.isoformat())
+    return base + ':hits', base + ':urls'
+
+
+def record_query(key, url):
+    """Count a request for a cached endpoint.
+
+    :param key: canonical cache key of the request
+    :param url: path and query string which reproduce it"""
+
+    hits, urls = _day_keys(date.today())
+    ttl = WARMER_WINDOW * 24 * 60 * 60
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.zincrby(hits, 1, key)
+    pipe.hset(urls, key, url)
+    pipe.expire(hits, ttl)
+    pipe.expire(urls, ttl)
+    pipe.execute()
+
+
+def top_queries(n=WARMER_QUERIES):
+    """:returns: list of (url, hits) for the n most requested canonical keys
+                 over the last WARMER_WINDOW days, most requested first"""
+
+    today = date.today()
+    days = [_day_keys(today - timedelta(days=i)) for i in range(WARMER_WINDOW)]
+    union = _base_key() + ':top'
+
+    pipe = redis_client.pipeline()
+    pipe.zunionstore(union, [hits for hits, _ in days])
+    pipe.zrevrange(union, 0, n - 1, withscores=True)
+    pipe.delete(union)
+    _, top, _ = pipe.execute()
+
+    queries = []
+    for key, hits in top:
+        # Take the URL from the most recent day the key was seen on.
+        for _, urls in days:
+            url = redis_client.hget(urls, key)
+            if url is not None:
+                queries.append((url, int(hits)))
+                break
+    return queries
+
+
+def _debounce_keys():
+    base = _base_key()
+    return base + ':due', base + ':pending'
+
+
+def postpone_warming(delay=WARMER_DELAY):
+    """Ask for a warm delay seconds from now, pushing back one that's
+    already pending.
+
+    :returns: whether none was pending, so the caller has to schedule it"""
+
+    due, pending = _debounce_keys()
+    pipe = redis_client.pipeline()
+    pipe.set(due, time.time() + delay)
+    # Expires in case the task that was to clear it never runs.
+    # Redis won't take an expiry of 0, for a warm that's due now.
+    pipe.set(pending, 1, nx=True, ex=max(1, delay * 2))
+    return bool(pipe.execute()[1])
+
+
+def seconds_until_warming():
+    """Called by the pending warm when it runs.
+
+    :returns: seconds until it's due, after being pushed back since it was
+              scheduled, or 0 if it's due now, in which case it's no
+              longer pending"""
+
+    due, pending = _debounce_keys()
+    with redis_client.pipeline() as pipe:
+        while True:
+            try:
+                # Should an ETL run postpone it in between, it has to
+                # either see this pending or find it postponed.
+                pipe.watch(due)
+                wait = float(pipe.get(due) or 0) - time.time()
+                pipe.multi()
+                if wait > 0:
+                    pipe.expire(pending, int(wait) + max(1, WARMER_DELAY * 2))
+                else:
+                    pipe.delete(pending)
+                pipe.execute()
+                return max(wait, 0)
+            except WatchError:
+                continue
+
+
+def warm(app=None, n=WARMER_QUERIES, concurrency=WARMER_CONCURRENCY):
+    """Replay the most frequent queries against the app, at most concurrency
+    at a time. Responses which are still cached come right back, the rest
+    are built and cached as they would be for a user.
+
+    :param app: flask app to replay against, one is created if not given
+    :param n: number of queries to replay
+    :param concurrency: number of queries replayed at once
+    :returns: report dict, see summarize"""
+
+    if app is None:
+        from plenario import create_app
+        app = create_app()
+
+    def replay(query):
+        url, _ = query
+        client = app.test_client()
+        start = time.time()
+        resp = client.get(url, environ_base={WARMING_ENVIRON_KEY: True})
+        return url, time.time() - start, resp.status_code
+
+    queries = top_queries(n)
+    pool = ThreadPool(max(1, min(concurrency, len(queries))))
+    try:
+        results = pool.map(replay, queries)
+    finally:
+        pool.close()
+        pool.join()
+    return summarize(results)
+
+
+def summarize(results):
+    """:param results: list of (url, seconds, status code)
+    :returns: dict with the number of queries, the URLs which failed, latency
+              percentiles (seconds) over the ones which didn't and the five
+              slowest queries"""
+
+    times = sorted(seconds for _, seconds, status in results if status == 200)
+    report = {
+        'queries': len(results),
+        'failed': [url for url, _, status in results if status != 200],
+        'slowest': [(url, seconds) for url, seconds, _ in
+                    sorted(results, key=itemgetter(1), reverse=True)[:5]],
+    }
+    for p in (50, 95, 99):
+        report['p{}'.format(p)] = percentile(times, p)
+    return report
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of an already sorted list, or None if it's
+    empty."""
+
+    if not values:
+        return None
+    rank = int(math.ceil(p / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else WARMER_QUERIES
+    print json.dumps(warm(n=n), indent=2)
@@ -0,0 +1,22 @@
+from plenario.settings import DATABASE_CONN
+from sqlalchemy import create_engine
+
+
+def main():
+
+    # establish connection to provided database
+    engine = create_engine(DATABASE_CONN, convert_unicode=True)
+
+    # last_update now only moves when the data does, and ETags go by it.
+    # Until a dataset's next update, its last check was its last ingest.
+    for table in ('meta_master', 'meta_shape'):
+        engine.execute("ALTER TABLE {} ADD COLUMN last_checked timestamp;".format(table))
+        engine.execute("UPDATE {} SET last_checked = last_update;".format(table))
+
+    print('... done.')
+
+
+if __name__ == '__main__':
+
+    print "Connecting to {}".format(DATABASE_CONN)
+    main()
@@ -0,0 +1,20 @@
+from plenario.settings import DATABASE_CONN
+from plenario.models import SlowQuery
+from sqlalchemy import create_engine
+
+
+def main():
+
+    # establish connection to provided database
+    engine = create_engine(DATABASE_CONN, convert_unicode=True)
+
+    # Where the API records its slow statements, see plenario.api.timing.
+    SlowQuery.__table__.create(bind=engine, checkfirst=True)
+
+    print('... done.')
+
+
+if __name__ == '__main__':
+
+    print "Connecting to {}".format(DATABASE_CONN)
+    main()
@@ -0,0 +1,21 @@
+from plenario.settings import DATABASE_CONN
+from sqlalchemy import create_engine
+
+
+def main():
+
+    # establish connection to provided database
+    engine = create_engine(DATABASE_CONN, convert_unicode=True)
+
+    # Shapes ingested before the column existed count as last updated
+    # the day they were added.
+    engine.execute("ALTER TABLE meta_shape ADD COLUMN last_update timestamp;")
+    engine.execute("UPDATE meta_shape SET last_update = date_added WHERE is_ingested;")
+
+    print('... done.')
+
+
+if __name__ == '__main__':
+
+    print "Connecting to {}".format(DATABASE_CONN)
+    main()
@@ -0,0 +1,23 @@
+from plenario.settings import DATABASE_CONN
+from sqlalchemy import create_engine
+
+
+def main():
+
+    # establish connection to provided database
+    engine = create_engine(DATABASE_CONN, convert_unicode=True)
+
+    # Datasets ingested before the columns existed have no fingerprint,
+    # so their next update downloads the source in full and records one.
+    for table in ('meta_master', 'meta_shape'):
+        engine.execute("ALTER TABLE {} ADD COLUMN source_etag varchar;".format(table))
+        engine.execute("ALTER TABLE {} ADD COLUMN source_last_modified varchar;".format(table))
+        engine.execute("ALTER TABLE {} ADD COLUMN source_digest varchar(64);".format(table))
+
+    print('... done.')
+
+
+if __name__ == '__main__':
+
+    print "Connecting to {}".format(DATABASE_CONN)
+    main()
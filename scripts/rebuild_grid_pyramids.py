@@ -0,0 +1,25 @@
+from plenario.settings import DATABASE_CONN
+from plenario.database import session
+from plenario.etl.point import _refresh_pyramid
+from plenario.models import MetaTable
+
+
+def main():
+
+    # Pyramids used to key squares on the nearest grid point rather than
+    # the square a point falls in, and updates now only recount the days
+    # they change, so build each one over once.
+    for meta in session.query(MetaTable).filter(MetaTable.date_added != None):
+        if not meta.has_pyramid():
+            continue
+        print(meta.dataset_name)
+        _refresh_pyramid(meta, meta.point_table)
+        session.commit()
+
+    print('... done.')
+
+
+if __name__ == '__main__':
+
+    print "Connecting to {}".format(DATABASE_CONN)
+    main()
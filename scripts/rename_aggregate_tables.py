@@ -0,0 +1,35 @@
+from plenario.settings import DATABASE_CONN
+from sqlalchemy import create_engine
+
+
+def main():
+
+    # establish connection to provided database
+    engine = create_engine(DATABASE_CONN, convert_unicode=True)
+
+    engine.execute("ALTER TABLE meta_master ADD COLUMN rollup_built boolean;")
+    engine.execute("ALTER TABLE meta_master ADD COLUMN pyramid_built boolean;")
+
+    # Rollups and pyramids were named r_<dataset> and g_<dataset>, which a
+    # dataset's own name can be. Theirs have no hash column.
+    names = [name for name, in engine.execute("SELECT dataset_name FROM meta_master;")]
+    for old, new, flag in (('r_', '_r_', 'rollup_built'),
+                           ('g_', '_g_', 'pyramid_built')):
+        for name in names:
+            columns = engine.execute(
+                "SELECT column_name FROM information_schema.columns "
+                "WHERE table_name = %s;", old + name).fetchall()
+            if not columns or ('hash',) in columns:
+                continue
+            print(old + name)
+            engine.execute('ALTER TABLE "{}" RENAME TO "{}";'.format(old + name, new + name))
+            engine.execute("UPDATE meta_master SET {} = TRUE WHERE dataset_name = %s;".
+                           format(flag), name)
+
+    print('... done.')
+
+
+if __name__ == '__main__':
+
+    print "Connecting to {}".format(DATABASE_CONN)
+    main()
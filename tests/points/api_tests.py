@@ -1,9 +1,28 @@
 import json
 import os
+import threading
+import time
 import urllib
 from StringIO import StringIO
 import csv
-
+from collections import OrderedDict
+from datetime import datetime
+from uuid import uuid4
+
+import sqlalchemy as sa
+from flask import request, make_response
+from flask_cache import Cache
+
+from plenario import create_app
+from plenario.api import common, timing
+from plenario.api.common import canonical_cache_key, cached_response, unknown_object_json_handler
+from plenario.api.encoder import RowEncoder
+from plenario.api.point import tile_envelope
+from plenario.api.validator import validate, NoGeoJSONValidator, ValidatorResult
+from plenario.catalog import catalog
+from plenario.database import session
+from plenario.models import MetaTable, SlowQuery
+from plenario.warmer import top_queries, warm, postpone_warming, seconds_until_warming
 from tests.test_fixtures.base_test import BasePlenarioTest, fixtures_path
 
 # Filters
@@ -201,6 +220,53 @@ class PointAPITests(BasePlenarioTest):
         self.assertTrue('latitude' in attributes['properties'])
         self.assertTrue('longitude' in attributes['properties'])
 
+    def test_streamed_json_response(self):
+        query = '/v1/api/detail/?dataset_name=flu_shot_clinics&obs_date__ge=2013-09-22&obs_date__le=2013-10-1&stream=true'
+        resp = self.app.get(query)
+        self.assertTrue(resp.is_streamed)
+
+        response_data = json.loads(resp.data)
+        self.assertEqual(response_data['meta']['total'], 5)
+        self.assertEqual(len(response_data['objects']), 5)
+        self.assertNotIn('hash', response_data['objects'][0])
+
+    def test_streamed_csv_response(self):
+        query = '/v1/api/detail/?dataset_name=flu_shot_clinics&obs_date__ge=2013-09-22&obs_date__le=2013-10-1&data_type=csv&stream=true'
+        resp = self.app.get(query)
+
+        lines = [line for line in csv.reader(StringIO(resp.data))]
+        # One header line, 5 data lines
+        self.assertEqual(len(lines), 6)
+        self.assertTrue('latitude' in lines[0])
+        self.assertFalse('geom' in lines[0])
+
+    def test_page_token_continues_detail(self):
+        base = '/v1/api/detail/?dataset_name=flu_shot_clinics&obs_date__ge=2013-09-22&obs_date__le=2013-10-1'
+        first = json.loads(self.app.get(base + '&limit=3').data)
+        self.assertEqual(len(first['objects']), 3)
+        token = first['meta']['next_page_token']
+
+        second = json.loads(self.app.get(base + '&limit=3&page_token=' + token).data)
+        self.assertEqual(len(second['objects']), 2)
+        self.assertNotIn('next_page_token', second['meta'])
+
+        # Same five records as one page, no repeats and none skipped.
+        everything = json.loads(self.app.get(base).data)
+        self.assertEqual(first['objects'] + second['objects'], everything['objects'])
+
+    def test_bad_page_token(self):
+        query = '/v1/api/detail/?dataset_name=flu_shot_clinics&page_token=garbage'
+        resp = self.app.get(query)
+        self.assertEqual(resp.status_code, 400)
+
+    def test_streamed_geojson_response(self):
+        query = '/v1/api/detail/?dataset_name=flu_shot_clinics&obs_date__ge=2013-09-22&obs_date__le=2013-10-1&data_type=geojson&stream=true'
+        resp = self.app.get(query)
+
+        points = json.loads(resp.data)['features']
+        self.assertEqual(len(points), 5)
+        self.assertTrue('latitude' in points[0]['properties'])
+
     def test_space_filter(self):
         escaped_query_rect = get_loop_rect()
 
@@ -266,6 +332,52 @@ class PointAPITests(BasePlenarioTest):
         # And they were far enough apart to each get their own square.
         self.assertEqual(len(response_data['features']), 6)
 
+    def test_grid_mvt(self):
+        query = 'v1/api/grid/?obs_date__ge=2013-1-1&obs_date__le=2014-1-1' \
+                '&dataset_name=flu_shot_clinics&data_type=mvt&tile=9/131/190'
+        resp = self.app.get(query)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Content-Type'], 'application/vnd.mapbox-vector-tile')
+        self.assertTrue(len(resp.data) > 0)
+
+    def test_grid_mvt_requires_tile(self):
+        query = 'v1/api/grid/?dataset_name=flu_shot_clinics&data_type=mvt'
+        resp = self.app.get(query)
+        self.assertEqual(resp.status_code, 400)
+
+    def test_grid_pyramid_counts_match_live_counts(self):
+        meta = MetaTable.get_by_dataset_name('flu_shot_clinics')
+        # Starts and ends partway through a day, so the pyramid's counts
+        # are topped up with live ones.
+        obs_dates = {'lower': datetime(2013, 1, 1, 12), 'upper': datetime(2013, 12, 31, 6)}
+        # Cuts through the clinics around the Loop.
+        tile = sa.func.ST_Transform(tile_envelope(12, 1050, 1522), 4326)
+
+        def counts(squares):
+            squares = squares.alias('s')
+            rows = session.execute(sa.select([sa.func.ST_AsText(squares.c.squares),
+                                              squares.c.count]))
+            return sorted((square, int(count)) for square, count in rows)
+
+        for extent in (None, tile):
+            size_x, size_y = meta.grid_cell_size(500)
+            live = meta._live_squares(size_x, size_y, obs_dates=obs_dates, extent=extent)
+            pyramid = meta._pyramid_squares(500, size_x, size_y, obs_dates, extent)
+            self.assertEqual(counts(live), counts(pyramid))
+
+    def test_grid_takes_json_data_type(self):
+        query = 'v1/api/grid/?obs_date__ge=2013-1-1&obs_date__le=2014-1-1&dataset_name=flu_shot_clinics'
+        geojson = self.app.get(query)
+        resp = self.app.get(query + '&data_type=json')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data), json.loads(geojson.data))
+
+    def test_grid_mvt_rejects_bad_zoom(self):
+        for tile in ('-1/0/0', '31/0/0', '100000/0/0'):
+            query = 'v1/api/grid/?dataset_name=flu_shot_clinics&data_type=mvt&tile=' + tile
+            resp = self.app.get(query)
+            self.assertEqual(resp.status_code, 400, tile)
+
     # ===========
     # /timeseries
     # ===========
@@ -444,3 +556,265 @@ class PointAPITests(BasePlenarioTest):
         resp = self.app.get(query)
         response_data = json.loads(resp.data)
         self.assertTrue("Unused parameter value \"fake_column=fake\"" in response_data['meta']['message'])
+
+    def test_catalog_picks_up_registry_edits(self):
+        meta = MetaTable.get_by_dataset_name('flu_shot_clinics')
+        original_name = meta.human_name
+        self.assertEqual(catalog.point('flu_shot_clinics').human_name, original_name)
+
+        meta.human_name = 'Flu Shots, Renamed'
+        session.commit()
+        self.assertEqual(catalog.point('flu_shot_clinics').human_name, 'Flu Shots, Renamed')
+
+        meta.human_name = original_name
+        session.commit()
+
+    def test_catalog_picks_up_admin_edits(self):
+        app = create_app()
+        app.config.update(LOGIN_DISABLED=True, WTF_CSRF_ENABLED=False)
+        meta = MetaTable.get_by_dataset_name('flu_shot_clinics')
+        original = {'human_name': meta.human_name, 'description': meta.description,
+                    'attribution': meta.attribution, 'update_freq': meta.update_freq,
+                    'observed_date': meta.observed_date, 'latitude': meta.latitude,
+                    'longitude': meta.longitude, 'location': ''}
+        self.assertEqual(catalog.point('flu_shot_clinics').human_name, original['human_name'])
+
+        edited = dict(original, human_name='Flu Shots, Edited')
+        resp = app.test_client().post('/admin/edit-dataset/' + meta.source_url_hash, data=edited)
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(catalog.point('flu_shot_clinics').human_name, 'Flu Shots, Edited')
+
+        app.test_client().post('/admin/edit-dataset/' + meta.source_url_hash, data=original)
+        self.assertEqual(catalog.point('flu_shot_clinics').human_name, original['human_name'])
+
+    def test_admin_edits_change_etag(self):
+        app = create_app()
+        app.config.update(LOGIN_DISABLED=True, WTF_CSRF_ENABLED=False)
+        meta = MetaTable.get_by_dataset_name('flu_shot_clinics')
+        original = {'human_name': meta.human_name, 'description': meta.description,
+                    'attribution': meta.attribution, 'update_freq': meta.update_freq,
+                    'observed_date': meta.observed_date, 'latitude': meta.latitude,
+                    'longitude': meta.longitude, 'location': ''}
+        url = '/v1/api/fields/flu_shot_clinics'
+        etag = self.app.get(url).headers['ETag']
+        self.assertEqual(self.app.get(url, headers={'If-None-Match': etag}).status_code, 304)
+
+        edited = dict(original, human_name='Flu Shots, Edited')
+        app.test_client().post('/admin/edit-dataset/' + meta.source_url_hash, data=edited)
+        try:
+            resp = self.app.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.headers['ETag'], etag)
+        finally:
+            app.test_client().post('/admin/edit-dataset/' + meta.source_url_hash, data=original)
+
+    def test_equivalent_requests_share_cache_key(self):
+        fields = ('dataset_name__in', 'obs_date__ge', 'obs_date__le', 'agg')
+
+        def key(query_string):
+            with self.app.application.test_request_context('/v1/api/timeseries?' + query_string):
+                args = validate(NoGeoJSONValidator(only=fields), request.args.to_dict())
+                return canonical_cache_key(args)
+
+        self.assertEqual(
+            key('dataset_name__in=flu_shot_clinics,crimes&obs_date__ge=2013-01-01&obs_date__le=2014-01-01'),
+            key('obs_date__le=2014-1-1&obs_date__ge=2013/01/01&dataset_name__in=crimes,flu_shot_clinics&')
+        )
+        self.assertNotEqual(
+            key('dataset_name__in=crimes&obs_date__ge=2013-01-01'),
+            key('dataset_name__in=crimes&obs_date__ge=2013-01-02')
+        )
+
+    def test_equivalent_requests_get_the_same_response(self):
+        # The first one's cached, and the second one gets it as is.
+        first = self.app.get('/v1/api/detail/?dataset_name=flu_shot_clinics'
+                             '&obs_date__ge=2013-09-22&obs_date__le=2013-10-01')
+        second = self.app.get('/v1/api/detail/?obs_date__le=2013/10/1'
+                              '&obs_date__ge=2013-9-22&dataset_name=flu_shot_clinics')
+        self.assertEqual(json.loads(first.data), json.loads(second.data))
+        self.assertEqual(json.loads(first.data)['meta']['query']['obs_date__ge'], '2013-09-22')
+
+    def test_concurrent_misses_build_response_once(self):
+        builds = []
+
+        @cached_response(timeout=60)
+        def handler(args):
+            builds.append(1)
+            time.sleep(0.5)
+            return make_response('built', 200)
+
+        # Unique arguments, so nothing is cached yet.
+        args = ValidatorResult({'dataset': 'single_flight', 'nonce': str(uuid4())}, {}, [])
+
+        def make_request():
+            with self.app.application.test_request_context('/v1/api/single-flight'):
+                handler(args)
+
+        threads = [threading.Thread(target=make_request) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(builds), 1)
+
+    def test_responses_are_cached_by_other_backends(self):
+        builds = []
+
+        @cached_response(timeout=60)
+        def handler(args):
+            builds.append(1)
+            return make_response('built', 200)
+
+        args = ValidatorResult({'dataset': 'simple_cache', 'nonce': str(uuid4())}, {}, [])
+        redis_cache = common.cache
+        common.cache = Cache(config={'CACHE_TYPE': 'simple'})
+        common.cache.init_app(self.app.application)
+        try:
+            for _ in range(2):
+                with self.app.application.test_request_context('/v1/api/simple-cache'):
+                    handler(args)
+        finally:
+            common.cache = redis_cache
+        self.assertEqual(len(builds), 1)
+
+    def test_stale_response_is_served_while_refreshed(self):
+        builds = []
+
+        @cached_response(timeout=1, stale_timeout=60)
+        def handler(args):
+            builds.append(1)
+            return make_response('build {}'.format(len(builds)), 200)
+
+        args = ValidatorResult({'dataset': 'stale_refresh', 'nonce': str(uuid4())}, {}, [])
+
+        with self.app.application.test_request_context('/v1/api/stale-refresh'):
+            self.assertEqual(handler(args).data, 'build 1')
+            time.sleep(1.1)
+            # Past its timeout, the old response still comes back right away.
+            self.assertEqual(handler(args).data, 'build 1')
+
+        for _ in range(50):
+            if len(builds) == 2:
+                break
+            time.sleep(0.1)
+        self.assertEqual(len(builds), 2)
+
+        with self.app.application.test_request_context('/v1/api/stale-refresh'):
+            self.assertEqual(handler(args).data, 'build 2')
+
+    def test_warmer_replays_frequent_queries(self):
+        url = '/v1/api/timeseries/?obs_date__ge=2012-01-01&obs_date__le=2013-12-31&agg=month'
+        for _ in range(3):
+            self.app.get(url)
+
+        self.assertIn(url, [u for u, _ in top_queries(1000)])
+
+        report = warm(self.app.application, n=1000)
+        self.assertGreater(report['queries'], 0)
+        self.assertNotIn(url, report['failed'])
+        self.assertIsNotNone(report['p50'])
+
+    def test_warming_is_debounced(self):
+        # Clear whatever's pending from earlier tests.
+        postpone_warming(0)
+        seconds_until_warming()
+
+        # The first ETL run of a burst schedules the warm, later ones only
+        # push it back.
+        self.assertTrue(postpone_warming(60))
+        self.assertFalse(postpone_warming(120))
+        self.assertGreater(seconds_until_warming(), 60)
+
+        postpone_warming(0)
+        self.assertEqual(seconds_until_warming(), 0)
+        self.assertTrue(postpone_warming(60))
+        postpone_warming(0)
+        seconds_until_warming()
+
+    def test_timing_is_reported(self):
+        url = '/v1/api/detail/?dataset_name=flu_shot_clinics&obs_date__ge=2013-09-22&obs_date__le=2013-10-1'
+        resp = self.app.get(url)
+        self.assertIn('total;dur=', resp.headers['Server-Timing'])
+        self.assertNotIn('timing', json.loads(resp.data)['meta'])
+
+        resp = self.app.get(url + '&debug_timing=true')
+        meta = json.loads(resp.data)['meta']
+        self.assertIn('validate', meta['timing'])
+        self.assertIn('total', meta['timing'])
+        # It's not a column condition.
+        self.assertEqual(meta['message'], [])
+
+    def test_slow_queries_are_recorded(self):
+        SlowQuery.for_dataset('crimes').delete(synchronize_session=False)
+        session.commit()
+
+        threshold, rate = timing.SLOW_QUERY_THRESHOLD, timing.SLOW_QUERY_EXPLAIN_RATE
+        timing.SLOW_QUERY_THRESHOLD, timing.SLOW_QUERY_EXPLAIN_RATE = 0, 1
+        try:
+            self.app.get('/v1/api/detail/?dataset_name=crimes&obs_date__ge=2000-01-01&nonce=' + str(uuid4()))
+        finally:
+            timing.SLOW_QUERY_THRESHOLD, timing.SLOW_QUERY_EXPLAIN_RATE = threshold, rate
+
+        # They're saved on a thread of their own.
+        for _ in range(50):
+            recorded = SlowQuery.for_dataset('crimes').all()
+            if recorded:
+                break
+            session.rollback()
+            time.sleep(0.1)
+
+        self.assertTrue(recorded)
+        self.assertEqual(recorded[0].endpoint, 'api.detail')
+        self.assertTrue(any(r.plan for r in recorded))
+
+    def test_row_encoder_matches_json_dumps(self):
+        table = catalog.point('crimes').point_table
+        rows = session.query(table).limit(50).all()
+        names = [c.name for c in table.columns]
+
+        encoder = RowEncoder(table.columns, exclude=['geom'])
+        for row in rows:
+            expected = OrderedDict((n, v) for n, v in zip(names, row) if n != 'geom')
+            self.assertEqual(encoder.encode(row),
+                             json.dumps(expected, default=unknown_object_json_handler))
+
+    def test_detail_json_columnar(self):
+        url = '/v1/api/detail/?dataset_name=flu_shot_clinics&obs_date__ge=2013-09-22&obs_date__le=2013-10-1'
+        rows = json.loads(self.app.get(url).data)['objects']
+        columnar = json.loads(self.app.get(url + '&data_type=json_columnar').data)
+
+        self.assertEqual(columnar['meta']['total'], len(rows))
+        self.assertEqual([dict(zip(columnar['columns'], values)) for values in columnar['data']], rows)
+
+    def test_streamed_detail_json_columnar(self):
+        url = '/v1/api/detail/?dataset_name=flu_shot_clinics&obs_date__ge=2013-09-22&obs_date__le=2013-10-1&data_type=json_columnar'
+        buffered = json.loads(self.app.get(url).data)
+        streamed = json.loads(self.app.get(url + '&stream=true').data)
+
+        self.assertEqual(streamed['columns'], buffered['columns'])
+        self.assertEqual(streamed['data'], buffered['data'])
+
+    def test_gzipped_response_matches_plain(self):
+        from plenario.api.compression import gunzip
+        url = '/v1/api/timeseries/?obs_date__ge=2013-09-22&obs_date__le=2013-10-1&agg=day'
+        # The first request fills the cache, the second is served from it.
+        for _ in range(2):
+            plain = self.app.get(url)
+            gzipped = self.app.get(url, headers={'Accept-Encoding': 'gzip'})
+
+            self.assertNotIn('Content-Encoding', plain.headers)
+            self.assertEqual(gzipped.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(json.loads(gunzip(gzipped.data)), json.loads(plain.data))
+
+    def test_conditional_get(self):
+        url = '/v1/api/timeseries/?obs_date__ge=2013-09-22&obs_date__le=2013-10-1&agg=day'
+        resp = self.app.get(url)
+        etag, last_modified = resp.headers['ETag'], resp.headers['Last-Modified']
+
+        self.assertEqual(self.app.get(url, headers={'If-None-Match': etag}).status_code, 304)
+        self.assertEqual(self.app.get(url, headers={'If-Modified-Since': last_modified}).status_code, 304)
+        self.assertEqual(self.app.get(url, headers={'If-None-Match': 'W/"stale"'}).status_code, 200)
+        # Other arguments, other ETag.
+        other = self.app.get(url.replace('agg=day', 'agg=week'))
+        self.assertNotEqual(other.headers['ETag'], etag)
@@ -1,15 +1,30 @@
 from unittest import TestCase
-from plenario.database import session, app_engine
+from plenario.database import session, app_engine, redis_client, \
+    cache_generations, store_cache_entry, invalidate_cache_tags
 import sqlalchemy as sa
 from sqlalchemy import Table, Column, Integer, Date, Float, String, TIMESTAMP, MetaData, Text
 from sqlalchemy.exc import NoSuchTableError
 from geoalchemy2 import Geometry
+from csvkit.unicsv import UnicodeCSVReader
+from dateutil.parser import parse
+from plenario.etl.common import ETLFile, SourceFingerprint, SourceUnchanged, \
+    fetch_source, is_unchanged, record_fingerprint, source_fingerprint, \
+    streamed_url
+from plenario.etl.hashing import HashedCSV, UnhashableValue, _DigestSet, _text
 from plenario.etl.point import Staging, PlenarioETL
 import os
+import hashlib
 import json
+from StringIO import StringIO
 from datetime import date
 from init_db import init_meta
 from plenario.models import MetaTable
+from plenario.settings import CACHE_CONFIG
+from plenario.utils.helpers import infer_csv_columns
+from plenario.utils.model_helpers import reflect_table, schema_changed
+from plenario.utils.typeinference import normalize_column_type, parse_datetime, \
+    DEFAULT_DATETIME
+from tests.test_fixtures.base_test import canned_response, canned_responses
 
 pwd = os.path.dirname(os.path.realpath(__file__))
 fixtures_path = os.path.join(pwd, '../test_fixtures')
@@ -114,6 +129,31 @@ class StagingTableTests(TestCase):
             observed_names = self.extract_names(s_table.cols)
         self.assertEqual(set(observed_names), set(self.expected_radio_col_names))
 
+    def test_col_info_infer_matches_per_column_inference(self):
+        with open(self.radio_path) as f:
+            reader = UnicodeCSVReader(f)
+            reader.next()
+            rows = [row for row in reader if row]
+            f.seek(0)
+            inferred = infer_csv_columns(f)
+            f.seek(0)
+            sampled = infer_csv_columns(f, sample_rows=len(rows))
+
+        for i, column in enumerate(inferred):
+            values = [row[i] for row in rows if len(row) > i]
+            self.assertEqual((column.type_, column.has_nulls), normalize_column_type(values))
+        self.assertEqual(sampled, inferred)
+
+    def test_common_datetimes_parse_like_dateutil(self):
+        values = ['2015-01-31', '2015-01-31 13:45', '2015-01-31T13:45:30.25',
+                  '2015-01-31 00:00:00', '01/31/2015', '1/3/2015 12:05:00 AM',
+                  '01/31/2015 01:45:30 PM', '13:45', '1:45:30 pm', '12:00 am']
+        for value in values:
+            self.assertEqual(parse_datetime(value), parse(value, default=DEFAULT_DATETIME))
+
+        for value in ['2015-02-30', '13/31/2015', '25:00']:
+            self.assertRaises(ValueError, parse_datetime, value)
+
     def test_col_info_existing(self):
         with Staging(self.existing_meta, source_path=self.dog_path) as s_table:
             observed_col_names = self.extract_names(s_table.cols)
@@ -150,6 +190,99 @@ class StagingTableTests(TestCase):
             all_rows = session.execute(s_table.table.select()).fetchall()
         self.assertEqual(len(all_rows), 5)
 
+    def test_staging_hashes_match_database(self):
+        # Rows are hashed on their way into the staging table, the same way
+        # md5(CAST(row AS text)) would.
+        for meta, path in [(self.unloaded_meta, self.radio_path),
+                           (self.existing_meta, self.dog_path)]:
+            with Staging(meta, source_path=path) as s_table:
+                cols = ', '.join('"{}"'.format(c.name) for c in s_table.cols)
+                mismatched = session.execute(
+                    'SELECT count(*) FROM "{}" WHERE hash <> md5(CAST(ROW({}) AS text))'.
+                    format(s_table.name, cols)).scalar()
+            self.assertEqual(mismatched, 0)
+
+    def test_quoted_empty_values_are_left_to_the_database(self):
+        # COPY loads "" as an empty string rather than NULL.
+        source = HashedCSV(StringIO('name,note\r\nfoo,""\r\nbar,\r\n'), [_text, _text])
+        self.assertRaises(UnhashableValue, source.read)
+
+        source = HashedCSV(StringIO('name,note\r\nfoo,"a "" b"\r\nbar,\r\n'), [_text, _text])
+        self.assertEqual(source.rows, 0)
+        source.read()
+        self.assertEqual(source.rows, 2)
+
+    def test_streamed_staging_matches_downloaded_staging(self):
+        with open(self.dog_path, 'rb') as f:
+            body = f.read()
+        url = 'http://nightvale.gov/dogpark.csv'
+        self.existing_meta.source_url = url
+
+        with canned_responses(canned_response(body, gzipped=True)):
+            with ETLFile(source_url=url) as helper:
+                downloaded = helper.fingerprint
+
+        with canned_responses(canned_response(body, gzipped=True)) as calls:
+            staging = Staging(self.existing_meta)
+            with staging as s_table:
+                all_rows = session.execute(s_table.table.select()).fetchall()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(all_rows), 5)
+        self.assertEqual(staging.fingerprint, downloaded)
+
+    def test_stream_doesnt_start_unless_rows_can_be_hashed(self):
+        url = 'http://nightvale.gov/dogpark.csv'
+        self.existing_meta.source_url = url
+        staging = Staging(self.existing_meta)
+        staging._canonicals = lambda: None
+
+        with canned_responses() as calls:
+            self.assertFalse(staging._stream_hashed_table(url))
+        self.assertEqual(calls, [])
+
+    def test_update_skips_unchanged_source(self):
+        with open(self.dog_path, 'rb') as f:
+            body = f.read()
+        url = 'http://nightvale.gov/dogpark.csv'
+        self.existing_meta.source_url = url
+
+        with canned_responses(canned_response(body, headers={'ETag': '"v1"'})):
+            self.assertTrue(PlenarioETL(self.existing_meta).update())
+        self.assertEqual(self.existing_meta.source_etag, '"v1"')
+        last_update = self.existing_meta.last_update
+
+        # The server says it hasn't changed.
+        with canned_responses(canned_response('', status_code=304)) as calls:
+            self.assertFalse(PlenarioETL(self.existing_meta).update())
+        self.assertEqual(calls[0][1]['headers']['If-None-Match'], '"v1"')
+
+        # It doesn't know, but the content is the same.
+        with canned_responses(canned_response(body, headers={'ETag': '"v2"'})):
+            self.assertFalse(PlenarioETL(self.existing_meta).update())
+        session.rollback()
+        self.assertEqual(self.existing_meta.source_etag, '"v2"')
+        # Checked, but the data and so the ETags of its responses stay put.
+        self.assertGreater(self.existing_meta.last_checked, last_update)
+        self.assertEqual(self.existing_meta.last_update, last_update)
+
+        all_rows = session.execute(self.existing_table.select()).fetchall()
+        self.assertEqual(len(all_rows), 5)
+
+    def test_digest_set_drops_duplicates(self):
+        digests = _DigestSet(slots=4)
+        seen = set()
+        # Enough to grow the table a few times, with repeats.
+        for i in range(5000):
+            key = hashlib.md5(str(i % 3000)).digest()
+            self.assertEqual(digests.add(key), key not in seen)
+            seen.add(key)
+        self.assertEqual(len(digests), 3000)
+
+        # All zeroes marks an empty slot, but can still be added.
+        self.assertTrue(digests.add('\0' * 16))
+        self.assertFalse(digests.add('\0' * 16))
+        self.assertEqual(len(digests), 3001)
+
     def test_insert_data(self):
         etl = PlenarioETL(self.existing_meta, source_path=self.dog_path)
         etl.update()
@@ -222,6 +355,91 @@ class StagingTableTests(TestCase):
         session.close()
         new_table.drop(app_engine, checkfirst=True)
 
+    def test_new_table_has_daily_rollup(self):
+        drop_if_exists(self.unloaded_meta.dataset_name)
+
+        etl = PlenarioETL(self.unloaded_meta, source_path=self.radio_path)
+        new_table = etl.add()
+
+        self.assertTrue(self.unloaded_meta.has_rollup())
+        rollup = self.unloaded_meta.rollup_table
+        total = session.query(sa.func.sum(rollup.c.count)).scalar()
+        self.assertEqual(total, 5)
+
+        session.close()
+        new_table.drop(app_engine, checkfirst=True)
+        rollup.drop(app_engine, checkfirst=True)
+
+    def test_new_table_has_grid_pyramid(self):
+        drop_if_exists(self.unloaded_meta.dataset_name)
+
+        etl = PlenarioETL(self.unloaded_meta, source_path=self.radio_path)
+        new_table = etl.add()
+
+        self.assertTrue(self.unloaded_meta.has_pyramid())
+        pyramid = self.unloaded_meta.pyramid_table
+        totals = session.query(pyramid.c.resolution, sa.func.sum(pyramid.c.count))\
+            .group_by(pyramid.c.resolution).all()
+        self.assertTrue(len(totals) > 0)
+        self.assertTrue(all(total == 5 for _, total in totals))
+
+        session.close()
+        new_table.drop(app_engine, checkfirst=True)
+        pyramid.drop(app_engine, checkfirst=True)
+        self.unloaded_meta.rollup_table.drop(app_engine, checkfirst=True)
+
+    def test_reflected_tables_are_reused_until_schema_changes(self):
+        drop_if_exists(self.unloaded_meta.dataset_name)
+
+        etl = PlenarioETL(self.unloaded_meta, source_path=self.radio_path)
+        new_table = etl.add()
+
+        name = self.unloaded_meta.dataset_name
+        self.assertIs(reflect_table(name), reflect_table(name))
+        first = reflect_table(name)
+        schema_changed()
+        self.assertIsNot(reflect_table(name), first)
+
+        session.close()
+        new_table.drop(app_engine, checkfirst=True)
+
+    def test_etl_drops_cached_responses_for_dataset(self):
+        drop_if_exists(self.unloaded_meta.dataset_name)
+        name = self.unloaded_meta.dataset_name
+        prefix = CACHE_CONFIG['CACHE_KEY_PREFIX']
+
+        store_cache_entry('cached_for_this', 'stale', [name], 60,
+                          cache_generations([name]))
+        store_cache_entry('cached_for_other', 'fresh', ['some_other_dataset'], 60,
+                          cache_generations(['some_other_dataset']))
+
+        etl = PlenarioETL(self.unloaded_meta, source_path=self.radio_path)
+        new_table = etl.add()
+
+        self.assertIsNone(redis_client.get(prefix + 'cached_for_this'))
+        self.assertEqual(redis_client.get(prefix + 'cached_for_other'), 'fresh')
+
+        redis_client.delete(prefix + 'cached_for_other')
+        session.close()
+        new_table.drop(app_engine, checkfirst=True)
+
+    def test_responses_built_before_invalidation_are_not_cached(self):
+        name = 'some_dataset'
+        prefix = CACHE_CONFIG['CACHE_KEY_PREFIX']
+
+        # Built from the old data while the ETL ran.
+        generations = cache_generations([name])
+        invalidate_cache_tags([name])
+        self.assertFalse(store_cache_entry('built_during_etl', 'stale', [name], 60, generations))
+        self.assertIsNone(redis_client.get(prefix + 'built_during_etl'))
+
+        # Built after it.
+        self.assertTrue(store_cache_entry('built_after_etl', 'fresh', [name], 60,
+                                          cache_generations([name])))
+        self.assertEqual(redis_client.get(prefix + 'built_after_etl'), 'fresh')
+        invalidate_cache_tags([name])
+        self.assertIsNone(redis_client.get(prefix + 'built_after_etl'))
+
     def test_location_col_add(self):
         drop_if_exists(self.opera_meta.dataset_name)
 
@@ -255,3 +473,90 @@ class StagingTableTests(TestCase):
                                                location='(-87.6495076896,41.7915865543)',
                                                geom=None)
         app_engine.execute(ins)
+
+
+class SourceDownloadTests(TestCase):
+    """
+    Do downloads of a source come out the same however they're read?
+    """
+    def setUp(self):
+        with open(os.path.join(fixtures_path, 'dog_park_permits.csv'), 'rb') as f:
+            self.body = f.read()
+        self.url = 'http://nightvale.gov/dogpark.csv'
+        self.headers = {'ETag': '"v1"'}
+
+    def test_streamed_url_decodes_gzip(self):
+        response = canned_response(self.body, headers=self.headers, gzipped=True)
+        with canned_responses(response):
+            # A small buffer, so decoding hands back more than was asked for.
+            with streamed_url(self.url, buffer_size=64) as (f, fingerprint):
+                streamed = f.read()
+                streamed_fingerprint = fingerprint()
+
+        self.assertEqual(streamed, self.body)
+        self.assertEqual(streamed_fingerprint.etag, '"v1"')
+        self.assertEqual(streamed_fingerprint.digest,
+                         hashlib.sha256(self.body).hexdigest())
+
+    def test_streamed_url_digest_matches_etl_file(self):
+        for gzipped in [False, True]:
+            with canned_responses(
+                    canned_response(self.body, headers=self.headers, gzipped=gzipped),
+                    canned_response(self.body, headers=self.headers, gzipped=gzipped)):
+                with streamed_url(self.url) as (f, fingerprint):
+                    f.read()
+                    streamed_fingerprint = fingerprint()
+                with ETLFile(source_url=self.url) as helper:
+                    downloaded = helper.handle.read()
+                    downloaded_fingerprint = helper.fingerprint
+
+            self.assertEqual(downloaded, self.body)
+            self.assertEqual(streamed_fingerprint, downloaded_fingerprint)
+
+    def test_fetch_source_stops_on_not_modified(self):
+        since = SourceFingerprint('"v1"', 'Tue, 01 Mar 2016 00:00:00 GMT', 'abc')
+        with canned_responses(canned_response('', status_code=304)) as calls:
+            self.assertRaises(SourceUnchanged, fetch_source, self.url, since)
+        headers = calls[0][1]['headers']
+        self.assertEqual(headers['If-None-Match'], '"v1"')
+        self.assertEqual(headers['If-Modified-Since'], 'Tue, 01 Mar 2016 00:00:00 GMT')
+
+        # Without a last download, nothing is conditional.
+        with canned_responses(canned_response(self.body)) as calls:
+            fetch_source(self.url).close()
+        self.assertEqual(calls[0][1]['headers'], {})
+
+    def test_is_unchanged(self):
+        digest = hashlib.sha256(self.body).hexdigest()
+        same = SourceFingerprint('"v2"', None, digest)
+        self.assertTrue(is_unchanged(SourceFingerprint('"v1"', None, digest), same))
+        self.assertFalse(is_unchanged(SourceFingerprint('"v1"', None, 'abc'), same))
+        self.assertFalse(is_unchanged(SourceFingerprint('"v1"', None, None), same))
+        self.assertFalse(is_unchanged(None, same))
+        self.assertFalse(is_unchanged(same, None))
+
+    def test_etl_file_stops_on_same_content(self):
+        since = SourceFingerprint('"v1"', None, hashlib.sha256(self.body).hexdigest())
+        response = canned_response(self.body, headers={'ETag': '"v2"'})
+        with canned_responses(response):
+            with self.assertRaises(SourceUnchanged) as raised:
+                with ETLFile(source_url=self.url, since=since):
+                    pass
+        # The new headers are handed back, to be recorded.
+        self.assertEqual(raised.exception.fingerprint,
+                         SourceFingerprint('"v2"', None, since.digest))
+
+    def test_record_fingerprint(self):
+        meta = MetaTable(url=self.url, human_name='Dog Park Permits',
+                         business_key='Hooded Figure ID',
+                         observed_date='Date', latitude='lat', longitude='lon')
+        self.assertIsNone(source_fingerprint(meta))
+
+        fingerprint = SourceFingerprint('"v1"', None, 'abc')
+        record_fingerprint(meta, fingerprint)
+        self.assertEqual(source_fingerprint(meta), fingerprint)
+
+        # Local files have no fingerprint, and leave the last one alone.
+        record_fingerprint(meta, None)
+        self.assertEqual(source_fingerprint(meta), fingerprint)
+
@@ -1,3 +1,4 @@
+import hashlib
 import json
 import os
 import urllib
@@ -6,10 +7,13 @@ from StringIO import StringIO
 
 from plenario.database import session, app_engine as engine
 from plenario.models import ShapeMetadata
+from plenario.utils.model_helpers import schema_changed
+from plenario.etl.common import SourceFingerprint, record_fingerprint, \
+    source_fingerprint
 from plenario.etl.shape import ShapeETL
 from plenario.utils.shapefile import Shapefile
 from tests.test_fixtures.base_test import BasePlenarioTest, FIXTURE_PATH, \
-    fixtures
+    fixtures, canned_response, canned_responses
 
 
 class ShapeTests(BasePlenarioTest):
@@ -34,6 +38,39 @@ class ShapeTests(BasePlenarioTest):
         # I changed Englewood to Englerwood :P
         self.assertEqual(altered_value, 'Englerwood')
 
+    def test_update_skips_unchanged_source(self):
+        with open(fixtures['neighborhoods'].path, 'rb') as f:
+            body = f.read()
+        shape_meta = session.query(ShapeMetadata).get('chicago_neighborhoods')
+        last_update, last_checked = shape_meta.last_update, shape_meta.last_checked
+        source_url = shape_meta.source_url
+        shape_meta.source_url = 'http://nightvale.gov/neighborhoods.zip'
+        record_fingerprint(shape_meta, SourceFingerprint(
+            '"v1"', None, hashlib.sha256(body).hexdigest()))
+        session.commit()
+
+        try:
+            # The server says it hasn't changed.
+            with canned_responses(canned_response('', status_code=304)) as calls:
+                self.assertFalse(ShapeETL(meta=shape_meta).update())
+            self.assertEqual(calls[0][1]['headers']['If-None-Match'], '"v1"')
+            # The check was committed, but the shapes haven't changed.
+            session.rollback()
+            self.assertNotEqual(shape_meta.last_checked, last_checked)
+            self.assertEqual(shape_meta.last_update, last_update)
+
+            # It doesn't know, but the content is the same.
+            response = canned_response(body, headers={'ETag': '"v2"'})
+            with canned_responses(response):
+                self.assertFalse(ShapeETL(meta=shape_meta).update())
+            session.rollback()
+            self.assertEqual(source_fingerprint(shape_meta).etag, '"v2"')
+        finally:
+            shape_meta.source_url = source_url
+            shape_meta.source_etag = shape_meta.source_last_modified = \
+                shape_meta.source_digest = None
+            session.commit()
+
     def test_no_import_when_name_conflict(self):
         # The city fixture should already be ingested
         with self.assertRaises(Exception):
@@ -46,6 +83,7 @@ class ShapeTests(BasePlenarioTest):
         self.assertIsNotNone(city_meta)
         city_meta.remove_table()
         session.commit()
+        schema_changed()
         city_meta = session.query(ShapeMetadata).get(fixtures['city'].table_name)
         self.assertIsNone(city_meta)
 
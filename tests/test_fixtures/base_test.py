@@ -1,6 +1,12 @@
+import gzip
 import os
+from contextlib import contextmanager
+from io import BytesIO
 
+import requests
 import unittest
+from requests.structures import CaseInsensitiveDict
+from urllib3.response import HTTPResponse
 
 from tests.test_fixtures.point_meta import flu_shot_meta, landmarks_meta, \
     flu_path, landmarks_path, crime_meta, crime_path
@@ -34,6 +40,48 @@ def drop_tables(table_names):
     session.commit()
 
 
+def canned_response(body, status_code=200, headers=None, gzipped=False):
+    """
+    A streaming requests response the way a server would send body.
+    """
+    headers = dict(headers or {})
+    if gzipped:
+        buf = BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb') as gz:
+            gz.write(body)
+        body = buf.getvalue()
+        headers['Content-Encoding'] = 'gzip'
+
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers = CaseInsensitiveDict(headers)
+    response.raw = HTTPResponse(BytesIO(body), headers=headers,
+                                status=status_code, preload_content=False,
+                                decode_content=False)
+    return response
+
+
+@contextmanager
+def canned_responses(*responses):
+    """
+    Answer requests.get with responses, in order, instead of the network.
+    :return: list of the (url, kwargs) requests.get was called with
+    """
+    responses = list(responses)
+    calls = []
+
+    def get(url, **kwargs):
+        calls.append((url, kwargs))
+        return responses.pop(0)
+
+    real_get = requests.get
+    requests.get = get
+    try:
+        yield calls
+    finally:
+        requests.get = real_get
+
+
 class Fixture(object):
     def __init__(self, human_name, file_name):
         self.human_name = human_name